@@ -331,3 +331,138 @@ SOCIALACCOUNT_FORMS = {"signup": "messaging_service.users.forms.UserSocialSignup
 
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Messaging API
+# ------------------------------------------------------------------------------
+# Seconds an inbound (type, messaging_provider_id) is remembered in the cache, so provider
+# retries are acknowledged without reaching the database. 0 turns the cache filter off,
+# duplicates are still caught by the unique index.
+API_WEBHOOK_DEDUPE_TIMEOUT = env.int("API_WEBHOOK_DEDUPE_TIMEOUT", default=15 * 60)
+# Queue outbound sends with .delay() and answer 202 instead of calling the provider inside
+# the request. Off by default so the synchronous path the tests exercise stays available.
+API_ASYNC_SEND = env.bool("API_ASYNC_SEND", default=False)
+# Participant identifier -> id cache: entries kept in each process's LRU, seconds they live
+# in the shared cache, and seconds they live in each LRU (which bounds how long another
+# process can keep using a participant after it's deleted).
+API_PARTICIPANT_CACHE_SIZE = env.int("API_PARTICIPANT_CACHE_SIZE", default=10_000)
+API_PARTICIPANT_CACHE_TIMEOUT = env.int("API_PARTICIPANT_CACHE_TIMEOUT", default=24 * 60 * 60)
+API_PARTICIPANT_CACHE_TTL = env.int("API_PARTICIPANT_CACHE_TTL", default=5 * 60)
+# Participant pair -> conversation id cache, per process: entries kept and seconds before they expire.
+API_CONVERSATION_CACHE_SIZE = env.int("API_CONVERSATION_CACHE_SIZE", default=50_000)
+API_CONVERSATION_CACHE_TTL = env.int("API_CONVERSATION_CACHE_TTL", default=5 * 60)
+# Outbound providers, keyed by provider (sms covers mms). An empty url keeps the stub that
+# pretends every send succeeded, as local development and the tests expect. Providers with a
+# batch_url get batch sends of up to batch_size messages from one sender in a single call.
+API_PROVIDERS = {
+    "sms": {
+        "url": env("API_SMS_PROVIDER_URL", default=""),
+        "api_key": env("API_SMS_PROVIDER_API_KEY", default=""),
+        "batch_url": env("API_SMS_PROVIDER_BATCH_URL", default=""),
+        "batch_size": env.int("API_SMS_PROVIDER_BATCH_SIZE", default=100),
+    },
+    "email": {
+        "url": env("API_EMAIL_PROVIDER_URL", default=""),
+        "api_key": env("API_EMAIL_PROVIDER_API_KEY", default=""),
+        "batch_url": env("API_EMAIL_PROVIDER_BATCH_URL", default=""),
+        "batch_size": env.int("API_EMAIL_PROVIDER_BATCH_SIZE", default=1000),
+    },
+}
+# Seconds. The connect timeout is kept short so a dead provider fails fast, reads get longer.
+API_PROVIDER_CONNECT_TIMEOUT = env.float("API_PROVIDER_CONNECT_TIMEOUT", default=3.0)
+API_PROVIDER_READ_TIMEOUT = env.float("API_PROVIDER_READ_TIMEOUT", default=10.0)
+# Keep-alive connections each worker process holds open per provider.
+API_PROVIDER_POOL_SIZE = env.int("API_PROVIDER_POOL_SIZE", default=10)
+# Provider rate limits shared by all workers (through Redis in production): tokens (sends)
+# per second, and how many can go out at once after a quiet spell.
+API_PROVIDER_RATE_LIMITS = {
+    "sms": {
+        "rate": env.float("API_SMS_PROVIDER_RATE", default=30.0),
+        "burst": env.int("API_SMS_PROVIDER_BURST", default=60),
+    },
+    "email": {
+        "rate": env.float("API_EMAIL_PROVIDER_RATE", default=100.0),
+        "burst": env.int("API_EMAIL_PROVIDER_BURST", default=200),
+    },
+}
+# Seconds a send waits on a rate limited (or 429 paused) provider before it's rescheduled instead.
+API_RATE_LIMIT_MAX_WAIT = env.float("API_RATE_LIMIT_MAX_WAIT", default=10.0)
+# Provider circuit breakers: consecutive failed sends (5xx or no response) that open a
+# provider's circuit, seconds it stays open before a probe send is let through, and seconds
+# before another probe is allowed if that one never reports back.
+API_CIRCUIT_BREAKER_THRESHOLD = env.int("API_CIRCUIT_BREAKER_THRESHOLD", default=5)
+API_CIRCUIT_BREAKER_OPEN_SECONDS = env.float("API_CIRCUIT_BREAKER_OPEN_SECONDS", default=30.0)
+API_CIRCUIT_BREAKER_PROBE_TIMEOUT = env.float("API_CIRCUIT_BREAKER_PROBE_TIMEOUT", default=15.0)
+# Batch sends: messages claimed per task, and provider calls each task keeps in flight.
+API_SEND_BATCH_SIZE = env.int("API_SEND_BATCH_SIZE", default=500)
+API_SEND_CONCURRENCY = env.int("API_SEND_CONCURRENCY", default=50)
+# Failed sends wait in MessageStatus.next_attempt_at and are queued by the pump_retries task:
+# seconds between pump runs, retries each provider gets queued per run, the most a retry's
+# backoff is stretched by (0.25 = up to 25% later), and seconds a queued retry or in-flight
+# send is leased for before it's due again in case its task or worker was lost.
+API_RETRY_PUMP_INTERVAL = env.float("API_RETRY_PUMP_INTERVAL", default=5.0)
+API_RETRY_BUDGET = {
+    "sms": env.int("API_SMS_RETRY_BUDGET", default=500),
+    "email": env.int("API_EMAIL_RETRY_BUDGET", default=500),
+}
+API_RETRY_JITTER = env.float("API_RETRY_JITTER", default=0.25)
+API_RETRY_LEASE = env.int("API_RETRY_LEASE", default=5 * 60)
+# Outbound sends are written to an outbox with their message: seconds between relay_outbox
+# runs, entries each run publishes at most, and seconds after publishing an entry whose send
+# still hasn't been claimed (its task may have been lost) is published again, doubling with
+# each time it's published.
+API_OUTBOX_RELAY_INTERVAL = env.float("API_OUTBOX_RELAY_INTERVAL", default=1.0)
+API_OUTBOX_RELAY_BATCH_SIZE = env.int("API_OUTBOX_RELAY_BATCH_SIZE", default=1000)
+API_OUTBOX_RELAY_LEASE = env.int("API_OUTBOX_RELAY_LEASE", default=10 * 60)
+# Sends given up on are kept as dead letters, requeued this many per transaction.
+API_DEAD_LETTER_REQUEUE_CHUNK_SIZE = env.int("API_DEAD_LETTER_REQUEUE_CHUNK_SIZE", default=1000)
+# Message bodies over API_BODY_INLINE_MAX_BYTES are stored zlib compressed, and ones still over
+# API_BODY_BLOB_MIN_BYTES compressed are moved out of the database to API_BODY_STORAGE (any
+# Django storage backend, e.g. S3 through django-storages) with just a preview kept in the row.
+# The default keeps them on local disk under MEDIA_ROOT, set API_BODY_STORAGE_ROOT to a
+# persistent volume when deploying.
+API_BODY_INLINE_MAX_BYTES = env.int("API_BODY_INLINE_MAX_BYTES", default=4 * 1024)
+API_BODY_BLOB_MIN_BYTES = env.int("API_BODY_BLOB_MIN_BYTES", default=64 * 1024)
+API_BODY_STORAGE = {
+    "BACKEND": "django.core.files.storage.FileSystemStorage",
+    "OPTIONS": {"location": env("API_BODY_STORAGE_ROOT", default=str(Path(MEDIA_ROOT) / "message_bodies"))},
+}
+# Postgres text search configuration messages are indexed and searched with.
+API_SEARCH_CONFIG = env("API_SEARCH_CONFIG", default="english")
+# Messages are partitioned by month: months ahead of the current one maintain_message_partitions
+# keeps partitions created for, and months of messages kept before their partitions are dropped
+# (0 keeps them all).
+API_MESSAGE_PARTITION_MONTHS_AHEAD = env.int("API_MESSAGE_PARTITION_MONTHS_AHEAD", default=3)
+API_MESSAGE_RETENTION_MONTHS = env.int("API_MESSAGE_RETENTION_MONTHS", default=0)
+# Priority lanes: transactional sends (a one-off 2FA code) and bulk ones (a campaign) are queued
+# on their own Celery queues, so a bulk backlog is never in front of a transactional send. Give
+# each queue its own workers, and keep the default queue (beat's pump_retries and relay_outbox)
+# off the bulk workers too, e.g.
+#   celery -A config.celery_app worker -Q sends-transactional,celery --concurrency 4
+#   celery -A config.celery_app worker -Q sends-bulk --concurrency 8
+API_SEND_QUEUES = {
+    "transactional": env("API_TRANSACTIONAL_SEND_QUEUE", default="sends-transactional"),
+    "bulk": env("API_BULK_SEND_QUEUE", default="sends-bulk"),
+}
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html#task-routes
+# send_message_batch is published to a lane explicitly, see publish_sends
+CELERY_TASK_ROUTES = {
+    "messaging_service.api.tasks.attempt_send_message": {"queue": API_SEND_QUEUES["transactional"]},
+    "messaging_service.api.tasks.send_pending_messages": {"queue": API_SEND_QUEUES["bulk"]},
+}
+# https://docs.celeryq.dev/en/stable/userguide/configuration.html#worker-prefetch-multiplier
+# a send batch can take a while, don't let an idle worker's share sit prefetched behind a busy one
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# https://docs.celeryq.dev/en/stable/userguide/periodic-tasks.html#beat-entries
+CELERY_BEAT_SCHEDULE = {
+    "pump-retries": {
+        "task": "messaging_service.api.tasks.pump_retries",
+        "schedule": API_RETRY_PUMP_INTERVAL,
+    },
+    "relay-outbox": {
+        "task": "messaging_service.api.tasks.relay_outbox",
+        "schedule": API_OUTBOX_RELAY_INTERVAL,
+    },
+    "maintain-message-partitions": {
+        "task": "messaging_service.api.tasks.maintain_message_partitions",
+        "schedule": 60 * 60,
+    },
+}
@@ -3,8 +3,23 @@ from django.contrib import admin
 # Register your models here.
 from .models import Conversation, Message, MessageStatus, Participant, Attachment
 
+
+class MessageAdmin(admin.ModelAdmin):
+    # the change list only shows previews, don't load every body for it
+    list_display = ['id', 'type', 'timestamp', 'body_preview', 'body_storage']
+    exclude = ['inline_body', 'search_vector']
+    readonly_fields = ['full_body', 'body_preview', 'body_storage', 'body_blob']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('inline_body', 'body_compressed', 'search_vector')
+
+    @admin.display(description='Body')
+    def full_body(self, message):
+        return message.body
+
+
 admin.site.register(Conversation)
-admin.site.register(Message)
+admin.site.register(Message, MessageAdmin)
 admin.site.register(MessageStatus)
 admin.site.register(Participant)
-admin.site.register(Attachment)
\ No newline at end of file
+admin.site.register(Attachment)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messaging_service.api'
+
+    def ready(self):
+        import messaging_service.api.signals  # noqa: F401, PLC0415
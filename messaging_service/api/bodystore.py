@@ -0,0 +1,42 @@
+import hashlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import storages
+from django.db import connection
+
+# Message bodies too big to keep in their row (see Message.body) live here, named by the sha256 of their content so
+# the same body is only stored once and a write never needs coordinating. Any Django storage backend will do, a
+# directory on the local filesystem unless API_BODY_STORAGE says otherwise.
+
+
+class BodyStore:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def name(self, key):
+        return f'{key[:2]}/{key[2:4]}/{key}'
+
+    def lock_id(self, key):
+        """The advisory lock id guarding a key against being deleted while it's being stored"""
+        return int(key[:15], 16)
+
+    def put(self, data):
+        """Stores data, returning its key. Call it inside the transaction that saves the message referring to the
+        key: until that commits, MessageManager.drop_partitions won't delete the body as unreferenced."""
+        key = hashlib.sha256(data).hexdigest()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock_shared(%s)", [self.lock_id(key)])
+        if not self.storage.exists(self.name(key)):
+            self.storage.save(self.name(key), ContentFile(data))
+        return key
+
+    def get(self, key):
+        with self.storage.open(self.name(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key):
+        self.storage.delete(self.name(key))
+
+
+body_store = BodyStore(storages.create_storage(settings.API_BODY_STORAGE))
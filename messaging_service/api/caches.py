@@ -0,0 +1,202 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import Conversation, Participant
+
+# Every send and receive resolves two participant identifiers and the conversation between them, and the same few
+# thousand business numbers and addresses show up in nearly every message. These caches keep those lookups out of
+# the per-message query budget.
+
+
+class LRUCache:
+    """A bounded in-process LRU. Least recently used keys are evicted once maxsize is reached, and with a ttl
+    (seconds) entries also expire, which bounds how stale another process's deletes can leave them."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (value, expires at or None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_many(self, keys):
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is not None and entry[1] is not None and entry[1] <= now:
+                    del self._data[key]
+                    self.expirations += 1
+                    entry = None
+                if entry is not None:
+                    self._data.move_to_end(key)
+                    found[key] = entry[0]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def set_many(self, values):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            for key, value in values.items():
+                self._data[key] = (value, expires_at)
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data), 'maxsize': self.maxsize,
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations,
+        }
+
+
+class ParticipantCache:
+    """Resolves participant identifiers to ids: the in-process LRU first, then the shared cache (Redis in
+    production, so one worker's lookups warm the others), then an upsert for whatever is still missing.
+
+    Participant ids never change, so entries only need evicting when a participant is deleted. A delete evicts from
+    the shared cache and the deleting process's LRU, the other processes' entries expire after ttl seconds. Ids from the
+    database are only cached once the transaction that read or created them commits, so a rolled back request
+    can't leave ids of participants that were never saved.
+    """
+
+    def __init__(self, maxsize, timeout, ttl, cache_alias='default'):
+        self.local = LRUCache(maxsize, ttl)
+        self.timeout = timeout
+        self.cache_alias = cache_alias
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def key(self, identifier):
+        return f'api:participant:{identifier}'
+
+    def resolve(self, identifiers):
+        """Returns {identifier: participant id}, creating participants that don't exist yet"""
+        identifiers = set(identifiers)
+        participant_ids = self.local.get_many(identifiers)
+
+        missing = identifiers - participant_ids.keys()
+        if missing:
+            shared = caches[self.cache_alias].get_many([self.key(identifier) for identifier in missing])
+            found = {identifier: shared[self.key(identifier)] for identifier in missing if self.key(identifier) in shared}
+            self.shared_hits += len(found)
+            self.shared_misses += len(missing) - len(found)
+            self.local.set_many(found)
+            participant_ids.update(found)
+
+            missing -= found.keys()
+            if missing:
+                created = Participant.objects.get_or_create_identifiers(missing)
+                transaction.on_commit(lambda: self.remember(created), robust=True)
+                participant_ids.update(created)
+        return participant_ids
+
+    def remember(self, participant_ids):
+        caches[self.cache_alias].set_many(
+            {self.key(identifier): id for identifier, id in participant_ids.items()}, timeout=self.timeout,
+        )
+        self.local.set_many(participant_ids)
+
+    def lookup(self, identifiers):
+        """Like resolve, but only returns participants that already exist"""
+        identifiers = set(identifiers)
+        participant_ids = self.local.get_many(identifiers)
+        missing = identifiers - participant_ids.keys()
+        if missing:
+            found = dict(Participant.objects.filter(identifier__in=missing).values_list('identifier', 'id'))
+            transaction.on_commit(lambda: self.local.set_many(found), robust=True)
+            participant_ids.update(found)
+        return participant_ids
+
+    def evict(self, identifier):
+        self.local.delete(identifier)
+        caches[self.cache_alias].delete(self.key(identifier))
+
+    def clear(self):
+        """Empties this process's LRU. The shared cache entries expire on their own."""
+        self.local.clear()
+
+    def stats(self):
+        return {**self.local.stats(), 'shared_hits': self.shared_hits, 'shared_misses': self.shared_misses}
+
+
+class ConversationCache:
+    """Normalized (participant1_id, participant2_id) -> conversation id, so steady traffic on existing threads skips
+    the conversation lookup entirely. In-process only, with a TTL as the backstop for deletes made elsewhere. Like
+    participants, ids are only cached once their transaction commits."""
+
+    def __init__(self, maxsize, ttl):
+        self.local = LRUCache(maxsize, ttl)
+
+    def normalize(self, participant1_id, participant2_id):
+        return (min(participant1_id, participant2_id), max(participant1_id, participant2_id))
+
+    def resolve(self, pairs):
+        """Returns {normalized pair: conversation id}, creating conversations that don't exist yet"""
+        pairs = {self.normalize(p1, p2) for p1, p2 in pairs}
+        conversation_ids = self.local.get_many(pairs)
+        missing = pairs - conversation_ids.keys()
+        if missing:
+            created = Conversation.objects.get_or_create_for_pairs(missing)
+            transaction.on_commit(lambda: self.local.set_many(created), robust=True)
+            conversation_ids.update(created)
+        return conversation_ids
+
+    def get_or_create(self, participant1_id, participant2_id):
+        return self.resolve([(participant1_id, participant2_id)])[self.normalize(participant1_id, participant2_id)]
+
+    def lookup(self, participant1_id, participant2_id):
+        """The conversation id between two participants, or None. Doesn't create anything."""
+        pair = self.normalize(participant1_id, participant2_id)
+        conversation_ids = self.local.get_many([pair])
+        if pair not in conversation_ids:
+            conversation_ids = list(Conversation.objects.filter(
+                participant1_id=pair[0], participant2_id=pair[1],
+            ).values_list('id', flat=True))
+            if not conversation_ids:
+                return None
+            conversation_id = conversation_ids[0]
+            transaction.on_commit(lambda: self.local.set_many({pair: conversation_id}), robust=True)
+            return conversation_id
+        return conversation_ids[pair]
+
+    def evict(self, participant1_id, participant2_id):
+        self.local.delete(self.normalize(participant1_id, participant2_id))
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return self.local.stats()
+
+
+participant_cache = ParticipantCache(
+    maxsize=settings.API_PARTICIPANT_CACHE_SIZE,
+    timeout=settings.API_PARTICIPANT_CACHE_TIMEOUT,
+    ttl=settings.API_PARTICIPANT_CACHE_TTL,
+)
+
+conversation_cache = ConversationCache(
+    maxsize=settings.API_CONVERSATION_CACHE_SIZE,
+    ttl=settings.API_CONVERSATION_CACHE_TTL,
+)
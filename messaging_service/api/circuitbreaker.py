@@ -0,0 +1,169 @@
+import threading
+import time
+
+from django.conf import settings
+
+from .ratelimit import shared_redis
+
+# Per provider circuit breakers shared by every worker. After `threshold` consecutive failed sends (5xx or no
+# response at all) a provider's circuit opens and sends are deferred without calling it. Once `open_seconds` have
+# passed it's half open: a single probe send is let through, closing the circuit if it succeeds and reopening it
+# if it doesn't. If the probe never reports back, another is let through after `probe_timeout`.
+# Like the rate limiter the state lives in Redis when that's the cache, in process otherwise.
+
+# KEYS[1] breaker hash. ARGV: probe timeout. Returns seconds until a send may be tried, "0" to send now.
+ALLOW_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local breaker = redis.call('HMGET', KEYS[1], 'opened_until', 'probe_until')
+local opened_until = tonumber(breaker[1]) or 0
+if opened_until == 0 then
+    return '0'
+end
+if now < opened_until then
+    return tostring(opened_until - now)
+end
+local probe_until = tonumber(breaker[2]) or 0
+if now < probe_until then
+    return tostring(probe_until - now)
+end
+redis.call('HSET', KEYS[1], 'probe_until', tostring(now + tonumber(ARGV[1])))
+return '0'
+"""
+
+# KEYS[1] breaker hash. ARGV: 1 if the send succeeded else 0, failure threshold, seconds to stay open.
+RECORD_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local opened_until = tonumber(redis.call('HGET', KEYS[1], 'opened_until')) or 0
+if ARGV[1] == '1' then
+    redis.call('HSET', KEYS[1], 'failures', 0, 'opened_until', 0, 'probe_until', 0)
+    return
+end
+if opened_until ~= 0 then
+    -- a failed probe reopens the circuit, stragglers sent before it opened don't extend it
+    if now >= opened_until then
+        redis.call('HSET', KEYS[1], 'opened_until', tostring(now + tonumber(ARGV[3])), 'probe_until', 0)
+        redis.call('HINCRBY', KEYS[1], 'opens', 1)
+    end
+    return
+end
+if redis.call('HINCRBY', KEYS[1], 'failures', 1) >= tonumber(ARGV[2]) then
+    redis.call('HSET', KEYS[1], 'failures', 0, 'opened_until', tostring(now + tonumber(ARGV[3])), 'probe_until', 0)
+    redis.call('HINCRBY', KEYS[1], 'opens', 1)
+end
+"""
+
+
+class RedisBreakers:
+    def __init__(self, redis):
+        self.redis = redis
+        self.allow_script = redis.register_script(ALLOW_SCRIPT)
+        self.record_script = redis.register_script(RECORD_SCRIPT)
+
+    def key(self, provider):
+        return f'api:circuit:{provider}'
+
+    def allow(self, provider, probe_timeout):
+        return float(self.allow_script(keys=[self.key(provider)], args=[probe_timeout]))
+
+    def record(self, provider, success, threshold, open_seconds):
+        self.record_script(keys=[self.key(provider)], args=[1 if success else 0, threshold, open_seconds])
+
+    def state(self, provider):
+        breaker = self.redis.hgetall(self.key(provider))
+        seconds, microseconds = self.redis.time()
+        return breaker_state({k.decode(): float(v) for k, v in breaker.items()}, seconds + microseconds / 1_000_000)
+
+
+class LocalBreakers:
+    """The same breakers, in process"""
+
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def allow(self, provider, probe_timeout):
+        now = time.time()
+        with self.lock:
+            breaker = self.breakers.setdefault(provider, {})
+            opened_until = breaker.get('opened_until', 0)
+            if not opened_until:
+                return 0
+            if now < opened_until:
+                return opened_until - now
+            if now < breaker.get('probe_until', 0):
+                return breaker['probe_until'] - now
+            breaker['probe_until'] = now + probe_timeout
+            return 0
+
+    def record(self, provider, success, threshold, open_seconds):
+        now = time.time()
+        with self.lock:
+            breaker = self.breakers.setdefault(provider, {})
+            opened_until = breaker.get('opened_until', 0)
+            if success:
+                breaker.update(failures=0, opened_until=0, probe_until=0)
+            elif opened_until:
+                if now >= opened_until:
+                    breaker.update(opened_until=now + open_seconds, probe_until=0)
+                    breaker['opens'] = breaker.get('opens', 0) + 1
+            else:
+                breaker['failures'] = breaker.get('failures', 0) + 1
+                if breaker['failures'] >= threshold:
+                    breaker.update(failures=0, opened_until=now + open_seconds, probe_until=0)
+                    breaker['opens'] = breaker.get('opens', 0) + 1
+
+    def state(self, provider):
+        with self.lock:
+            return breaker_state(dict(self.breakers.get(provider, {})), time.time())
+
+
+def breaker_state(breaker, now):
+    opened_until = breaker.get('opened_until', 0)
+    if not opened_until:
+        state = 'closed'
+    elif now < opened_until:
+        state = 'open'
+    else:
+        state = 'half_open'
+    return {
+        'state': state,
+        'failures': int(breaker.get('failures', 0)),
+        'open_for': round(max(0, opened_until - now), 2),
+        'opens': int(breaker.get('opens', 0)),
+    }
+
+
+class CircuitBreaker:
+    def __init__(self, breakers, providers, threshold, open_seconds, probe_timeout):
+        self.breakers = breakers
+        self.providers = providers
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.probe_timeout = probe_timeout
+
+    def allow(self, provider):
+        """Returns None if a send to provider may go ahead, otherwise the seconds to defer it for"""
+        wait = self.breakers.allow(provider, self.probe_timeout)
+        return wait or None
+
+    def record(self, provider, success):
+        self.breakers.record(provider, success, self.threshold, self.open_seconds)
+
+    def state(self):
+        return {provider: self.breakers.state(provider) for provider in self.providers}
+
+
+def build_circuit_breaker():
+    redis = shared_redis()
+    return CircuitBreaker(
+        RedisBreakers(redis) if redis is not None else LocalBreakers(),
+        list(settings.API_PROVIDERS),
+        threshold=settings.API_CIRCUIT_BREAKER_THRESHOLD,
+        open_seconds=settings.API_CIRCUIT_BREAKER_OPEN_SECONDS,
+        probe_timeout=settings.API_CIRCUIT_BREAKER_PROBE_TIMEOUT,
+    )
+
+
+circuit_breaker = build_circuit_breaker()
@@ -1,18 +1,298 @@
-from django.http import HttpResponse
-def send_sms(message):
-    print(f"Sending SMS (pretend integrations would be implemented here). Data dump:")
+import asyncio
+import math
+import os
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import httpx
+from django.conf import settings
+
+from .circuitbreaker import circuit_breaker
+from .ratelimit import rate_limiter
+
+# Provider clients. Each worker process keeps one pooled, keep-alive httpx client per provider, so a busy worker
+# reuses warm connections instead of paying for a TCP (and TLS) handshake on every send.
+# With no url configured for a provider we keep the old behaviour of pretending the send succeeded.
+
+PROVIDER_FOR_TYPE = {'sms': 'sms', 'mms': 'sms', 'email': 'email'} # message type -> provider
+DEFAULT_RETRY_AFTER = 1 # seconds a provider is paused for after a 429 without a usable Retry-After
+
+@dataclass
+class ProviderResponse:
+    status_code: int
+    headers: dict = field(default_factory=dict)
+    sent: bool = True # False for responses we made up without calling the provider
+
+    @classmethod
+    def throttled(cls, wait):
+        """Stands in for a 429 when the provider is paused for longer than we'll hold a worker, so the send gets
+        rescheduled like one"""
+        return cls(status_code=429, headers={'Retry-After': str(math.ceil(wait))}, sent=False)
+
+    @classmethod
+    def circuit_open(cls, wait):
+        """Stands in for a 503 while the provider's circuit is open"""
+        return cls(status_code=503, headers={'Retry-After': str(math.ceil(wait))}, sent=False)
+
+    @classmethod
+    def error(cls):
+        """Stands in for a 503 when a call couldn't be made for a reason of our own (e.g. Redis is down)"""
+        return cls(status_code=503, sent=False)
+
+
+def retry_after(response):
+    """Whole seconds a response's Retry-After asks for, given as seconds or as an HTTP-date (RFC 9110), and
+    DEFAULT_RETRY_AFTER if it's missing or unreadable"""
+    value = response.headers.get('Retry-After', '').strip()
+    try:
+        return max(0, math.ceil(float(value)))
+    except (ValueError, OverflowError):
+        pass
+    try:
+        return max(0, math.ceil((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class ProviderClient:
+    def __init__(self, name, url, api_key='', batch_url='', batch_size=1):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        # with a batch_url, send_messages groups up to batch_size messages of a type from one sender into one call
+        self.batch_url = batch_url
+        self.batch_size = batch_size
+        self._client = None
+
+    def client_options(self, pool_size):
+        return {
+            'timeout': httpx.Timeout(
+                settings.API_PROVIDER_READ_TIMEOUT,
+                connect=settings.API_PROVIDER_CONNECT_TIMEOUT,
+                pool=settings.API_PROVIDER_CONNECT_TIMEOUT,
+            ),
+            'limits': httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            'headers': {'Authorization': f'Bearer {self.api_key}'} if self.api_key else {},
+        }
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.Client(**self.client_options(settings.API_PROVIDER_POOL_SIZE))
+        return self._client
+
+    def async_client(self, concurrency):
+        """A fresh AsyncClient for one event loop, sized for `concurrency` requests in flight"""
+        return httpx.AsyncClient(**self.client_options(concurrency))
+
+    def send(self, payload):
+        """POSTs one message. Transport failures come back as a 503 so attempt_send_message retries them like a
+        provider outage, everything else is the provider's own status code and headers (e.g. Retry-After)."""
+        wait = circuit_breaker.allow(self.name)
+        if wait is not None:
+            return ProviderResponse.circuit_open(wait)
+        wait = rate_limiter.acquire(self.name)
+        if wait is not None:
+            return ProviderResponse.throttled(wait)
+        try:
+            response = self.client.post(self.url, json=payload)
+        except httpx.TransportError as e:
+            return self.transport_error(e)
+        return self.response(response)
+
+    def response(self, response):
+        self.record(response)
+        return ProviderResponse(status_code=response.status_code, headers=response.headers)
+
+    def record(self, response):
+        """Feeds a response to the provider's rate limiter and circuit breaker"""
+        if response.status_code == 429:
+            # the provider is throttling all of us, not just this message
+            rate_limiter.pause(self.name, retry_after(response))
+        circuit_breaker.record(self.name, success=response.status_code < 500)
+
+    def transport_error(self, error):
+        print(f"{self.name} provider request failed: {error!r}")
+        circuit_breaker.record(self.name, success=False)
+        return ProviderResponse(status_code=503)
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+_clients = {}
+
+def get_client(provider):
+    if provider not in _clients:
+        config = settings.API_PROVIDERS[provider]
+        _clients[provider] = ProviderClient(
+            provider, config['url'], config.get('api_key', ''),
+            batch_url=config.get('batch_url', ''), batch_size=config.get('batch_size', 1),
+        )
+    return _clients[provider]
+
+def _reset_clients():
+    # a forked child (Celery prefork) must not share its parent's sockets, it builds its own pool on first use
+    _clients.clear()
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+
+def recipient_payload(message):
+    return {
+        'to': message.to_participant.identifier,
+        'body': message.body,
+        'attachments': [attachment.url for attachment in message.attachments.all()],
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+def message_payload(message):
+    payload = {'from': message.from_participant.identifier, **recipient_payload(message)}
+    if message.type != 'email':
+        payload['type'] = message.type
+    return payload
+
+def batch_payload(messages):
+    """One call's worth of messages of the same type from the same sender. The provider answers a 2xx with a result
+    per message, in order: {"results": [{"status": 202, "id": "..."}, ...]}."""
+    payload = {
+        'from': messages[0].from_participant.identifier,
+        'messages': [recipient_payload(message) for message in messages],
+    }
+    if messages[0].type != 'email':
+        payload['type'] = messages[0].type
+    return payload
+
+def pretend_send(message):
+    print(f"Sending {message.type} (no provider configured, pretending it succeeded). Data dump:")
     print("Message:")
     print(message)
     print("Attachments:")
     print("\n".join([attachment.url for attachment in message.attachments.all()]))
     print()
-    return HttpResponse(status=200)
+    return ProviderResponse(status_code=200)
+
+def send_message(message):
+    client = get_client(PROVIDER_FOR_TYPE[message.type])
+    if not client.url:
+        return pretend_send(message)
+    return client.send(message_payload(message))
+
+@dataclass
+class ProviderCall:
+    """One request to a provider: a single message, or several to its batch_url"""
+    provider: ProviderClient
+    payload: dict
+    indexes: list # where the call's messages are in the list given to send_messages
+    batch: bool = False
+
+def batch_responses(call, response):
+    """Splits a batch call's response into one ProviderResponse per message. A call that failed as a whole (a 429,
+    a 5xx) failed for each of its messages."""
+    if not 200 <= response.status_code < 300:
+        return [ProviderResponse(status_code=response.status_code, headers=response.headers)] * len(call.indexes)
+    try:
+        results = response.json()['results']
+    except (ValueError, KeyError, TypeError):
+        results = []
+    if not isinstance(results, list):
+        results = []
+    # a result missing from an accepted batch, or one we can't read, is taken as accepted: retrying it could send it
+    # twice
+    return [
+        ProviderResponse(status_code=result_status(results[i] if i < len(results) else None, response.status_code))
+        for i in range(len(call.indexes))
+    ]
+
+def result_status(result, default):
+    status = result.get('status') if isinstance(result, dict) else None
+    return status if isinstance(status, int) and not isinstance(status, bool) else default
+
+async def _send_concurrently(calls, concurrency):
+    """Makes the calls with up to `concurrency` in flight, returning each one's list of ProviderResponses"""
+    semaphore = asyncio.Semaphore(concurrency)
+    providers = {call.provider.name: call.provider for call in calls}
+    async_clients = {name: provider.async_client(concurrency) for name, provider in providers.items()}
+
+    async def send_one(call):
+        try:
+            return await make_call(call)
+        except Exception as e:
+            # one call going wrong mustn't lose the rest of the chunk's outcomes, its messages are retried
+            print(f"{call.provider.name} provider call failed: {e!r}")
+            return [ProviderResponse.error()] * len(call.indexes)
+
+    async def make_call(call):
+        # the circuit breaker and rate limiter are Redis round trips, made on threads so they don't stall the other
+        # calls in flight
+        provider = call.provider
+        async with semaphore:
+            wait = await asyncio.to_thread(circuit_breaker.allow, provider.name)
+            if wait is not None:
+                return [ProviderResponse.circuit_open(wait)] * len(call.indexes)
+            wait = await rate_limiter.acquire_async(provider.name)
+            if wait is not None:
+                return [ProviderResponse.throttled(wait)] * len(call.indexes)
+            try:
+                response = await async_clients[provider.name].post(
+                    provider.batch_url if call.batch else provider.url, json=call.payload,
+                )
+            except httpx.TransportError as e:
+                return [await asyncio.to_thread(provider.transport_error, e)] * len(call.indexes)
+            responses = (
+                batch_responses(call, response) if call.batch
+                else [ProviderResponse(status_code=response.status_code, headers=response.headers)]
+            )
+            try:
+                await asyncio.to_thread(provider.record, response)
+            except Exception as e:
+                # the provider has answered, what it said stands
+                print(f"Couldn't record {provider.name} provider's response: {e!r}")
+            return responses
+
+    try:
+        return await asyncio.gather(*[send_one(call) for call in calls])
+    finally:
+        for async_client in async_clients.values():
+            await async_client.aclose()
+
+def send_messages(messages, concurrency):
+    """Sends many messages with up to `concurrency` provider calls in flight, returning a ProviderResponse per
+    message in order. Messages of the same type from the same sender go out in batches where the provider takes
+    them. Payloads are built before the event loop starts, so prefetch attachments (and select the participants)
+    to keep this from querying per message."""
+    responses = [None] * len(messages)
+    calls = []
+    groups = {}
+    for index, message in enumerate(messages):
+        client = get_client(PROVIDER_FOR_TYPE[message.type])
+        if not client.url:
+            responses[index] = pretend_send(message)
+        elif client.batch_url:
+            groups.setdefault((client.name, message.type, message.from_participant_id), []).append(index)
+        else:
+            calls.append(ProviderCall(client, message_payload(message), [index]))
+
+    for (provider, _, _), indexes in groups.items():
+        client = get_client(provider)
+        for i in range(0, len(indexes), client.batch_size):
+            chunk = indexes[i:i + client.batch_size]
+            if len(chunk) == 1:
+                calls.append(ProviderCall(client, message_payload(messages[chunk[0]]), chunk))
+            else:
+                calls.append(ProviderCall(client, batch_payload([messages[j] for j in chunk]), chunk, batch=True))
+
+    if calls:
+        for call, call_responses in zip(calls, asyncio.run(_send_concurrently(calls, concurrency))):
+            for index, response in zip(call.indexes, call_responses):
+                responses[index] = response
+    return responses
+
+def send_sms(message):
+    return send_message(message)
 
 def send_email(message):
-    print(f"Sending Email (pretend integrations would be implemented here). Data dump:")
-    print("Message:")
-    print(message)
-    print("Attachments:")
-    print("\n".join([attachment.url for attachment in message.attachments.all()]))
-    print()
-    return HttpResponse(status=200)
\ No newline at end of file
+    return send_message(message)
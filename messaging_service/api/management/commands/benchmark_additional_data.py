@@ -0,0 +1,68 @@
+import re
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from messaging_service.api.models import Conversation, Message, Participant
+
+
+class Command(BaseCommand):
+    help = (
+        "Time ?data= lookups (additional_data containment) on a table of generated messages, with the GIN index "
+        "and with it ruled out. Everything runs in a transaction that's rolled back, nothing is left behind."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=2_000_000)
+        parser.add_argument("--campaigns", type=int, default=1000, help="Distinct campaign values across the rows")
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        lookups = [
+            ("provider id", {"xillio_id": f"x{rows // 2}"}),
+            ("campaign", {"campaign": "c7"}),
+            ("id + campaign", {"xillio_id": f"x{rows // 3}", "campaign": f"c{rows // 3 % options['campaigns']}"}),
+            ("no match", {"xillio_id": "missing"}),
+        ]
+        with transaction.atomic():
+            self.generate(rows, options["campaigns"])
+            self.stdout.write(f"{'lookup':>14}  {'planned':>12}  {'no index':>12}  matches  index used")
+            for name, data in lookups:
+                # what get_messages/find_messages run for ?data=, a newest-first page
+                messages = Message.objects.filter(additional_data__contains=data).order_by("-timestamp", "-id")[:20]
+                indexed, used = self.execution_time(messages)
+                self.set_index_scans("off")
+                unindexed, _ = self.execution_time(messages)
+                self.set_index_scans("on")
+                self.stdout.write(
+                    f"{name:>14}  {indexed:10.2f}ms  {unindexed:10.2f}ms  {len(messages):>7}  {'yes' if used else 'no'}"
+                )
+            transaction.set_rollback(True)
+
+    def generate(self, rows, campaigns):
+        started = time.perf_counter()
+        ids = Participant.objects.get_or_create_identifiers(["+12016660000", "+18045550000"])
+        conversation, _ = Conversation.objects.get_or_create_conversation(*ids.values())
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {Message._meta.db_table} (
+                    conversation_id, from_participant_id, to_participant_id, body, body_preview, body_blob, timestamp,
+                    type, messaging_provider_id, additional_data
+                )
+                SELECT %s, %s, %s, 'benchmark', 'benchmark', '', now() - make_interval(secs => i), 'sms', '',
+                    jsonb_build_object('xillio_id', 'x' || i, 'campaign', 'c' || (i %% %s), 'locale', 'en-US')
+                FROM generate_series(1, %s) i
+            """, [conversation.id, *ids.values(), campaigns, rows])
+            cursor.execute(f"ANALYZE {Message._meta.db_table}")
+        self.stdout.write(f"Generated {rows} messages in {time.perf_counter() - started:.1f}s")
+
+    def set_index_scans(self, value):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SET LOCAL enable_bitmapscan = {value}")
+            cursor.execute(f"SET LOCAL enable_indexscan = {value}")
+
+    def execution_time(self, queryset):
+        """Milliseconds the query took, and whether the GIN index was used"""
+        plan = queryset.explain(analyze=True)
+        return float(re.search(r"Execution Time: ([\d.]+) ms", plan).group(1)), "api_msg_additional_data_idx" in plan
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from messaging_service.api.integrations import ProviderCall, ProviderClient, _send_concurrently
+from messaging_service.api.mock_provider import MockProviderServer
+
+PAYLOAD = {"from": "+12016661234", "to": "+18045551234", "type": "sms", "body": "benchmark", "attachments": []}
+
+
+class Command(BaseCommand):
+    help = (
+        "Time a transactional send queued behind a bulk backlog, with every send on one queue against priority "
+        "lanes. Worker threads stand in for Celery workers, each draining send batches from its queue."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", help="Provider url, by default a mock provider is started in process")
+        parser.add_argument("--backlog", type=int, default=5000, help="Bulk messages queued ahead of the transactional one")
+        parser.add_argument("--batch-size", type=int, default=500, help="Messages per send batch, like API_SEND_BATCH_SIZE")
+        parser.add_argument("--concurrency", type=int, default=50, help="Sends in flight per batch, like API_SEND_CONCURRENCY")
+        parser.add_argument("--workers", type=int, default=2, help="Workers in all")
+        parser.add_argument("--transactional-workers", type=int, default=1,
+                            help="Of those, the ones given to the transactional lane")
+        parser.add_argument("--latency", type=float, default=0.05, help="Latency of the in-process mock provider")
+
+    def handle(self, *args, **options):
+        logging.getLogger("httpx").setLevel(logging.WARNING) # one INFO line per request otherwise
+        if not 0 < options["transactional_workers"] < options["workers"]:
+            raise CommandError("--transactional-workers must leave at least one of --workers for the bulk lane")
+        server = None
+        url = options["url"]
+        if not url:
+            server = MockProviderServer(("127.0.0.1", 0), latency=options["latency"]).start_in_background()
+            url = server.url
+
+        provider = ProviderClient("benchmark", url)
+
+        def send_batch(size):
+            calls = [ProviderCall(provider, PAYLOAD, [i]) for i in range(size)]
+            asyncio.run(_send_concurrently(calls, options["concurrency"]))
+
+        def work(lane):
+            while True:
+                batch = lane.get()
+                if batch is None:
+                    return
+                send_batch(batch["size"])
+                batch["sent_at"] = time.perf_counter()
+
+        def run(lanes):
+            """lanes: (queue for bulk batches, queue for the transactional one, workers per queue)"""
+            bulk, transactional, workers = lanes
+            bulk_batches = [
+                {"size": min(options["batch_size"], options["backlog"] - i)}
+                for i in range(0, options["backlog"], options["batch_size"])
+            ]
+            for batch in bulk_batches:
+                bulk.put(batch)
+            threads = [
+                threading.Thread(target=work, args=(lane,)) for lane, count in workers.items() for _ in range(count)
+            ]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+
+            # a 2FA code comes in once the backlog is being drained
+            time.sleep(options["latency"])
+            otp = {"size": 1, "queued_at": time.perf_counter()}
+            transactional.put(otp)
+
+            while any(batch.get("sent_at") is None for batch in bulk_batches + [otp]):
+                time.sleep(0.01)
+            for lane, count in workers.items():
+                for _ in range(count):
+                    lane.put(None)
+            for thread in threads:
+                thread.join()
+            drained = max(batch["sent_at"] for batch in bulk_batches) - started
+            return otp["sent_at"] - otp["queued_at"], drained
+
+        one_queue = queue.Queue()
+        bulk_lane, transactional_lane = queue.Queue(), queue.Queue()
+        runs = [
+            ("one queue", (one_queue, one_queue, {one_queue: options["workers"]})),
+            ("priority lanes", (bulk_lane, transactional_lane, {
+                bulk_lane: options["workers"] - options["transactional_workers"],
+                transactional_lane: options["transactional_workers"],
+            })),
+        ]
+        try:
+            self.stdout.write(
+                f"{options['backlog']} bulk messages in batches of {options['batch_size']}, {options['workers']} workers"
+            )
+            for name, lanes in runs:
+                latency, drained = run(lanes)
+                self.stdout.write(
+                    f"{name:>16}: transactional send took {latency * 1000:8.1f}ms, backlog drained in {drained:.2f}s"
+                )
+        finally:
+            provider.close()
+            if server:
+                server.shutdown()
+                server.server_close()
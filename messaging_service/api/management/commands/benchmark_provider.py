@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from django.core.management.base import BaseCommand
+
+from messaging_service.api.integrations import ProviderCall, ProviderClient, _send_concurrently
+from messaging_service.api.mock_provider import MockProviderServer
+
+PAYLOAD = {"from": "+12016661234", "to": "+18045551234", "type": "sms", "body": "benchmark", "attachments": []}
+
+
+class Command(BaseCommand):
+    help = "Compare provider send throughput with the pooled keep-alive client against a new connection per send"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", help="Provider url, by default a mock provider is started in process")
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--concurrency", type=int, default=4, help="Sending threads, like busy worker threads")
+        parser.add_argument("--async-concurrency", type=int, default=50, help="Sends in flight for the asyncio run")
+        parser.add_argument("--latency", type=float, default=0.0, help="Latency of the in-process mock provider")
+
+    def handle(self, *args, **options):
+        logging.getLogger("httpx").setLevel(logging.WARNING) # one INFO line per request otherwise
+        server = None
+        url = options["url"]
+        if not url:
+            server = MockProviderServer(("127.0.0.1", 0), latency=options["latency"]).start_in_background()
+            url = server.url
+
+        pooled = ProviderClient("benchmark", url)
+
+        def send_pooled(_):
+            return pooled.send(PAYLOAD).status_code
+
+        def send_unpooled(_):
+            with httpx.Client() as client:
+                return client.post(url, json=PAYLOAD).status_code
+
+        def run_threaded(send):
+            with ThreadPoolExecutor(options["concurrency"]) as executor:
+                return list(executor.map(send, range(options["requests"])))
+
+        def run_async():
+            # what send_message_batch does, one worker thread with the whole batch in flight
+            calls = [ProviderCall(pooled, PAYLOAD, [i]) for i in range(options["requests"])]
+            responses = asyncio.run(_send_concurrently(calls, options["async_concurrency"]))
+            return [response.status_code for [response] in responses]
+
+        runs = [
+            ("new connection per send", lambda: run_threaded(send_unpooled)),
+            ("pooled keep-alive", lambda: run_threaded(send_pooled)),
+            ("asyncio fan-out", run_async),
+        ]
+        try:
+            for name, run in runs:
+                connections_before = server.connections if server else None
+                started = time.perf_counter()
+                statuses = run()
+                elapsed = time.perf_counter() - started
+                line = f"{name:>24}: {options['requests'] / elapsed:8.0f} sends/s, {sum(s < 300 for s in statuses)} ok"
+                if server:
+                    line += f", {server.connections - connections_before} connections opened"
+                self.stdout.write(line)
+        finally:
+            pooled.close()
+            if server:
+                server.shutdown()
+                server.server_close()
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from messaging_service.api.caches import conversation_cache
+from messaging_service.api.models import Conversation
+
+
+class Command(BaseCommand):
+    help = "Merge conversations that share a participant pair into the oldest one, moving their messages over"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report how many duplicates there are")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = Conversation.objects.merge_duplicates(dry_run=options["dry_run"])
+        # the merged away conversations were deleted with raw SQL, no post_delete to evict them
+        conversation_cache.clear()
+        if options["dry_run"]:
+            self.stdout.write(f"{count} duplicate conversations would be merged")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Merged {count} duplicate conversations"))
@@ -0,0 +1,51 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from messaging_service.api.models import Message, add_months
+
+
+def month(value):
+    return datetime.datetime.strptime(value, "%Y-%m").date()
+
+
+class Command(BaseCommand):
+    help = (
+        "List the message table's monthly partitions, create them ahead of time, or drop old months whole for "
+        "retention. The maintain_message_partitions task does the creating (and dropping, with "
+        "API_MESSAGE_RETENTION_MONTHS set) on its own, this is for doing it by hand."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--create-ahead", type=int, help="Create partitions from this month to this many months ahead")
+        parser.add_argument("--drop-before", type=month, help="Drop the partitions of months before this one (YYYY-MM)")
+        parser.add_argument("--dry-run", action="store_true", help="Only list the partitions --drop-before would drop")
+
+    def handle(self, *args, **options):
+        if options["create_ahead"] is not None:
+            this_month = timezone.now().date().replace(day=1)
+            created = Message.objects.create_partitions(
+                add_months(this_month, n) for n in range(options["create_ahead"] + 1)
+            )
+            self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partitions"))
+
+        if options["drop_before"] is not None:
+            if options["dry_run"]:
+                for partition_month, name in Message.objects.partitions().items():
+                    if partition_month < options["drop_before"]:
+                        self.stdout.write(f"{name} would be dropped")
+                return
+            dropped = Message.objects.drop_partitions(options["drop_before"])
+            self.stdout.write(self.style.SUCCESS(f"Dropped {len(dropped)} partitions: {', '.join(dropped) or '-'}"))
+
+        partitions = list(Message.objects.partitions().values()) + [f"{Message._meta.db_table}_default"]
+        with connection.cursor() as cursor:
+            # the planner's estimates, counting a big month would take as long as the query partitioning avoids
+            cursor.execute(
+                "SELECT relname, GREATEST(reltuples, 0)::bigint FROM pg_class WHERE relname = ANY(%s)", [partitions],
+            )
+            rows = dict(cursor.fetchall())
+        for name in partitions:
+            self.stdout.write(f"{name:<24} ~{rows.get(name, 0)} rows")
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from messaging_service.api.mock_provider import MockProviderServer
+
+
+class Command(BaseCommand):
+    help = "Run a local mock SMS/email provider, point API_SMS_PROVIDER_URL/API_EMAIL_PROVIDER_URL at it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8090)
+        parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every response")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+        parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+        parser.add_argument("--recipient-error-rate", type=float, default=0.0, help="Fraction of batch recipients rejected")
+        parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+
+    def handle(self, *args, **options):
+        server = MockProviderServer(
+            (options["host"], options["port"]),
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            throttle_rate=options["throttle_rate"],
+            retry_after=options["retry_after"],
+            recipient_error_rate=options["recipient_error_rate"],
+        )
+        self.stdout.write(f"Mock provider listening on {server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
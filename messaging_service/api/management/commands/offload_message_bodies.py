@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from messaging_service.api.models import BodyStorage, Message
+
+BODY_FIELDS = ['body_storage', 'inline_body', 'body_compressed', 'body_blob', 'body_preview']
+
+
+class Command(BaseCommand):
+    help = (
+        "Compress, or move to the body store, message bodies saved inline before they would have been. "
+        "Safe to stop and rerun, it picks up where the inline bodies over the threshold are."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        moved = last_id = 0
+        while True:
+            with transaction.atomic():
+                messages = list(
+                    Message.objects.annotate(body_bytes=models.Func('inline_body', function='octet_length'))
+                    .filter(id__gt=last_id, body_storage=BodyStorage.INLINE, body_bytes__gt=settings.API_BODY_INLINE_MAX_BYTES)
+                    .order_by('id')[:options["batch_size"]]
+                )
+                if not messages:
+                    break
+                for message in messages:
+                    message.body = message.inline_body
+                Message.objects.bulk_update(messages, BODY_FIELDS)
+            moved += len(messages)
+            last_id = messages[-1].id
+        self.stdout.write(self.style.SUCCESS(f"Moved {moved} message bodies out of line"))
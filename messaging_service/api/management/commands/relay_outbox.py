@@ -0,0 +1,27 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from messaging_service.api.tasks import relay_outbox
+
+
+class Command(BaseCommand):
+    help = "Continuously publish outbound sends from the outbox. Any number of relays can run side by side."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=settings.API_OUTBOX_RELAY_BATCH_SIZE)
+        parser.add_argument("--interval", type=float, default=settings.API_OUTBOX_RELAY_INTERVAL,
+                            help="Seconds to sleep when the outbox is empty")
+        parser.add_argument("--once", action="store_true", help="Relay one batch and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            relayed, lag = relay_outbox(options["batch_size"])
+            if relayed or options["once"]:
+                self.stdout.write(f"Relayed {relayed} sends, {lag:.1f}s behind")
+            if options["once"]:
+                return
+            # a full batch means there's likely more waiting
+            if relayed < options["batch_size"]:
+                time.sleep(options["interval"])
@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from messaging_service.api.models import DeadLetter
+
+
+def aware_datetime(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(value)
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+class Command(BaseCommand):
+    help = (
+        "Requeue sends that were given up on, e.g. after a provider outage. They go back to pump_retries, "
+        "which sends them at each provider's retry budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--provider", choices=list(settings.API_PROVIDERS))
+        parser.add_argument("--reason", help='Exact failure reason, e.g. "Failed after 3 attempts"')
+        parser.add_argument("--status-code", type=int, help="The provider's last HTTP status code")
+        parser.add_argument("--since", type=aware_datetime, help="Failed at or after this ISO 8601 datetime")
+        parser.add_argument("--until", type=aware_datetime, help="Failed before this ISO 8601 datetime")
+        parser.add_argument("--limit", type=int, help="Requeue at most this many")
+        parser.add_argument("--chunk-size", type=int, default=settings.API_DEAD_LETTER_REQUEUE_CHUNK_SIZE)
+        parser.add_argument("--pause", type=float, default=0, help="Seconds to sleep between chunks")
+        parser.add_argument("--dry-run", action="store_true", help="Only list what matches, by reason")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1")
+        dead_letters = DeadLetter.objects.matching(
+            provider=options["provider"],
+            reason=options["reason"],
+            http_status_code=options["status_code"],
+            since=options["since"],
+            until=options["until"],
+        )
+        if options["dry_run"]:
+            total = 0
+            for row in dead_letters.summary():
+                total += row["count"]
+                self.stdout.write(f"{row['count']:>8}  {row['type']:<6} {row['http_status_code'] or '-':<4} {row['reason']}")
+            if options["limit"] is not None:
+                total = min(total, options["limit"])
+            self.stdout.write(f"{total} dead letters would be requeued")
+            return
+
+        requeued = dead_letters.requeue(options["chunk_size"], limit=options["limit"], pause=options["pause"])
+        self.stdout.write(self.style.SUCCESS(f"Requeued {requeued} dead letters"))
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:08
+
+from django.db import migrations, models
+
+
+def delete_duplicate_inbound_messages(apps, schema_editor):
+    """Webhook retries used to be saved as new rows, keep the first copy of each before adding the constraint"""
+    Message = apps.get_model('api', 'Message')
+    Attachment = apps.get_model('api', 'Attachment')
+    duplicates = Message.objects.filter(
+        outbound_status__isnull=True,
+        messaging_provider_id__gt='',
+        id__gt=models.Subquery(
+            Message.objects.filter(
+                outbound_status__isnull=True,
+                type=models.OuterRef('type'),
+                messaging_provider_id=models.OuterRef('messaging_provider_id'),
+            ).order_by('id').values('id')[:1]
+        ),
+    ).values('id')
+    Attachment.objects.filter(message_id__in=duplicates).delete()
+    Message.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_alter_conversation_options_alter_message_options_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_inbound_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_delete_duplicate_inbound_messages'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('outbound_status__isnull', True), models.Q(('messaging_provider_id', ''), _negated=True)), fields=('type', 'messaging_provider_id'), name='api_message_inbound_provider_id_uniq'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_message_inbound_provider_id_uniq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_preview',
+            field=models.CharField(blank=True, db_default='', default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.IntegerField(db_default=0, default=0),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE api_conversation c SET
+                message_count = s.message_count,
+                last_message_at = s.timestamp,
+                last_message_preview = LEFT(s.body, 255)
+            FROM (
+                SELECT DISTINCT ON (conversation_id)
+                    conversation_id, timestamp, body, count(*) OVER (PARTITION BY conversation_id) AS message_count
+                FROM api_message
+                ORDER BY conversation_id, timestamp DESC, id DESC
+            ) s
+            WHERE c.id = s.conversation_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['-last_message_at', '-id'], name='api_conv_last_message_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:12
+
+from django.db import migrations
+
+# 0003 dropped the unique (participant1, participant2) constraint, so concurrent get_or_create calls could
+# create the same conversation twice. Fold each duplicate into the oldest conversation for its pair before
+# 0008 restores the constraint. Kept separate from 0008 because Postgres won't build the index in the same
+# transaction as these updates (deferred FK trigger events).
+MERGE_DUPLICATE_CONVERSATIONS = [
+    """
+    UPDATE api_message m SET conversation_id = d.keep_id
+    FROM (
+        SELECT id, min(id) OVER (PARTITION BY participant1_id, participant2_id) AS keep_id FROM api_conversation
+    ) d
+    WHERE m.conversation_id = d.id AND d.id <> d.keep_id
+    """,
+    """
+    UPDATE api_conversation c SET
+        message_count = s.message_count,
+        last_message_at = s.timestamp,
+        last_message_preview = LEFT(s.body, 255)
+    FROM (
+        SELECT DISTINCT ON (conversation_id)
+            conversation_id, timestamp, body, count(*) OVER (PARTITION BY conversation_id) AS message_count
+        FROM api_message
+        ORDER BY conversation_id, timestamp DESC, id DESC
+    ) s
+    WHERE c.id = s.conversation_id AND EXISTS (
+        SELECT 1 FROM api_conversation d
+        WHERE d.participant1_id = c.participant1_id AND d.participant2_id = c.participant2_id AND d.id > c.id
+    )
+    """,
+    """
+    DELETE FROM api_conversation c USING api_conversation k
+    WHERE c.participant1_id = k.participant1_id AND c.participant2_id = k.participant2_id AND c.id > k.id
+    """,
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_conversation_last_message'),
+    ]
+
+    operations = [
+        migrations.RunSQL(MERGE_DUPLICATE_CONVERSATIONS, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_merge_duplicate_conversations'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='participant1',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='conversations_as_p1', to='api.participant'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='api.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', '-timestamp', '-id'], name='api_msg_conv_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagestatus',
+            index=models.Index(condition=models.Q(('error_message', ''), ('send_success', False)), fields=['id'], name='api_msgstatus_pending_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('participant1', 'participant2'), name='api_conversation_participants_uniq'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_messagestatus_next_attempt_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagestatus',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('retrying', 'Retrying'), ('sent', 'Sent'), ('failed', 'Failed')], db_default='pending', default='pending', max_length=16),
+        ),
+        # statuses that have used up their 3 attempts were previously only marked failed by one more task run
+        migrations.RunSQL(
+            """
+            UPDATE api_messagestatus SET
+                state = CASE
+                    WHEN send_success THEN 'sent'
+                    WHEN error_message <> '' THEN 'failed'
+                    WHEN send_attempts >= 3 THEN 'failed'
+                    WHEN next_attempt_at IS NOT NULL THEN 'retrying'
+                    ELSE 'pending'
+                END,
+                error_message = CASE
+                    WHEN NOT send_success AND error_message = '' AND send_attempts >= 3 THEN 'Failed after 3 attempts'
+                    ELSE error_message
+                END,
+                next_attempt_at = CASE
+                    WHEN NOT send_success AND error_message = '' AND send_attempts < 3 THEN next_attempt_at
+                END
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
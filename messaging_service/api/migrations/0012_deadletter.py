@@ -0,0 +1,38 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_outboxentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeadLetter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(max_length=255)),
+                ('reason', models.TextField()),
+                ('http_status_code', models.IntegerField(blank=True, null=True)),
+                ('failed_at', models.DateTimeField()),
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='dead_letter', to='api.message')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['type', 'http_status_code', 'reason', 'failed_at'], name='api_deadletter_filter_idx'), models.Index(fields=['failed_at'], name='api_deadletter_failed_at_idx')],
+            },
+        ),
+        # sends given up on before there were dead letters, when they failed isn't known so it's taken as now
+        migrations.RunSQL(
+            """
+            INSERT INTO api_deadletter (message_id, type, reason, http_status_code, failed_at)
+            SELECT m.id, m.type, s.error_message, s.last_http_status_code, now()
+            FROM api_message m JOIN api_messagestatus s ON s.id = m.outbound_status_id
+            WHERE s.state = 'failed'
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_deadletter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagestatus',
+            name='priority',
+            field=models.CharField(choices=[('transactional', 'Transactional'), ('bulk', 'Bulk')], db_default='transactional', default='transactional', max_length=16),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.1.11 on 2026-10-18 06:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_messagestatus_priority'),
+    ]
+
+    operations = [
+        # Message.body is a property now, the column stays where it is as inline_body
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='message',
+                    old_name='body',
+                    new_name='inline_body',
+                ),
+                migrations.AlterField(
+                    model_name='message',
+                    name='inline_body',
+                    field=models.TextField(blank=True, db_column='body'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='body_storage',
+            field=models.CharField(choices=[('inline', 'Inline'), ('zlib', 'Zlib'), ('blob', 'Blob')], db_default='inline', default='inline', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='body_compressed',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='body_blob',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='body_preview',
+            field=models.CharField(blank=True, db_default='', default='', max_length=255),
+        ),
+        # close enough to preview_text for existing rows, tags dropped but entities left as they are.
+        # The bodies themselves are compressed or moved out by the offload_message_bodies command.
+        migrations.RunSQL(
+            r"""
+            UPDATE api_message SET body_preview = LEFT(btrim(regexp_replace(
+                CASE WHEN type = 'email' THEN regexp_replace(body, '<[^>]*>', '', 'g') ELSE body END,
+                '\s+', ' ', 'g'
+            )), 255)
+            """,
+            migrations.RunSQL.noop,
+        ),
+        # the inbox previews were cut from the raw bodies, take them from the latest message's preview instead
+        migrations.RunSQL(
+            """
+            UPDATE api_conversation c SET last_message_preview = s.body_preview
+            FROM (
+                SELECT DISTINCT ON (conversation_id) conversation_id, body_preview
+                FROM api_message
+                ORDER BY conversation_id, timestamp DESC, id DESC
+            ) s
+            WHERE c.id = s.conversation_id AND c.last_message_preview <> s.body_preview
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.11 on 2026-10-18 06:45
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # built concurrently, a GIN index over every message takes a while and mustn't block inserts meanwhile
+    atomic = False
+
+    dependencies = [
+        ('api', '0014_message_body_storage'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='message',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['additional_data'], name='api_msg_additional_data_idx', opclasses=['jsonb_path_ops']),
+        ),
+    ]
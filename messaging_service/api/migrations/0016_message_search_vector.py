@@ -0,0 +1,67 @@
+# Generated by Django 5.1.11 on 2026-10-18 05:57
+
+import html
+import zlib
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.core.files.storage import storages
+from django.db import migrations, models
+from django.utils.html import strip_tags
+
+
+def index_stored_bodies(apps, schema_editor):
+    # bodies compressed or moved out of their row by offload_message_bodies, which SQL can't read. Read and made plain
+    # text here as the body store and plain_text did at the time.
+    storage = storages.create_storage(settings.API_BODY_STORAGE)
+    Message = apps.get_model('api', 'Message')
+    for message in Message.objects.exclude(body_storage='inline').only('id', 'type', 'body_storage', 'body_compressed', 'body_blob').iterator():
+        if message.body_storage == 'zlib':
+            compressed = message.body_compressed
+        else:
+            key = message.body_blob
+            with storage.open(f'{key[:2]}/{key[2:4]}/{key}', 'rb') as f:
+                compressed = f.read()
+        body = zlib.decompress(compressed).decode()
+        if message.type == 'email':
+            body = html.unescape(strip_tags(body))
+        Message.objects.filter(id=message.id).update(
+            search_vector=django.contrib.postgres.search.SearchVector(models.Value(' '.join(body.split())), config=settings.API_SEARCH_CONFIG),
+        )
+
+
+class Migration(migrations.Migration):
+    # the index is built concurrently, and the backfill before it isn't held in one long transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0015_message_additional_data_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, null=True),
+        ),
+        # like plain_text, tags dropped from emails but entities left as they are
+        migrations.RunSQL(
+            [(
+                r"""
+                UPDATE api_message SET search_vector = to_tsvector(%s::regconfig,
+                    CASE WHEN type = 'email' THEN regexp_replace(body, '<[^>]*>', ' ', 'g') ELSE body END
+                )
+                WHERE body_storage = 'inline'
+                """,
+                [settings.API_SEARCH_CONFIG],
+            )],
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunPython(index_stored_bodies, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='message',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='api_msg_search_vector_idx'),
+        ),
+    ]
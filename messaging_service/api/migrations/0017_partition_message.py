@@ -0,0 +1,123 @@
+# Generated by Django 5.1.11 on 2026-10-18 09:10
+
+import datetime
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def partition_messages(apps, schema_editor):
+    """Swaps api_message for a copy partitioned by month on timestamp. The rows are copied, so on a big table run
+    this in a quiet period: writes to messages wait for it."""
+    Message = apps.get_model('api', 'Message')
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE api_message RENAME TO api_message_unpartitioned")
+        cursor.execute("""
+            CREATE TABLE api_message (
+                LIKE api_message_unpartitioned INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING STORAGE INCLUDING COMPRESSION
+            ) PARTITION BY RANGE (timestamp)
+        """)
+
+        # a partition for each month with messages and the months coming up, see MessageManager
+        cursor.execute("SELECT DISTINCT date_trunc('month', timestamp) FROM api_message_unpartitioned")
+        months = {month.date() for month, in cursor.fetchall()}
+        this_month = timezone.now().date().replace(day=1)
+        months |= {add_months(this_month, n) for n in range(settings.API_MESSAGE_PARTITION_MONTHS_AHEAD + 1)}
+        cursor.execute("CREATE TABLE api_message_default PARTITION OF api_message DEFAULT")
+        for month in sorted(months):
+            cursor.execute(f"""
+                CREATE TABLE api_message_p{month:%Y_%m} PARTITION OF api_message
+                FOR VALUES FROM ('{month:%Y-%m-%d} 00:00+00') TO ('{add_months(month, 1):%Y-%m-%d} 00:00+00')
+            """)
+
+        cursor.execute("INSERT INTO api_message SELECT * FROM api_message_unpartitioned")
+        cursor.execute("DROP TABLE api_message_unpartitioned")
+        cursor.execute("""
+            SELECT setval(pg_get_serial_sequence('api_message', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM api_message
+        """)
+        cursor.execute("SELECT pg_get_serial_sequence('api_message', 'id')")
+        cursor.execute(f"ALTER SEQUENCE {cursor.fetchone()[0]} RENAME TO api_message_id_seq")
+
+        # the old table's keys and indexes, built on each partition now the rows are in
+        cursor.execute("ALTER TABLE api_message ADD CONSTRAINT api_message_pkey PRIMARY KEY (id, timestamp)")
+        cursor.execute("""
+            ALTER TABLE api_message ADD CONSTRAINT api_message_outbound_status_id_timestamp_uniq
+                UNIQUE (outbound_status_id, timestamp)
+        """)
+        for column, references, name in [
+            ('outbound_status_id', 'api_messagestatus', 'api_message_outbound_status_id_ed6e5664_fk_api_messagestatus_id'),
+            ('conversation_id', 'api_conversation', 'api_message_conversation_id_e0f0e1a5_fk_api_conversation_id'),
+            ('from_participant_id', 'api_participant', 'api_message_from_participant_id_63721e51_fk_api_participant_id'),
+            ('to_participant_id', 'api_participant', 'api_message_to_participant_id_1df3d523_fk_api_participant_id'),
+        ]:
+            cursor.execute(f"""
+                ALTER TABLE api_message ADD CONSTRAINT {name}
+                    FOREIGN KEY ({column}) REFERENCES {references} (id) DEFERRABLE INITIALLY DEFERRED
+            """)
+        cursor.execute("CREATE INDEX api_message_from_participant_id_63721e51 ON api_message (from_participant_id)")
+        cursor.execute("CREATE INDEX api_message_to_participant_id_1df3d523 ON api_message (to_participant_id)")
+    for index in Message._meta.indexes:
+        schema_editor.add_index(Message, index)
+
+
+def name_partition_indexes(apps, schema_editor):
+    """The indexes built on partitions for the ones above renamed {index}_{partition suffix}, as
+    MessageManager.name_partition_indexes does for partitions created later"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT partition.relname, child.relname, parent.relname
+            FROM pg_inherits p
+            JOIN pg_class partition ON partition.oid = p.inhrelid
+            JOIN pg_index i ON i.indrelid = p.inhrelid
+            JOIN pg_class child ON child.oid = i.indexrelid
+            JOIN pg_inherits ip ON ip.inhrelid = i.indexrelid
+            JOIN pg_class parent ON parent.oid = ip.inhparent
+            WHERE p.inhparent = 'api_message'::regclass
+        """)
+        for partition, index, parent in cursor.fetchall():
+            name = f"{parent}_{partition.removeprefix('api_message_')}"
+            if index != name:
+                cursor.execute(f"ALTER INDEX {index} RENAME TO {name}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_message_search_vector'),
+    ]
+
+    operations = [
+        # a partitioned table can only be referenced through a key that includes the partition key
+        migrations.AlterField(
+            model_name='attachment',
+            name='message',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='api.message'),
+        ),
+        migrations.AlterField(
+            model_name='outboxentry',
+            name='message',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='outbox_entry', to='api.message'),
+        ),
+        migrations.AlterField(
+            model_name='deadletter',
+            name='message',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='dead_letter', to='api.message'),
+        ),
+        migrations.RemoveConstraint(
+            model_name='message',
+            name='api_message_inbound_provider_id_uniq',
+        ),
+        migrations.RunPython(partition_messages),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(condition=models.Q(('outbound_status__isnull', True), models.Q(('messaging_provider_id', ''), _negated=True)), fields=('type', 'messaging_provider_id', 'timestamp'), name='api_message_inbound_provider_id_uniq'),
+        ),
+        migrations.RunPython(name_partition_indexes),
+    ]
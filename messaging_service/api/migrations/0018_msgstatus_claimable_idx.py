@@ -0,0 +1,24 @@
+# Generated by Django 5.1.11 on 2026-10-18 10:16
+
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the new index is built before the old one goes, both without blocking sends meanwhile
+    atomic = False
+
+    dependencies = [
+        ('api', '0017_partition_message'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='messagestatus',
+            index=models.Index(condition=models.Q(('state__in', ['pending', 'retrying', 'sending'])), fields=['id'], name='api_msgstatus_claimable_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='messagestatus',
+            name='api_msgstatus_pending_idx',
+        ),
+    ]
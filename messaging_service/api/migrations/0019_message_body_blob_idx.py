@@ -0,0 +1,44 @@
+# Generated by Django 5.1.11 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+def add_body_blob_index(apps, schema_editor):
+    """Builds the index on each partition without blocking writes to it, then attaches it to the table's, which is
+    only valid once every partition has one. Partitions created later get theirs when they're attached."""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'api_message'::regclass")
+        partitions = sorted(name for name, in cursor.fetchall())
+        cursor.execute("CREATE INDEX api_msg_body_blob_idx ON ONLY api_message (body_blob) WHERE body_storage = 'blob'")
+        for partition in partitions:
+            name = f"api_msg_body_blob_idx_{partition.removeprefix('api_message_')}"
+            cursor.execute(f"CREATE INDEX CONCURRENTLY {name} ON {partition} (body_blob) WHERE body_storage = 'blob'")
+            cursor.execute(f"ALTER INDEX api_msg_body_blob_idx ATTACH PARTITION {name}")
+
+
+def remove_body_blob_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP INDEX api_msg_body_blob_idx")
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0018_msgstatus_claimable_idx'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(add_body_blob_index, remove_body_blob_index),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='message',
+                    index=models.Index(condition=models.Q(('body_storage', 'blob')), fields=['body_blob'], name='api_msg_body_blob_idx'),
+                ),
+            ],
+        ),
+    ]
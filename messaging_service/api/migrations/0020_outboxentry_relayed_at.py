@@ -0,0 +1,18 @@
+# Generated by Django 5.1.11 on 2026-10-18 14:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_message_body_blob_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxentry',
+            name='relayed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.11 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0020_outboxentry_relayed_at'),
+    ]
+
+    operations = [
+        # entries relayed before this are simply due again, the send's claim makes publishing them twice harmless
+        migrations.RemoveField(
+            model_name='outboxentry',
+            name='relayed_at',
+        ),
+        migrations.AddField(
+            model_name='outboxentry',
+            name='relays',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='outboxentry',
+            name='next_relay_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
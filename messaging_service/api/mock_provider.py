@@ -0,0 +1,82 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in SMS/email provider for benchmarking the outbound path offline. It speaks HTTP/1.1 keep-alive like
+# a real provider, can add latency, and can fail or throttle a fraction of requests. A POST of {"messages": [...]}
+# is a batch send and gets a result per message, a fraction of which can be rejected.
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, don't let Nagle hold the body back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        headers = {}
+        roll = random.random()
+        if roll < self.server.throttle_rate:
+            status, response = 429, {'error': 'Too many requests'}
+            headers['Retry-After'] = str(self.server.retry_after)
+        elif roll < self.server.throttle_rate + self.server.error_rate:
+            status, response = 503, {'error': 'Service unavailable'}
+        elif isinstance(body.get('messages'), list):
+            # a batch send, a result per message
+            status, response = 202, {'results': [
+                {'status': 400, 'error': 'Invalid recipient'} if random.random() < self.server.recipient_error_rate
+                else {'status': 202, 'id': str(uuid.uuid4())}
+                for _ in body['messages']
+            ]}
+        else:
+            status, response = 202, {'id': str(uuid.uuid4())}
+
+        encoded = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockProviderServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # the default of 5 drops connections under a concurrent sender
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1, recipient_error_rate=0.0):
+        super().__init__(address, MockProviderHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.recipient_error_rate = recipient_error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/messages'
+
+    def start_in_background(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
@@ -1,10 +1,59 @@
-from django.db import models
+import datetime
+import html
+import re
+import time
+import zlib
+
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models.functions import Least, Now, Power
+from django.utils import timezone
+from django.utils.html import strip_tags
 from django.core.exceptions import ValidationError
 
+from .bodystore import body_store
+
 # Create your models here.
 
+PREVIEW_LENGTH = 255
+
+class ParticipantManager(models.Manager):
+    def get_or_create_identifiers(self, identifiers):
+        """Bulk get_or_create by identifier. Returns a dict of identifier -> participant id.
+
+        A single INSERT ... ON CONFLICT DO NOTHING that also selects the rows which already existed.
+        """
+        identifiers = list(set(identifiers))
+        if not identifiers:
+            return {}
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH input AS (SELECT unnest(%s::varchar[]) AS identifier),
+                inserted AS (
+                    INSERT INTO {table} (identifier) SELECT identifier FROM input
+                    ON CONFLICT (identifier) DO NOTHING
+                    RETURNING identifier, id
+                )
+                SELECT identifier, id FROM inserted
+                UNION ALL
+                SELECT p.identifier, p.id FROM {table} p JOIN input USING (identifier)
+            """, [identifiers])
+            participant_ids = dict(cursor.fetchall())
+        if len(participant_ids) < len(identifiers):
+            # a concurrent transaction committed the row after our statement's snapshot was taken
+            participant_ids.update(self.filter(
+                identifier__in=set(identifiers) - participant_ids.keys()
+            ).values_list('identifier', 'id'))
+        return participant_ids
+
+
 class Participant(models.Model):
     identifier = models.CharField(max_length=255, unique=True) # email or phone number
+
+    objects = ParticipantManager()
     
     def __str__(self):
         return f"{self.identifier}"
@@ -40,12 +89,15 @@ class ConversationQuerySet(models.QuerySet):
     
     def by_identifier(self, identifier1, identifier2):
         """Find conversation by participant identifiers (email/phone)"""
-        try:
-            p1 = Participant.objects.get(identifier=identifier1)
-            p2 = Participant.objects.get(identifier=identifier2)
-            return self.get_conversation(p1, p2)
-        except Participant.DoesNotExist:
+        from .caches import conversation_cache, participant_cache
+
+        participant_ids = participant_cache.lookup([identifier1, identifier2])
+        if identifier1 not in participant_ids or identifier2 not in participant_ids:
             raise Conversation.DoesNotExist("One or both participants not found")
+        conversation_id = conversation_cache.lookup(participant_ids[identifier1], participant_ids[identifier2])
+        if conversation_id is None:
+            raise Conversation.DoesNotExist("Conversation matching query does not exist.")
+        return self.get(id=conversation_id)
 
 class ConversationManager(models.Manager):
     def get_queryset(self):
@@ -77,13 +129,150 @@ class ConversationManager(models.Manager):
             raise ValidationError("A conversation cannot be between the same participant.")
         
         p1, p2 = self.get_queryset()._normalize_participants(participant1, participant2)
-        return self.get_or_create(participant1=p1, participant2=p2, **kwargs)
+        if kwargs:
+            return self.get_or_create(participant1=p1, participant2=p2, **kwargs)
+        (conversation, created), = self.upsert_pairs([(getattr(p1, 'id', p1), getattr(p2, 'id', p2))])
+        return conversation, created
+    
+    def get_or_create_for_pairs(self, pairs):
+        """Bulk get_or_create_conversation for (participant_id, participant_id) pairs.
+
+        Returns a dict of normalized (lower id, higher id) pair -> conversation id, so callers should look up
+        with the same normalization.
+        """
+        normalized = {(min(p1, p2), max(p1, p2)) for p1, p2 in pairs}
+        if any(p1 == p2 for p1, p2 in normalized):
+            raise ValidationError("A conversation cannot be between the same participant.")
+        return {
+            (conversation.participant1_id, conversation.participant2_id): conversation.id
+            for conversation, _ in self.upsert_pairs(normalized)
+        }
+    
+    def upsert_pairs(self, pairs):
+        """Race-free get_or_create for already normalized (participant1_id, participant2_id) pairs.
+
+        A single INSERT ... ON CONFLICT DO NOTHING RETURNING against the unique (participant1, participant2)
+        constraint, together with the rows that already existed, so any number of workers can ingest messages
+        between the same two participants without locks or retries. Returns a list of (conversation, created).
+        """
+        pairs = list(pairs)
+        if not pairs:
+            return []
+
+        table = self.model._meta.db_table
+        fields = self.model._meta.concrete_fields
+        columns = ', '.join(field.column for field in fields)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH input AS (
+                    SELECT * FROM unnest(%s::bigint[], %s::bigint[]) AS t(participant1_id, participant2_id)
+                ),
+                inserted AS (
+                    INSERT INTO {table} (participant1_id, participant2_id, created_at)
+                    SELECT participant1_id, participant2_id, now() FROM input
+                    ON CONFLICT (participant1_id, participant2_id) DO NOTHING
+                    RETURNING {columns}
+                )
+                SELECT {columns}, true FROM inserted
+                UNION ALL
+                SELECT {', '.join(f'c.{field.column}' for field in fields)}, false
+                FROM {table} c JOIN input USING (participant1_id, participant2_id)
+            """, [[p1 for p1, _ in pairs], [p2 for _, p2 in pairs]])
+            rows = cursor.fetchall()
+
+        attnames = [field.attname for field in fields]
+        results = [(self.model.from_db(self.db, attnames, row[:-1]), row[-1]) for row in rows]
+        found = {(conversation.participant1_id, conversation.participant2_id) for conversation, _ in results}
+        for p1, p2 in set(pairs) - found:
+            # a concurrent transaction committed the row after our statement's snapshot was taken
+            results.append((self.get(participant1_id=p1, participant2_id=p2), False))
+        return results
+    
+    def merge_duplicates(self, dry_run=False):
+        """Fold conversations that share a participant pair into the oldest one. Returns how many were merged away.
+
+        The unique constraint keeps new duplicates out, this cleans up ones created while it was missing
+        (see migration 0007, which does the same on migrate).
+        """
+        table = self.model._meta.db_table
+        message_table = Message._meta.db_table
+        duplicates = f"""
+            SELECT id, min(id) OVER (PARTITION BY participant1_id, participant2_id) AS keep_id FROM {table}
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM ({duplicates}) d WHERE d.id <> d.keep_id")
+            count, = cursor.fetchone()
+            if dry_run or not count:
+                return count
+
+            cursor.execute(f"""
+                UPDATE {message_table} m SET conversation_id = d.keep_id
+                FROM ({duplicates}) d
+                WHERE m.conversation_id = d.id AND d.id <> d.keep_id
+            """)
+            cursor.execute(f"""
+                UPDATE {table} c SET
+                    message_count = s.message_count,
+                    last_message_at = s.timestamp,
+                    last_message_preview = s.body_preview
+                FROM (
+                    SELECT DISTINCT ON (conversation_id)
+                        conversation_id, timestamp, body_preview, count(*) OVER (PARTITION BY conversation_id) AS message_count
+                    FROM {message_table}
+                    WHERE conversation_id IN (SELECT keep_id FROM ({duplicates}) d WHERE d.id <> d.keep_id)
+                    ORDER BY conversation_id, timestamp DESC, id DESC
+                ) s
+                WHERE c.id = s.conversation_id
+            """)
+            cursor.execute(f"""
+                DELETE FROM {table} c USING {table} k
+                WHERE c.participant1_id = k.participant1_id AND c.participant2_id = k.participant2_id AND c.id > k.id
+            """)
+        return count
+    
+    def record_messages(self, messages):
+        """Fold newly saved messages into their conversations' last_message_at/last_message_preview/message_count.
+
+        One UPDATE for any number of messages. Counts are incremented in the database so concurrent writers don't
+        lose updates, and the preview only moves forward in time.
+        """
+        timestamp_field = Message._meta.get_field('timestamp')
+        latest = {}
+        counts = {}
+        for message in messages:
+            timestamp = timestamp_field.to_python(message.timestamp)
+            counts[message.conversation_id] = counts.get(message.conversation_id, 0) + 1
+            if message.conversation_id not in latest or timestamp >= latest[message.conversation_id][0]:
+                latest[message.conversation_id] = (timestamp, message.body_preview)
+        if not counts:
+            return
+
+        # sorted so concurrent batches lock shared conversations in the same order
+        conversation_ids = sorted(counts)
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {table} c SET
+                    message_count = c.message_count + v.count,
+                    last_message_preview = CASE
+                        WHEN c.last_message_at IS NULL OR v.last_message_at >= c.last_message_at THEN v.preview
+                        ELSE c.last_message_preview
+                    END,
+                    last_message_at = GREATEST(c.last_message_at, v.last_message_at)
+                FROM unnest(%s::bigint[], %s::integer[], %s::timestamptz[], %s::varchar[])
+                    AS v(id, count, last_message_at, preview)
+                WHERE c.id = v.id
+            """, [
+                conversation_ids,
+                [counts[id] for id in conversation_ids],
+                [latest[id][0] for id in conversation_ids],
+                [latest[id][1] for id in conversation_ids],
+            ])
     
     def get_or_create_by_identifier(self, identifier1, identifier2, **kwargs):
         """Get or create conversation by participant identifiers"""
-        p1, _ = Participant.objects.get_or_create(identifier=identifier1)
-        p2, _ = Participant.objects.get_or_create(identifier=identifier2)
-        return self.get_or_create_conversation(p1, p2, **kwargs)
+        participant_ids = Participant.objects.get_or_create_identifiers([identifier1, identifier2])
+        return self.get_or_create_conversation(participant_ids[identifier1], participant_ids[identifier2], **kwargs)
 
 # ========================= End of boring django code
 
@@ -91,7 +280,8 @@ class Conversation(models.Model):
     participant1 = models.ForeignKey(
         Participant, 
         on_delete=models.CASCADE, 
-        related_name='conversations_as_p1'
+        related_name='conversations_as_p1',
+        db_index=False, # leading column of the unique (participant1, participant2) index
     )
     participant2 = models.ForeignKey(
         Participant, 
@@ -99,12 +289,14 @@ class Conversation(models.Model):
         related_name='conversations_as_p2'
     )
     created_at = models.DateTimeField(auto_now_add=True)
+    # denormalized so the inbox renders from this table alone, kept up to date by ConversationManager.record_messages
+    # db defaults because get_or_create_for_pairs inserts with raw SQL
+    last_message_at = models.DateTimeField(blank=True, null=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='', db_default='')
+    message_count = models.IntegerField(default=0, db_default=0)
     
     objects = ConversationManager()
     
-    class Meta:
-        unique_together = ['participant1', 'participant2']
-    
     def clean(self):
         if self.participant1 == self.participant2:
             raise ValidationError("A conversation cannot be between the same participant.")
@@ -130,47 +322,597 @@ class Conversation(models.Model):
 
     class Meta: 
         ordering = ['-created_at']
+        constraints = [
+            # get_conversation/filter_by_participants; participant2's own FK index serves for_participant
+            models.UniqueConstraint(fields=['participant1', 'participant2'], name='api_conversation_participants_uniq'),
+        ]
+        indexes = [
+            # the inbox, sorted by recent activity (get_conversations?sort=recent)
+            models.Index(fields=['-last_message_at', '-id'], name='api_conv_last_message_idx'),
+        ]
     
+class MessageStatusManager(models.Manager):
+    """State transitions for outbound sends. Each is a single conditional UPDATE ... RETURNING, so a status only
+    moves on from the state it's expected to be in: of two workers handling the same message (say a redelivered
+    task) only one claims it, and an attempt is only counted, or its outcome recorded, once."""
+
+    def _update_returning(self, sql, params):
+        fields = self.model._meta.concrete_fields
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(
+                table=self.model._meta.db_table,
+                columns=', '.join(f's.{connection.ops.quote_name(field.column)}' for field in fields),
+            ), params)
+            rows = cursor.fetchall()
+        attnames = [field.attname for field in fields]
+        return [self.model.from_db(self.db, attnames, row) for row in rows]
+
+    def claim(self, status_ids=None, states=('pending', 'retrying'), limit=None, max_attempts=None, lease=None):
+        """Moves statuses in one of `states` (just status_ids, if given) to sending and counts the attempt.
+        Returns the claimed statuses, at most `limit` of them, oldest first.
+
+        Rows another claim has locked are skipped rather than waited on, and so are statuses that have used up
+        max_attempts. A claimed status's next_attempt_at is pushed out by `lease` seconds: if the worker dies with
+        the send in flight the status can be claimed again once that has passed.
+        """
+        statuses = self._update_returning("""
+            UPDATE {table} s SET
+                state = 'sending',
+                send_attempts = s.send_attempts + 1,
+                next_attempt_at = now() + make_interval(secs => %(lease)s)
+            WHERE s.id IN (
+                SELECT id FROM {table}
+                WHERE (%(ids)s::bigint[] IS NULL OR id = ANY(%(ids)s::bigint[]))
+                    AND (state = ANY(%(states)s::varchar[]) OR (state = 'sending' AND next_attempt_at <= now()))
+                    AND (%(max_attempts)s::integer IS NULL OR send_attempts < %(max_attempts)s::integer)
+                ORDER BY id
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING {columns}
+        """, {
+            'ids': list(status_ids) if status_ids is not None else None,
+            'states': list(states),
+            'limit': limit,
+            'max_attempts': max_attempts,
+            'lease': lease or 0,
+        })
+        for status in statuses:
+            status.claimed_attempts = status.send_attempts
+        return sorted(statuses, key=lambda status: status.id)
+
+    def give_up_lost(self, max_attempts, error_message):
+        """Fails sends whose worker was lost on their last attempt: still in sending with the lease run out and no
+        attempts left, which claim skips for good. They're added to the dead letters in the same transaction.
+        Returns the ids given up on."""
+        with transaction.atomic():
+            statuses = self._update_returning("""
+                UPDATE {table} s SET
+                    state = 'failed',
+                    send_success = false,
+                    error_message = %(error_message)s,
+                    next_attempt_at = NULL
+                WHERE s.id IN (
+                    SELECT id FROM {table}
+                    WHERE state = 'sending' AND next_attempt_at <= now() AND send_attempts >= %(max_attempts)s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {columns}
+            """, {'max_attempts': max_attempts, 'error_message': error_message})
+            DeadLetter.objects.add([status.id for status in statuses])
+        return [status.id for status in statuses]
+
+    def finish(self, statuses):
+        """Writes the outcome of claimed sends, set on each status with succeed/fail/retry, in one UPDATE. A status
+        is only updated if it's still in sending at the attempt it was claimed for. Returns the ids that were.
+        Sends given up on are also added to the dead letters, in the same transaction."""
+        if not statuses:
+            return set()
+        with transaction.atomic():
+            updated = self._finish(statuses)
+            DeadLetter.objects.add([
+                status.id for status in statuses if status.state == MessageStatus.State.FAILED and status.id in updated
+            ])
+        return updated
+
+    def _finish(self, statuses):
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {self.model._meta.db_table} s SET
+                    state = v.state,
+                    send_success = v.state = 'sent',
+                    send_attempts = v.send_attempts,
+                    last_http_status_code = v.last_http_status_code,
+                    error_message = v.error_message,
+                    next_attempt_at = v.next_attempt_at
+                FROM unnest(
+                    %s::bigint[], %s::integer[], %s::varchar[], %s::integer[], %s::integer[], %s::text[], %s::timestamptz[]
+                ) AS v(id, claimed_attempts, state, send_attempts, last_http_status_code, error_message, next_attempt_at)
+                WHERE s.id = v.id AND s.state = 'sending' AND s.send_attempts = v.claimed_attempts
+                RETURNING s.id
+            """, [
+                [status.id for status in statuses],
+                [status.claimed_attempts for status in statuses],
+                [status.state for status in statuses],
+                [status.send_attempts for status in statuses],
+                [status.last_http_status_code for status in statuses],
+                [status.error_message for status in statuses],
+                [status.next_attempt_at for status in statuses],
+            ])
+            return {id for id, in cursor.fetchall()}
+
+
 class MessageStatus(models.Model):
+    class State(models.TextChoices):
+        PENDING = 'pending' # not attempted yet
+        SENDING = 'sending' # claimed by a worker, the provider call is in flight
+        RETRYING = 'retrying' # waiting for next_attempt_at
+        SENT = 'sent'
+        FAILED = 'failed'
+
+    class Priority(models.TextChoices):
+        TRANSACTIONAL = 'transactional' # one-off sends someone is waiting on, e.g. a 2FA code
+        BULK = 'bulk' # campaigns and other batches
+
+    state = models.CharField(max_length=16, choices=State.choices, default=State.PENDING, db_default=State.PENDING)
+    # the lane (Celery queue) the send goes through, retries included, so a bulk backlog never delays a transactional send
+    priority = models.CharField(
+        max_length=16, choices=Priority.choices, default=Priority.TRANSACTIONAL, db_default=Priority.TRANSACTIONAL,
+    )
     send_attempts = models.IntegerField(default=0)
     send_success = models.BooleanField(default=False)
     error_message = models.TextField(blank=True)
     last_http_status_code = models.IntegerField(blank=True, null=True)
+    # when a failed send is due to be retried (or an in-flight one's lease runs out), picked up by pump_retries
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+
+    objects = MessageStatusManager()
+
+    class Meta:
+        indexes = [
+            # sends still to be claimed or in flight, the small hot end of an ever growing table. Matches claim's
+            # predicate, which walks it in id order.
+            models.Index(
+                fields=['id'],
+                condition=models.Q(state__in=['pending', 'retrying', 'sending']),
+                name='api_msgstatus_claimable_idx',
+            ),
+            # only retries waiting to come due
+            models.Index(
+                fields=['next_attempt_at'],
+                condition=models.Q(next_attempt_at__isnull=False),
+                name='api_msgstatus_next_attempt_idx',
+            ),
+        ]
     
     def __str__(self):
         return f"{self.id}: Send Attempt {self.send_attempts}. Success: {self.send_success}. Error Message: {self.error_message}"
 
+    # Outcomes of a claimed send. These only change the instance, MessageStatus.objects.finish writes them.
+
+    def succeed(self, http_status_code):
+        self.state = self.State.SENT
+        self.send_success = True
+        self.last_http_status_code = http_status_code
+        self.next_attempt_at = None
+
+    def fail(self, error_message, http_status_code=None):
+        self.state = self.State.FAILED
+        self.error_message = error_message
+        self.last_http_status_code = http_status_code or self.last_http_status_code
+        self.next_attempt_at = None
+
+    def retry(self, next_attempt_at, http_status_code=None, counts_as_attempt=True):
+        self.state = self.State.RETRYING
+        self.last_http_status_code = http_status_code or self.last_http_status_code
+        self.next_attempt_at = next_attempt_at
+        if not counts_as_attempt:
+            self.send_attempts -= 1
+
+
+class BodyStorage(models.TextChoices):
+    INLINE = 'inline' # as is, in inline_body
+    ZLIB = 'zlib' # compressed, in body_compressed
+    BLOB = 'blob' # compressed, in the body store under body_blob
+
+
+def plain_text(body, is_html=False):
+    """A body as plain text on one line"""
+    if is_html:
+        body = html.unescape(strip_tags(body))
+    return ' '.join(body.split())
+
+
+def add_months(month, months):
+    """The first of the month `months` after (or before, if negative) the month of `month`"""
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+class MessageManager(models.Manager):
+    """The message table is range partitioned by month on timestamp (see migration 0017): a partition per month
+    named api_message_pYYYY_MM, and api_message_default for timestamps no month has a partition for. Queries
+    filtered on timestamp only read the months they cover, and a month is dropped whole rather than DELETEd.
+
+    maintain_message_partitions keeps partitions created ahead of time, so the default partition only ever holds
+    the odd message timestamped far in the past or future."""
+
+    def _month_tables(self, cursor):
+        """{first of the month: (table name, attached)} for the monthly tables, including any detached ones"""
+        table = self.model._meta.db_table
+        cursor.execute(
+            "SELECT relname, relispartition FROM pg_class WHERE relkind = 'r' AND relname ~ %s "
+            "AND relnamespace = current_schema()::regnamespace",
+            [rf'^{table}_p\d{{4}}_\d{{2}}$'],
+        )
+        tables = {}
+        for name, attached in cursor.fetchall():
+            year, month = re.search(r'(\d{4})_(\d{2})$', name).groups()
+            tables[datetime.date(int(year), int(month), 1)] = (name, attached)
+        return dict(sorted(tables.items()))
+
+    def partitions(self):
+        """{first of the month: partition name} for the monthly partitions, oldest first"""
+        with connection.cursor() as cursor:
+            return {month: name for month, (name, attached) in self._month_tables(cursor).items() if attached}
+
+    def create_partitions(self, months):
+        """Creates partitions for the months (dates, any day of the month) that don't have one yet, and the default
+        partition if it's missing. Returns the names of the monthly partitions created.
+
+        Messages of the month already in the default partition are moved into the new one, so this also works for
+        a month that has started, at the cost of locking the default partition while it's checked."""
+        table = self.model._meta.db_table
+        created = []
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+            existing = self._month_tables(cursor)
+        for month in sorted({month.replace(day=1) for month in months} - existing.keys()):
+            name = f"{table}_p{month:%Y_%m}"
+            bounds = [
+                datetime.datetime.combine(month, datetime.time(), datetime.timezone.utc),
+                datetime.datetime.combine(add_months(month, 1), datetime.time(), datetime.timezone.utc),
+            ]
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING STORAGE INCLUDING COMPRESSION)")
+                cursor.execute(f"""
+                    WITH moved AS (
+                        DELETE FROM {table}_default WHERE timestamp >= %s AND timestamp < %s RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved
+                """, bounds)
+                # indexes, keys and foreign keys come from the parent
+                cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+            created.append(name)
+        self.name_partition_indexes()
+        return created
+
+    def name_partition_indexes(self):
+        """Renames the indexes Postgres created on partitions for the table's own to {index}_{partition suffix},
+        e.g. api_msg_conv_timestamp_idx_p2026_10, so they're recognisable in query plans"""
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT partition.relname, child.relname, parent.relname
+                FROM pg_inherits p
+                JOIN pg_class partition ON partition.oid = p.inhrelid
+                JOIN pg_index i ON i.indrelid = p.inhrelid
+                JOIN pg_class child ON child.oid = i.indexrelid
+                JOIN pg_inherits ip ON ip.inhrelid = i.indexrelid
+                JOIN pg_class parent ON parent.oid = ip.inhparent
+                WHERE p.inhparent = %s::regclass
+            """, [table])
+            for partition, index, parent in cursor.fetchall():
+                name = f"{parent}_{partition.removeprefix(f'{table}_')}"
+                if index != name:
+                    cursor.execute(f"ALTER INDEX {index} RENAME TO {name}")
+
+    def drop_partitions(self, before):
+        """Drops the monthly partitions of months before the month of `before`, along with their messages'
+        attachments, outbox entries, dead letters and send statuses, and takes their messages off their
+        conversations' message counts. Bodies in the body store no other message refers to are deleted too.
+        Returns the names of the partitions dropped.
+
+        Each partition is detached first, a quick catalog change, so the message table is only locked for a moment
+        whatever the month's size. The cleanup after it runs on the detached table, and a partition a failed run
+        left detached is picked up by the next. Don't call this inside a transaction."""
+        table = self.model._meta.db_table
+        cutoff = before.replace(day=1)
+        with connection.cursor() as cursor:
+            tables = [entry for month, entry in self._month_tables(cursor).items() if month < cutoff]
+            for name, attached in tables:
+                if attached:
+                    cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        for name, _ in tables:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f"""
+                    UPDATE {Conversation._meta.db_table} c SET message_count = GREATEST(c.message_count - m.count, 0)
+                    FROM (SELECT conversation_id, count(*) AS count FROM {name} GROUP BY conversation_id) m
+                    WHERE c.id = m.conversation_id
+                """)
+                for model in [Attachment, OutboxEntry, DeadLetter]:
+                    cursor.execute(f"DELETE FROM {model._meta.db_table} d USING {name} m WHERE d.message_id = m.id")
+                cursor.execute(f"SELECT DISTINCT body_blob FROM {name} WHERE body_storage = %s", [BodyStorage.BLOB])
+                blobs = [key for key, in cursor.fetchall()]
+                # the statuses go after the table, whose foreign key to them would otherwise be checked at commit
+                cursor.execute(f"""
+                    CREATE TEMPORARY TABLE dropped_statuses AS
+                    SELECT outbound_status_id AS id FROM {name} WHERE outbound_status_id IS NOT NULL
+                """)
+                cursor.execute(f"DROP TABLE {name}")
+                cursor.execute(f"DELETE FROM {MessageStatus._meta.db_table} s USING dropped_statuses d WHERE s.id = d.id")
+                cursor.execute("DROP TABLE dropped_statuses")
+            self._delete_unreferenced_bodies(blobs)
+        return [name for name, _ in tables]
+
+    def _delete_unreferenced_bodies(self, keys):
+        """Deletes the bodies no message refers to any more from the body store. Bodies are shared by every message
+        with the same one, so a body is only deleted once none is left, and not while a transaction that's storing
+        it again holds its lock (see BodyStore.put)."""
+        for key in keys:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", [body_store.lock_id(key)])
+                if cursor.fetchone()[0] and not self.filter(body_storage=BodyStorage.BLOB, body_blob=key).exists():
+                    body_store.delete(key)
+
 
 class Message(models.Model):
     # existence of status implies it's outbound
     outbound_status = models.OneToOneField(MessageStatus, on_delete=models.CASCADE, blank=True, null=True)
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
+    # indexed by the (conversation, -timestamp, -id) index below rather than on its own
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages', db_index=False)
     to_participant = models.ForeignKey(Participant, on_delete=models.CASCADE, related_name='messages_to')
     from_participant = models.ForeignKey(Participant, on_delete=models.CASCADE, related_name='messages_from')
-    body = models.TextField()
     timestamp = models.DateTimeField()
     type = models.CharField(max_length=255)
     messaging_provider_id = models.CharField(max_length=255)
     additional_data = models.JSONField(default=dict)
+    # The body lives in one of these depending on its size, set and read it through Message.body.
+    # Listings only need the preview, defer inline_body and body_compressed to leave big bodies in the database.
+    body_storage = models.CharField(
+        max_length=8, choices=BodyStorage.choices, default=BodyStorage.INLINE, db_default=BodyStorage.INLINE,
+    )
+    inline_body = models.TextField(db_column='body', blank=True)
+    body_compressed = models.BinaryField(blank=True, null=True)
+    body_blob = models.CharField(max_length=64, blank=True, default='') # its key in the body store
+    body_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='', db_default='')
+    # the body's words for full-text search, set with the body so bodies stored out of line are searchable too
+    search_vector = SearchVectorField(blank=True, null=True)
+
+    objects = MessageManager()
+
+    @property
+    def body(self):
+        """The full body, decompressed or fetched from the body store the first time it's asked for"""
+        if self.__dict__.get('_body') is None:
+            if self.body_storage == BodyStorage.ZLIB:
+                self._body = zlib.decompress(self.body_compressed).decode()
+            elif self.body_storage == BodyStorage.BLOB:
+                self._body = zlib.decompress(body_store.get(self.body_blob)).decode()
+            else:
+                self._body = self.inline_body
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        text = plain_text(value, is_html=self.type == 'email')
+        self.body_preview = text[:PREVIEW_LENGTH]
+        self.search_vector = SearchVector(models.Value(text), config=settings.API_SEARCH_CONFIG)
+        self.body_storage, self.inline_body, self.body_compressed, self.body_blob = BodyStorage.INLINE, value, None, ''
+        encoded = value.encode()
+        if len(encoded) <= settings.API_BODY_INLINE_MAX_BYTES:
+            return
+        compressed = zlib.compress(encoded)
+        self.inline_body = ''
+        if len(compressed) <= settings.API_BODY_BLOB_MIN_BYTES:
+            self.body_storage, self.body_compressed = BodyStorage.ZLIB, compressed
+        else:
+            # written straight away so bulk_create can save it too, a body whose message is never saved is only
+            # wasted space
+            self.body_storage, self.body_blob = BodyStorage.BLOB, body_store.put(compressed)
+
+    def refresh_from_db(self, *args, **kwargs):
+        self.__dict__.pop('_body', None)
+        super().refresh_from_db(*args, **kwargs)
 
     def __str__(self):
-        return f"{self.id}: {self.body} from {self.from_participant} to {self.to_participant} at {self.timestamp}. Type: {self.type}. Messaging Provider ID: {self.messaging_provider_id}. Outbound: {self.outbound_status is not None}. Send Attempts: {self.outbound_status.send_attempts if self.outbound_status else 0}. Additional Data: {self.additional_data}"
+        return f"{self.id}: {self.body_preview} from {self.from_participant} to {self.to_participant} at {self.timestamp}. Type: {self.type}. Messaging Provider ID: {self.messaging_provider_id}. Outbound: {self.outbound_status is not None}. Send Attempts: {self.outbound_status.send_attempts if self.outbound_status else 0}. Additional Data: {self.additional_data}"
 
     class Meta: 
         ordering = ['-timestamp']
+        indexes = [
+            # get_messages, both page and cursor modes: a conversation's messages newest first
+            models.Index(fields=['conversation', '-timestamp', '-id'], name='api_msg_conv_timestamp_idx'),
+            # ?data= lookups (additional_data @> {...}), jsonb_path_ops only does containment but is a fraction of the size
+            GinIndex(fields=['additional_data'], opclasses=['jsonb_path_ops'], name='api_msg_additional_data_idx'),
+            GinIndex(fields=['search_vector'], name='api_msg_search_vector_idx'),
+            # whether a body in the body store is still referred to, when a month's messages are dropped
+            models.Index(fields=['body_blob'], condition=models.Q(body_storage='blob'), name='api_msg_body_blob_idx'),
+        ]
+        # Partitioned by month on timestamp, so the primary key and unique constraints include it in the database:
+        # the key is (id, timestamp) and outbound_status is unique with timestamp. Tables referencing messages can't
+        # have foreign keys to them, their on_delete is Django's alone.
+        constraints = [
+            # providers retry webhooks, (type, messaging_provider_id) is the idempotency key for inbound messages.
+            # A retry repeats the message's timestamp, which has to be part of it.
+            models.UniqueConstraint(
+                fields=['type', 'messaging_provider_id', 'timestamp'],
+                condition=models.Q(outbound_status__isnull=True) & ~models.Q(messaging_provider_id=''),
+                name='api_message_inbound_provider_id_uniq',
+            ),
+        ]
 
 class Attachment(models.Model):
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='attachments')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='attachments', db_constraint=False)
     url = models.URLField()
 
 
+class OutboxEntryManager(models.Manager):
+    def add(self, message_ids):
+        """Queues outbound messages for sending. Call inside the transaction that saves them."""
+        self.bulk_create([self.model(message_id=message_id) for message_id in message_ids])
+
+    def due(self):
+        """Entries waiting to be relayed: not relayed yet, or not claimed by a send by their next_relay_at, so their
+        task may have been lost"""
+        return self.filter(models.Q(next_relay_at__isnull=True) | models.Q(next_relay_at__lte=timezone.now()))
+
+    def relay(self, publish, message_ids=None, limit=None):
+        """Claims up to `limit` due entries (just those for message_ids, if given), oldest first, hands their message
+        ids to publish(message_ids, priority) a priority at a time and marks them relayed, all in one transaction.
+        Returns how many were relayed.
+
+        Entries another relay has claimed are skipped, so any number of relays can run side by side. If publish
+        raises the entries stay put for the next run; if it succeeds but the commit doesn't they're published again,
+        which the send's claim makes harmless. An entry is only deleted by the claim of its send (see
+        tasks.claim_for_send). Until then it comes due again API_OUTBOX_RELAY_LEASE after being relayed, doubling
+        with each relay (up to 64 times): a lost task looks the same as one queued behind a big backlog, which
+        shouldn't be published over and over while it drains.
+        """
+        with transaction.atomic():
+            entries = self.due().select_for_update(skip_locked=True, of=('self',)).order_by('id')
+            if message_ids is not None:
+                entries = entries.filter(message_id__in=message_ids)
+            entries = list(entries.values_list('id', 'message_id', 'message__outbound_status__priority')[:limit])
+            by_priority = {}
+            for _, message_id, priority in entries:
+                by_priority.setdefault(priority, []).append(message_id)
+            for priority, priority_message_ids in by_priority.items():
+                publish(priority_message_ids, priority)
+            if entries:
+                lease = models.Value(datetime.timedelta(seconds=settings.API_OUTBOX_RELAY_LEASE))
+                self.filter(id__in=[id for id, _, _ in entries]).update(
+                    relays=models.F('relays') + 1,
+                    next_relay_at=models.ExpressionWrapper(
+                        Now() + lease * Power(2, Least(models.F('relays'), 6)), output_field=models.DateTimeField(),
+                    ),
+                )
+        return len(entries)
+
+    def lag(self):
+        """Seconds the oldest due entry has been waiting, 0 with none due"""
+        oldest = self.due().order_by('id').values_list('created_at', flat=True).first()
+        return (timezone.now() - oldest).total_seconds() if oldest else 0
+
+
+class OutboxEntry(models.Model):
+    """An outbound message waiting for its send to be claimed. Written in the same transaction as the message, so a
+    message is never committed without its send being queued, even if the broker is down, the process dies before
+    it can publish or the published task is lost."""
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='outbox_entry', db_constraint=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # times the send has been published, and when it's due to be again if it still hasn't been claimed
+    relays = models.IntegerField(default=0)
+    next_relay_at = models.DateTimeField(blank=True, null=True)
+
+    objects = OutboxEntryManager()
+
+
+class DeadLetterQuerySet(models.QuerySet):
+    def add(self, status_ids):
+        """Records the sends of status_ids as given up on, with the reason and status code now on their status"""
+        if not status_ids:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {self.model._meta.db_table} (message_id, type, reason, http_status_code, failed_at)
+                SELECT m.id, m.type, s.error_message, s.last_http_status_code, now()
+                FROM {Message._meta.db_table} m JOIN {MessageStatus._meta.db_table} s ON s.id = m.outbound_status_id
+                WHERE s.id = ANY(%s::bigint[])
+                ON CONFLICT (message_id) DO UPDATE SET
+                    reason = EXCLUDED.reason, http_status_code = EXCLUDED.http_status_code, failed_at = EXCLUDED.failed_at
+            """, [list(status_ids)])
+
+    def matching(self, provider=None, reason=None, http_status_code=None, since=None, until=None):
+        """Dead letters by provider, reason, the provider's status code and when they failed (since inclusive,
+        until exclusive). Leave a filter out (None) to not filter on it."""
+        from .integrations import PROVIDER_FOR_TYPE
+
+        dead_letters = self
+        if provider is not None:
+            dead_letters = dead_letters.filter(type__in=[type for type, name in PROVIDER_FOR_TYPE.items() if name == provider])
+        if reason is not None:
+            dead_letters = dead_letters.filter(reason=reason)
+        if http_status_code is not None:
+            dead_letters = dead_letters.filter(http_status_code=http_status_code)
+        if since is not None:
+            dead_letters = dead_letters.filter(failed_at__gte=since)
+        if until is not None:
+            dead_letters = dead_letters.filter(failed_at__lt=until)
+        return dead_letters
+
+    def summary(self):
+        """Counts by type, reason and status code, largest first"""
+        return list(
+            self.values('type', 'reason', 'http_status_code')
+            .annotate(count=models.Count('id'))
+            .order_by('-count', 'type', 'reason')
+        )
+
+    def requeue(self, chunk_size, limit=None, pause=0):
+        """Puts these dead letters' sends back up for retry with fresh attempts, and removes them. Returns how many
+        were requeued.
+
+        Works through them chunk_size at a time, each chunk its own transaction of two set-based statements, so
+        requeuing a whole outage's worth never holds a long transaction or loads it into memory. Don't call this
+        inside a transaction. The sends are left to pump_retries rather than queued here, so they go out at each
+        provider's API_RETRY_BUDGET per run however many are requeued at once. `pause` is seconds to sleep between
+        chunks, to go easier on the database.
+        """
+        requeued = 0
+        while limit is None or requeued < limit:
+            size = chunk_size if limit is None else min(chunk_size, limit - requeued)
+            with transaction.atomic():
+                entries = list(
+                    self.select_for_update(skip_locked=True, of=('self',)).order_by('id')
+                    .values_list('id', 'message__outbound_status_id')[:size]
+                )
+                if not entries:
+                    break
+                MessageStatus.objects.filter(
+                    id__in=[status_id for _, status_id in entries], state=MessageStatus.State.FAILED,
+                ).update(
+                    state=MessageStatus.State.RETRYING,
+                    send_attempts=0,
+                    send_success=False,
+                    error_message='',
+                    next_attempt_at=timezone.now(),
+                )
+                self.model.objects.filter(id__in=[id for id, _ in entries]).delete()
+            requeued += len(entries)
+            if len(entries) < size:
+                break
+            if pause:
+                time.sleep(pause)
+        return requeued
+
+
+class DeadLetter(models.Model):
+    """An outbound send that was given up on. Kept apart from MessageStatus so the failures can be found, and
+    replayed after a provider incident, without scanning every status."""
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='dead_letter', db_constraint=False)
+    type = models.CharField(max_length=255) # the message's, which gives the provider
+    reason = models.TextField()
+    http_status_code = models.IntegerField(blank=True, null=True)
+    failed_at = models.DateTimeField()
+
+    objects = DeadLetterQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # the filters used to pick what to requeue, each narrowing the next
+            models.Index(fields=['type', 'http_status_code', 'reason', 'failed_at'], name='api_deadletter_filter_idx'),
+            models.Index(fields=['failed_at'], name='api_deadletter_failed_at_idx'),
+        ]
+
+
 
 
 
 
 # Just in case, preparing for your questions in advance:
 import secrets
-from django.conf import settings
 
 class APIToken(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -0,0 +1,172 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+
+# Per provider token buckets shared by every worker, so the cluster as a whole stays under a provider's rate limit,
+# and a 429's Retry-After pauses everyone's sends to that provider rather than just the message that got it.
+# With django_redis as the default cache the buckets live in Redis, otherwise (local development, the tests) each
+# process has its own.
+
+# KEYS[1] bucket hash. ARGV: rate (tokens/s), burst, tokens wanted.
+# Returns seconds to wait before trying again, "0" if the tokens were taken.
+TAKE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, burst, wanted = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at', 'paused_until')
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+local paused_until = tonumber(bucket[3]) or 0
+if now < paused_until then
+    return tostring(paused_until - now)
+end
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= wanted then
+    tokens = tokens - wanted
+else
+    wait = (wanted - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+return tostring(wait)
+"""
+
+# KEYS[1] bucket hash. ARGV: seconds to pause for. A pause only ever extends an existing one.
+PAUSE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local paused_until = tonumber(redis.call('HGET', KEYS[1], 'paused_until')) or 0
+redis.call('HSET', KEYS[1], 'paused_until', tostring(math.max(paused_until, now + tonumber(ARGV[1]))))
+redis.call('HINCRBY', KEYS[1], 'throttled', 1)
+"""
+
+
+class RedisBuckets:
+    def __init__(self, redis):
+        self.redis = redis
+        self.take_script = redis.register_script(TAKE_SCRIPT)
+        self.pause_script = redis.register_script(PAUSE_SCRIPT)
+
+    def key(self, provider):
+        return f'api:ratelimit:{provider}'
+
+    def take(self, provider, rate, burst, tokens=1):
+        return float(self.take_script(keys=[self.key(provider)], args=[rate, burst, tokens]))
+
+    def pause(self, provider, seconds):
+        self.pause_script(keys=[self.key(provider)], args=[seconds])
+
+    def state(self, provider, rate, burst):
+        bucket = self.redis.hgetall(self.key(provider))
+        seconds, microseconds = self.redis.time()
+        return bucket_state({k.decode(): float(v) for k, v in bucket.items()}, seconds + microseconds / 1_000_000, rate, burst)
+
+
+class LocalBuckets:
+    """The same buckets, in process"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, provider, rate, burst, tokens=1):
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.setdefault(provider, {})
+            if now < bucket.get('paused_until', 0):
+                return bucket['paused_until'] - now
+            available = min(burst, bucket.get('tokens', burst) + max(0, now - bucket.get('updated_at', now)) * rate)
+            wait = 0
+            if available >= tokens:
+                available -= tokens
+            else:
+                wait = (tokens - available) / rate
+            bucket.update(tokens=available, updated_at=now)
+            return wait
+
+    def pause(self, provider, seconds):
+        with self.lock:
+            bucket = self.buckets.setdefault(provider, {})
+            bucket['paused_until'] = max(bucket.get('paused_until', 0), time.time() + seconds)
+            bucket['throttled'] = bucket.get('throttled', 0) + 1
+
+    def state(self, provider, rate, burst):
+        with self.lock:
+            return bucket_state(dict(self.buckets.get(provider, {})), time.time(), rate, burst)
+
+
+def bucket_state(bucket, now, rate, burst):
+    tokens = min(burst, bucket.get('tokens', burst) + max(0, now - bucket.get('updated_at', now)) * rate)
+    return {
+        'rate': rate,
+        'burst': burst,
+        'tokens': round(tokens, 2),
+        'paused_for': round(max(0, bucket.get('paused_until', 0) - now), 2),
+        'throttled': int(bucket.get('throttled', 0)),
+    }
+
+
+class ProviderRateLimiter:
+    def __init__(self, buckets, limits, max_wait):
+        self.buckets = buckets
+        self.limits = limits
+        self.max_wait = max_wait
+
+    def take(self, provider, tokens=1):
+        """Takes tokens if they're available, returning 0, otherwise the seconds until they might be.
+        Providers without a configured limit are never limited."""
+        limit = self.limits.get(provider)
+        if limit is None:
+            return 0
+        return self.buckets.take(provider, limit['rate'], limit['burst'], tokens)
+
+    def acquire(self, provider, tokens=1):
+        """Waits for tokens, up to max_wait seconds. Returns None once they're taken, otherwise (the provider is
+        paused for longer than that) the seconds still to wait, so the caller can reschedule instead of blocking."""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            wait = self.take(provider, tokens)
+            if not wait:
+                return None
+            if time.monotonic() + wait > deadline:
+                return wait
+            time.sleep(wait)
+
+    async def acquire_async(self, provider, tokens=1):
+        """acquire, for an event loop. take is a Redis round trip, made on a thread so the loop's other sends carry on."""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            wait = await asyncio.to_thread(self.take, provider, tokens)
+            if not wait:
+                return None
+            if time.monotonic() + wait > deadline:
+                return wait
+            await asyncio.sleep(wait)
+
+    def pause(self, provider, seconds):
+        """Stops every worker sending to provider for the next `seconds`, e.g. a 429's Retry-After"""
+        self.buckets.pause(provider, seconds)
+
+    def state(self):
+        return {
+            provider: self.buckets.state(provider, limit['rate'], limit['burst'])
+            for provider, limit in self.limits.items()
+        }
+
+
+def shared_redis():
+    """The default cache's Redis connection, None when the cache isn't django_redis"""
+    if settings.CACHES['default']['BACKEND'].startswith('django_redis'):
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+    return None
+
+def build_rate_limiter():
+    redis = shared_redis()
+    buckets = RedisBuckets(redis) if redis is not None else LocalBuckets()
+    return ProviderRateLimiter(buckets, settings.API_PROVIDER_RATE_LIMITS, settings.API_RATE_LIMIT_MAX_WAIT)
+
+
+rate_limiter = build_rate_limiter()
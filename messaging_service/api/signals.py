@@ -0,0 +1,15 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .caches import conversation_cache, participant_cache
+from .models import Conversation, Participant
+
+
+@receiver(post_delete, sender=Participant)
+def evict_participant(sender, instance, **kwargs):
+    participant_cache.evict(instance.identifier)
+
+
+@receiver(post_delete, sender=Conversation)
+def evict_conversation(sender, instance, **kwargs):
+    conversation_cache.evict(instance.participant1_id, instance.participant2_id)
@@ -1,30 +1,36 @@
+import random
+from datetime import timedelta
+
 from celery import shared_task
-from .models import Message
-from .integrations import send_sms, send_email
-from requests.exceptions import RequestException
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Message, MessageStatus, OutboxEntry, add_months
+from .integrations import PROVIDER_FOR_TYPE, retry_after, send_sms, send_email, send_messages
+import httpx
 
 MAX_SEND_ATTEMPTS = 3
 SEND_BASE_DELAY = 3
 
 # Note that Celery making requests will block the worker from processing other tasks.
 # But these requests are short-lived, so it shouldn't be a big deal.
+# A send is a claim (pending/retrying -> sending, counting the attempt) and then its outcome (sending -> sent,
+# failed or retrying), each a single narrow UPDATE on the status, see MessageStatusManager.
 @shared_task
 def attempt_send_message(message_id):
 
-    message = Message.objects.get(id=message_id)
+    message = Message.objects.select_related('from_participant', 'to_participant').get(id=message_id)
 
-    if not message.outbound_status:
+    if not message.outbound_status_id:
         return
-    
-    if message.outbound_status.send_attempts >= MAX_SEND_ATTEMPTS:
-        print(f"Message {message_id} failed after {MAX_SEND_ATTEMPTS} attempts. Giving up.")
-        message.outbound_status.send_success = False
-        message.outbound_status.error_message = f"Failed after {MAX_SEND_ATTEMPTS} attempts"
-        message.save()
+
+    claimed = MessageStatus.objects.claim(
+        [message.outbound_status_id], max_attempts=MAX_SEND_ATTEMPTS, lease=settings.API_RETRY_LEASE,
+    )
+    if not claimed:
+        # already sent or given up on, or another worker has it in flight (e.g. this task was redelivered)
         return
-    
-    message.outbound_status.send_attempts += 1
-    message.save()
+    message.outbound_status = status = claimed[0]
 
     try:
         if message.type == 'sms' or message.type == 'mms':
@@ -33,31 +39,172 @@ def attempt_send_message(message_id):
             response = send_email(message)
         else:
             raise ValueError(f"Invalid message type: {message.type}")
-        
+
         # In theory we could add a "retry message" too but I'm already over-engineering this for this exercise
         # Basically, retry if appropriate, otherwise give up
-        message.outbound_status.last_http_status_code = response.status_code
-        message.save()
-
-        if response.status_code in [200, 201, 202, 204]:
-            message.outbound_status.send_success = True
-            message.save()
-        elif response.status_code == 429:
-            retry_after = response.headers.get('Retry-After')
-            if retry_after:
-                retry_after = int(retry_after)
-                attempt_send_message.apply_async(args=[message_id], countdown=retry_after)
-            else:
-                attempt_send_message.apply_async(args=[message_id], countdown=SEND_BASE_DELAY * 2**message.outbound_status.send_attempts)
-        elif response.status_code in [500, 502, 503, 504]:
-            attempt_send_message.apply_async(args=[message_id], countdown=SEND_BASE_DELAY * 2**message.outbound_status.send_attempts)
-        elif 400 <= response.status_code < 500:
-            print(f"Message {message_id} failed with status code {response.status_code}. Giving up.")
-            message.outbound_status.send_success = False
-            message.outbound_status.error_message = f"Failed with status code {response.status_code}"
-            message.save()
-        else:
-            message.outbound_status.send_success = True
-            message.save()
-    except RequestException as e: # implies a network error, so retry
-        attempt_send_message.apply_async(args=[message_id], countdown=SEND_BASE_DELAY * 2**message.outbound_status.send_attempts)
+        record_response(status, response)
+    except httpx.HTTPError as e: # implies a network error, so retry
+        schedule_retry(status, SEND_BASE_DELAY * 2**status.send_attempts)
+    MessageStatus.objects.finish([status])
+
+
+def record_response(status, response):
+    """Moves a claimed status on according to the provider's response"""
+    countdown = retry_countdown(response, status.send_attempts)
+    if countdown is not None:
+        schedule_retry(status, countdown, response)
+    elif 400 <= response.status_code < 500:
+        print(f"Message status {status.id} failed with status code {response.status_code}. Giving up.")
+        status.fail(f"Failed with status code {response.status_code}", response.status_code)
+    else:
+        status.succeed(response.status_code)
+
+def retry_countdown(response, send_attempts):
+    """Seconds to wait before retrying a send that got `response`, None if it shouldn't be retried"""
+    if response.status_code in [429, 503] and response.headers.get('Retry-After'):
+        return retry_after(response)
+    if response.status_code == 429 or response.status_code in [500, 502, 503, 504]:
+        return SEND_BASE_DELAY * 2**send_attempts
+    return None
+
+def schedule_retry(status, countdown, response=None):
+    """Sets status up to be retried by pump_retries after about `countdown` seconds, or gives up on it once it's
+    out of attempts.
+
+    Retries wait in the database rather than as countdown tasks, which the broker would hand to workers to hold in
+    memory until they're due. They're jittered upwards (never sooner than a Retry-After) so the messages that failed
+    together in an outage don't all come back at once."""
+    http_status_code = response.status_code if response else None
+    counted = response is None or counts_as_attempt(response)
+    if counted and status.send_attempts >= MAX_SEND_ATTEMPTS:
+        print(f"Message status {status.id} failed after {MAX_SEND_ATTEMPTS} attempts. Giving up.")
+        status.fail(f"Failed after {MAX_SEND_ATTEMPTS} attempts", http_status_code)
+        return
+    countdown *= 1 + random.uniform(0, settings.API_RETRY_JITTER)
+    status.retry(timezone.now() + timedelta(seconds=countdown), http_status_code, counts_as_attempt=counted)
+
+def counts_as_attempt(response):
+    # throttled sends, and ones deferred while the provider's circuit is open, never reached the provider's queue,
+    # they don't count towards MAX_SEND_ATTEMPTS
+    return response.sent and response.status_code != 429
+
+def claim_for_send(status_ids=None, states=('pending', 'retrying'), limit=None):
+    """Claims statuses and returns their messages, ready to send. Their outbox entries are deleted with the claim,
+    from then on the claim's lease sees to the send being retried if this one is lost. So are those of status_ids
+    not claimed: they're already sent, given up on or claimed by another worker."""
+    with transaction.atomic():
+        statuses = {
+            status.id: status
+            for status in MessageStatus.objects.claim(
+                status_ids, states, limit, max_attempts=MAX_SEND_ATTEMPTS, lease=settings.API_RETRY_LEASE,
+            )
+        }
+        OutboxEntry.objects.filter(
+            message__outbound_status_id__in=list(statuses) if status_ids is None else status_ids,
+        ).delete()
+    messages = list(
+        Message.objects.filter(outbound_status_id__in=statuses)
+        .select_related('from_participant', 'to_participant')
+        .prefetch_related('attachments')
+    )
+    for message in messages:
+        message.outbound_status = statuses[message.outbound_status_id]
+    return messages
+
+# Unlike attempt_send_message these don't block the worker on one provider call at a time: a chunk of messages is
+# sent from an event loop with up to API_SEND_CONCURRENCY calls in flight, and every outcome is written back in one
+# bulk UPDATE. Retries are scheduled for pump_retries like attempt_send_message's.
+@shared_task
+def send_message_batch(message_ids):
+    status_ids = Message.objects.filter(id__in=message_ids).values_list('outbound_status_id', flat=True)
+    send_claimed(claim_for_send([id for id in status_ids if id is not None]))
+
+@shared_task
+def send_pending_messages(limit=None):
+    """Sends a chunk of outbound messages that haven't been attempted yet"""
+    messages = claim_for_send(states=('pending',), limit=limit or settings.API_SEND_BATCH_SIZE)
+    send_claimed(messages)
+    return len(messages)
+
+def send_claimed(messages):
+    if not messages:
+        return
+    responses = send_messages(messages, settings.API_SEND_CONCURRENCY)
+    for message, response in zip(messages, responses):
+        try:
+            record_response(message.outbound_status, response)
+        except Exception as e:
+            # one response we can't make sense of mustn't keep the rest of the batch's outcomes from being written
+            print(f"Message status {message.outbound_status_id} got a response we couldn't record, retrying it. {e}")
+            schedule_retry(message.outbound_status, SEND_BASE_DELAY * 2**message.outbound_status.send_attempts)
+    MessageStatus.objects.finish([message.outbound_status for message in messages])
+
+@shared_task
+def pump_retries():
+    """Queues the retries that have come due onto send_message_batch, run every API_RETRY_PUMP_INTERVAL by beat.
+    Each provider gets at most API_RETRY_BUDGET of its retries queued per run, so one recovering from an outage
+    isn't handed its whole backlog at once and the rest wait for the next run. Transactional retries get first
+    call on the budget, and each retry goes back to its own lane. Sends whose worker was lost on their last
+    attempt are given up on rather than queued. Returns how many were queued."""
+    lost = MessageStatus.objects.give_up_lost(MAX_SEND_ATTEMPTS, f"Failed after {MAX_SEND_ATTEMPTS} attempts")
+    for status_id in lost:
+        print(f"Message status {status_id} was lost on its last attempt. Giving up.")
+    now = timezone.now()
+    status_ids, message_ids = [], {priority: [] for priority in MessageStatus.Priority}
+    with transaction.atomic():
+        for provider, budget in settings.API_RETRY_BUDGET.items():
+            types = [type for type, name in PROVIDER_FOR_TYPE.items() if name == provider]
+            for priority in MessageStatus.Priority:
+                # retries come due, and sends in flight whose lease ran out
+                due = (
+                    MessageStatus.objects.filter(
+                        next_attempt_at__lte=now, state__in=[MessageStatus.State.RETRYING, MessageStatus.State.SENDING],
+                        priority=priority, message__type__in=types,
+                    )
+                    .select_for_update(skip_locked=True, of=('self',))
+                    .order_by('next_attempt_at')
+                )
+                for status_id, message_id in due.values_list('id', 'message__id')[:budget]:
+                    status_ids.append(status_id)
+                    message_ids[priority].append(message_id)
+                    budget -= 1
+                if not budget:
+                    break
+        # leased rather than cleared, so if a send task is lost its messages come due again
+        MessageStatus.objects.filter(id__in=status_ids).update(
+            next_attempt_at=now + timedelta(seconds=settings.API_RETRY_LEASE),
+        )
+
+    for priority, priority_message_ids in message_ids.items():
+        publish_sends(priority_message_ids, priority)
+    return len(status_ids)
+
+def publish_sends(message_ids, priority=MessageStatus.Priority.TRANSACTIONAL):
+    """Queues send_message_batch for the messages on their priority's lane, see API_SEND_QUEUES"""
+    for i in range(0, len(message_ids), settings.API_SEND_BATCH_SIZE):
+        send_message_batch.apply_async(
+            args=[message_ids[i:i + settings.API_SEND_BATCH_SIZE]], queue=settings.API_SEND_QUEUES[priority],
+        )
+
+@shared_task
+def relay_outbox(limit=None):
+    """Publishes outbound sends still waiting in the outbox, run every API_OUTBOX_RELAY_INTERVAL by beat (or
+    continuously by the relay_outbox command). The request that saved a message normally publishes it straight
+    after its commit, this picks up the ones it didn't get to and publishes again the ones whose task was lost.
+    Returns how many were published and the lag left."""
+    relayed = OutboxEntry.objects.relay(publish_sends, limit=limit or settings.API_OUTBOX_RELAY_BATCH_SIZE)
+    return relayed, OutboxEntry.objects.lag()
+
+@shared_task
+def maintain_message_partitions():
+    """Creates message partitions API_MESSAGE_PARTITION_MONTHS_AHEAD months ahead, and drops the ones older than
+    API_MESSAGE_RETENTION_MONTHS if it's set. Run hourly by beat, there's nothing to do most runs.
+    Returns the partitions created and dropped."""
+    this_month = timezone.now().date().replace(day=1)
+    created = Message.objects.create_partitions(
+        add_months(this_month, n) for n in range(settings.API_MESSAGE_PARTITION_MONTHS_AHEAD + 1)
+    )
+    dropped = []
+    if settings.API_MESSAGE_RETENTION_MONTHS:
+        dropped = Message.objects.drop_partitions(add_months(this_month, -settings.API_MESSAGE_RETENTION_MONTHS))
+    return created, dropped
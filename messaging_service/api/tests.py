@@ -0,0 +1,1450 @@
+import json
+import re
+import secrets
+import threading
+import time
+from datetime import date, timedelta
+
+import httpx
+import pytest
+from django.contrib.postgres.search import SearchQuery
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from messaging_service.api import integrations, tasks, views
+from messaging_service.api.bodystore import body_store
+from messaging_service.api.caches import LRUCache, conversation_cache, participant_cache
+from messaging_service.api.circuitbreaker import CircuitBreaker, LocalBreakers, circuit_breaker
+from messaging_service.api.mock_provider import MockProviderServer
+from messaging_service.api.models import (
+    Attachment, Conversation, DeadLetter, Message, MessageStatus, OutboxEntry, Participant, add_months,
+)
+from messaging_service.api.ratelimit import LocalBuckets, ProviderRateLimiter, rate_limiter
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture(autouse=True)
+def _clear_cache():
+    # the caches outlive each test's rolled back transaction
+    cache.clear()
+    participant_cache.clear()
+    conversation_cache.clear()
+    rate_limiter.buckets = LocalBuckets()
+    circuit_breaker.breakers = LocalBreakers()
+
+
+class PublishedSends(list):
+    """Stands in for the broker: the send_message_batch chunks published, with the queue each went to in .queues"""
+
+    def __init__(self):
+        super().__init__()
+        self.queues = []
+
+    def apply_async(self, args=None, kwargs=None, queue=None, **options):
+        self.append(args[0])
+        self.queues.append(queue)
+
+
+def post_json(client, url, data):
+    return client.post(url, data=json.dumps(data), content_type="application/json")
+
+
+def sms_payload(**kwargs):
+    payload = {
+        "from": "+12016661234",
+        "to": "+18045551234",
+        "type": "sms",
+        "body": "Hello!",
+        "attachments": None,
+        "timestamp": "2024-11-01T14:00:00Z",
+    }
+    payload.update(kwargs)
+    return payload
+
+
+def seconds_until_retry(status):
+    return (status.next_attempt_at - timezone.now()).total_seconds()
+
+
+def email_payload(**kwargs):
+    payload = {
+        "from": "user@usehatchapp.com",
+        "to": "contact@gmail.com",
+        "type": "email",
+        "body": "Hello <b>there</b>",
+        "attachments": ["https://example.com/document.pdf"],
+        "timestamp": "2024-11-01T14:00:00Z",
+    }
+    payload.update(kwargs)
+    return payload
+
+
+class TestSendBatch:
+    def test_mixed_batch(self, client):
+        response = post_json(client, "/api/messages/batch/", [
+            sms_payload(),
+            sms_payload(type="mms", attachments=["https://example.com/a.jpg", "https://example.com/b.jpg"]),
+            email_payload(xillio_id="abc"),
+            sms_payload(type="fax"),
+            sms_payload(to="+12016661234"),
+        ])
+
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [result["index"] for result in results] == [0, 1, 2, 3, 4]
+        assert [result["status"] for result in results] == [202, 202, 202, 400, 400]
+
+        assert Message.objects.count() == 3
+        assert Conversation.objects.count() == 2
+        assert Participant.objects.count() == 4
+        assert Attachment.objects.count() == 3
+        email = Message.objects.get(id=results[2]["message_id"])
+        assert email.type == "email"
+        assert email.additional_data == {"xillio_id": "abc"}
+        assert email.outbound_status is not None
+
+    def test_reuses_existing_conversation(self, client):
+        post_json(client, "/api/messages/sms", sms_payload())
+        post_json(client, "/api/messages/batch/", [sms_payload(**{"from": "+18045551234", "to": "+12016661234"})])
+
+        assert Conversation.objects.count() == 1
+        assert Message.objects.count() == 2
+
+    def test_query_count_is_independent_of_batch_size(self, client):
+        def count_queries(size):
+            batch = [
+                sms_payload(**{"from": f"+1201666{size:02}{i:02}", "attachments": ["https://example.com/a.jpg"]})
+                for i in range(size)
+            ]
+            with CaptureQueriesContext(connection) as context:
+                response = post_json(client, "/api/messages/batch/", batch)
+            assert response.status_code == 200
+            return len(context.captured_queries)
+
+        assert count_queries(2) == count_queries(40)
+
+    def test_rejects_non_list(self, client):
+        response = post_json(client, "/api/messages/batch/", sms_payload())
+        assert response.status_code == 400
+
+
+class TestReceiveBatch:
+    def test_sms_batch(self, client):
+        response = post_json(client, "/api/webhooks/sms/batch/", [
+            sms_payload(messaging_provider_id="message-1"),
+            sms_payload(type="mms", messaging_provider_id="message-2", attachments=["https://example.com/a.jpg"]),
+            email_payload(),
+            {"from": "+12016661234"},
+        ])
+
+        assert response.status_code == 200
+        assert [result["status"] for result in response.json()["results"]] == [201, 201, 400, 400]
+        assert Message.objects.filter(outbound_status__isnull=True).count() == 2
+        assert Conversation.objects.count() == 1
+        assert Attachment.objects.count() == 1
+
+    def test_email_batch(self, client):
+        response = post_json(client, "/api/webhooks/email/batch", [
+            {key: value for key, value in email_payload(**{"from": f"contact{i}@gmail.com"}).items() if key != "type"}
+            for i in range(3)
+        ])
+
+        assert [result["status"] for result in response.json()["results"]] == [201, 201, 201]
+        assert Conversation.objects.count() == 3
+        assert Participant.objects.count() == 4
+        assert set(Message.objects.values_list("type", flat=True)) == {"email"}
+
+
+class TestInboundDedupe:
+    def test_retry_is_acknowledged_without_writing(self, client):
+        first = post_json(client, "/api/webhooks/sms", sms_payload(messaging_provider_id="message-1"))
+        retry = post_json(client, "/api/webhooks/sms", sms_payload(messaging_provider_id="message-1"))
+
+        assert first.status_code == retry.status_code == 201
+        assert first.json() == retry.json()
+        assert Message.objects.count() == 1
+
+    def test_retry_past_the_cache(self, client, settings):
+        settings.API_WEBHOOK_DEDUPE_TIMEOUT = 0
+        post_json(client, "/api/webhooks/sms", sms_payload(messaging_provider_id="message-1"))
+        retry = post_json(client, "/api/webhooks/sms", sms_payload(messaging_provider_id="message-1"))
+
+        assert retry.status_code == 201
+        assert Message.objects.count() == 1
+
+    def test_messages_without_provider_id_are_not_deduped(self, client):
+        post_json(client, "/api/webhooks/email", email_payload())
+        post_json(client, "/api/webhooks/email", email_payload())
+
+        assert Message.objects.count() == 2
+
+    def test_batch(self, client):
+        post_json(client, "/api/webhooks/sms", sms_payload(messaging_provider_id="message-1"))
+        original = Message.objects.get()
+
+        response = post_json(client, "/api/webhooks/sms/batch/", [
+            sms_payload(messaging_provider_id="message-1"),
+            sms_payload(messaging_provider_id="message-2"),
+            sms_payload(messaging_provider_id="message-2"),
+        ])
+
+        results = response.json()["results"]
+        assert [result["status"] for result in results] == [201, 201, 201]
+        assert results[0]["message_id"] == original.id
+        assert results[1]["message_id"] == results[2]["message_id"]
+        assert Message.objects.count() == 2
+
+
+class TestAsyncSend:
+    def test_send_is_queued_on_commit(self, client, settings, django_capture_on_commit_callbacks):
+        settings.API_ASYNC_SEND = True
+        # warm, so the only callback is the send's rather than caching its participants
+        with django_capture_on_commit_callbacks(execute=True):
+            conversation_cache.get_or_create(*participant_cache.resolve(["+12016661234", "+18045551234"]).values())
+        with django_capture_on_commit_callbacks() as callbacks:
+            response = post_json(client, "/api/messages/sms", sms_payload())
+
+        assert response.status_code == 202
+        assert len(callbacks) == 1
+        status = client.get(f"/api/messages/{response.json()['message_id']}/status/").json()
+        assert status["state"] == "pending"
+        assert status["send_attempts"] == 0
+
+    def test_status_after_synchronous_send(self, client):
+        post_json(client, "/api/messages/sms", sms_payload())
+        message = Message.objects.get()
+
+        status = client.get(f"/api/messages/{message.id}/status").json()
+        assert status["state"] == "sent"
+        assert status["last_http_status_code"] == 200
+
+    def test_status_of_inbound_message(self, client):
+        post_json(client, "/api/webhooks/sms", sms_payload())
+        message = Message.objects.get()
+
+        assert client.get(f"/api/messages/{message.id}/status/").status_code == 404
+
+
+class TestCursorPagination:
+    def test_messages(self, client):
+        batch = [
+            sms_payload(messaging_provider_id=f"message-{i}", timestamp=f"2024-11-01T14:{i // 2:02}:00Z")
+            for i in range(45)
+        ]
+        post_json(client, "/api/webhooks/sms/batch/", batch)
+        conversation = Conversation.objects.get()
+
+        seen, cursor = [], ""
+        while cursor is not None:
+            response = client.get(f"/api/conversations/{conversation.id}/messages/", {"cursor": cursor}).json()
+            assert "total_pages" not in response
+            seen += [message["id"] for message in response["messages"]]
+            cursor = response["next_cursor"]
+
+        expected = list(Message.objects.order_by("-timestamp", "-id").values_list("id", flat=True))
+        assert seen == expected
+
+    def test_conversations(self, client):
+        post_json(client, "/api/webhooks/sms/batch/", [sms_payload(**{"from": f"+120166612{i:02}"}) for i in range(25)])
+
+        first = client.get("/api/conversations/", {"cursor": ""}).json()
+        second = client.get("/api/conversations/", {"cursor": first["next_cursor"]}).json()
+
+        assert len(first["conversations"]) == 20
+        assert len(second["conversations"]) == 5
+        assert second["next_cursor"] is None
+
+    def test_invalid_cursor(self, client):
+        assert client.get("/api/conversations/", {"cursor": "nonsense"}).status_code == 400
+
+
+class TestMessagesQueryCount:
+    def count_queries(self, client, conversation_id, params):
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(f"/api/conversations/{conversation_id}/messages/", params)
+        assert response.status_code == 200
+        return len(context.captured_queries)
+
+    @pytest.mark.parametrize("params", [{}, {"cursor": ""}])
+    def test_constant_query_count(self, client, params):
+        post_json(client, "/api/messages/batch/", [sms_payload(**{"from": "+12016660000"})])
+        post_json(client, "/api/messages/batch/", [
+            sms_payload(type="mms", attachments=[f"https://example.com/{i}-{j}.jpg" for j in range(3)])
+            for i in range(20)
+        ])
+        post_json(client, "/api/webhooks/sms/batch/", [sms_payload(**{"from": "+18045551234", "to": "+12016661234"})])
+        small, large = Conversation.objects.order_by("id")
+
+        assert large.messages.count() == 21
+        assert self.count_queries(client, small.id, params) == self.count_queries(client, large.id, params)
+
+
+class TestConversationSummary:
+    def test_counts_and_preview_follow_latest_message(self, client):
+        post_json(client, "/api/messages/sms", sms_payload(body="first", timestamp="2024-11-01T14:00:00Z"))
+        post_json(client, "/api/webhooks/sms/batch/", [
+            sms_payload(body="latest", timestamp="2024-11-01T16:00:00Z"),
+            sms_payload(body="older", timestamp="2024-11-01T15:00:00Z"),
+        ])
+        post_json(client, "/api/webhooks/sms", sms_payload(body="late delivery", timestamp="2024-11-01T13:00:00Z"))
+
+        conversation = Conversation.objects.get()
+        assert conversation.message_count == 4
+        assert conversation.last_message_preview == "latest"
+        assert conversation.last_message_at.hour == 16
+
+    def test_inbox_is_a_single_query(self, client):
+        for i in range(3):
+            post_json(client, "/api/messages/sms", sms_payload(**{"to": f"+1804555000{i}"}, timestamp=f"2024-11-0{3 - i}T14:00:00Z"))
+        # no messages yet, not in the inbox
+        Conversation.objects.get_or_create_by_identifier("+12016669999", "+18045559999")
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.get("/api/conversations/", {"sort": "recent", "cursor": ""})
+
+        # not counting the ATOMIC_REQUESTS savepoint around the view
+        assert len([query for query in context.captured_queries if "SAVEPOINT" not in query["sql"]]) == 1
+        conversations = response.json()["conversations"]
+        assert [set(conversation["participants"]) - {"+12016661234"} for conversation in conversations] == [
+            {"+18045550000"}, {"+18045550001"}, {"+18045550002"},
+        ]
+        assert conversations[0]["last_message_preview"] == "Hello!"
+
+
+class TestIndexes:
+    @pytest.fixture(autouse=True)
+    def _no_seqscan(self):
+        # the test tables are tiny, make the planner show which index it would pick on real data
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    @pytest.fixture
+    def conversation(self, client):
+        # a busy business number, so the participant2 index alone is a poor choice for a pair lookup. Its participant
+        # is created last so it's participant2 of every pair.
+        senders = [f"+1201666{i:04}" for i in range(300)]
+        Participant.objects.get_or_create_identifiers(senders)
+        post_json(client, "/api/messages/batch/", [sms_payload(**{"from": sender}) for sender in senders])
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE api_conversation")
+        return Conversation.objects.first()
+
+    def test_messages_page(self, conversation):
+        with connection.cursor() as cursor:
+            # with sorting discouraged too, a Sort node would mean no index can produce the order
+            cursor.execute("SET LOCAL enable_sort = off")
+            cursor.execute("SET LOCAL enable_bitmapscan = off")
+        plan = conversation.messages.order_by("-timestamp", "-id")[:21].explain()
+        assert "api_msg_conv_timestamp_idx" in plan
+        # a Sort node, the partitions' index scans are merged in order ("Merge Append ... Sort Key:")
+        assert not re.search(r"\bSort  \(", plan)
+
+    def test_conversation_by_participants(self, conversation):
+        plan = Conversation.objects.filter_by_participants(conversation.participant1, conversation.participant2).explain()
+        assert "api_conversation_participants_uniq" in plan
+
+    def test_conversations_for_participant(self, conversation):
+        plan = Conversation.objects.for_participant(conversation.participant2).explain()
+        assert "api_conversation_participants_uniq" in plan
+        assert "participant2_id" in plan
+        assert "Seq Scan" not in plan
+
+    def test_claim(self, conversation):
+        # the UPDATE send_pending_messages runs, explained rather than run again
+        with CaptureQueriesContext(connection) as context:
+            MessageStatus.objects.claim(states=("pending",), limit=500)
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN " + context.captured_queries[-1]["sql"])
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        assert "api_msgstatus_claimable_idx" in plan
+
+    def test_additional_data_lookup(self, conversation):
+        plan = Message.objects.filter(additional_data__contains={"xillio_id": "abc"}).explain()
+        assert "api_msg_additional_data_idx" in plan
+
+    def test_search(self, conversation):
+        plan = Message.objects.filter(search_vector=SearchQuery("hello", config="english")).explain()
+        assert "api_msg_search_vector_idx" in plan
+
+
+class TestConversationUpsert:
+    def test_get_or_create_conversation(self):
+        ids = Participant.objects.get_or_create_identifiers(["+12016661234", "+18045551234"])
+        first, created = Conversation.objects.get_or_create_conversation(ids["+18045551234"], ids["+12016661234"])
+        again, created_again = Conversation.objects.get_or_create_conversation(ids["+12016661234"], ids["+18045551234"])
+
+        assert (created, created_again) == (True, False)
+        assert first.id == again.id
+        assert again.participant1_id < again.participant2_id
+        assert again.created_at is not None
+        assert Conversation.objects.count() == 1
+
+    def test_merge_duplicates(self, client):
+        post_json(client, "/api/webhooks/sms", sms_payload(body="first"))
+        post_json(client, "/api/webhooks/sms", sms_payload(body="second"))
+        original = Conversation.objects.get()
+        # as things were before the constraint was restored
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+            cursor.execute("ALTER TABLE api_conversation DROP CONSTRAINT api_conversation_participants_uniq")
+        duplicate, = Conversation.objects.bulk_create([
+            Conversation(participant1_id=original.participant1_id, participant2_id=original.participant2_id),
+        ])
+        Message.objects.filter(inline_body="second").update(conversation=duplicate)
+
+        call_command("merge_duplicate_conversations")
+
+        conversation = Conversation.objects.get()
+        assert conversation.id == original.id
+        assert conversation.messages.count() == 2
+        assert conversation.message_count == 2
+
+
+class TestParticipantCache:
+    def test_resolve(self, client, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            ids = participant_cache.resolve(["+12016661234", "+18045551234"])
+        assert ids == dict(Participant.objects.values_list("identifier", "id"))
+
+        participant_cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            assert participant_cache.resolve(["+12016661234"]) == {"+12016661234": ids["+12016661234"]}
+            assert participant_cache.resolve(["+12016661234"]) == {"+12016661234": ids["+12016661234"]}
+        assert len(context.captured_queries) == 0
+
+    def test_lru_eviction(self):
+        lru = LRUCache(maxsize=2)
+        lru.set_many({"a": 1, "b": 2})
+        lru.get_many(["a"])
+        lru.set_many({"c": 3})
+
+        assert lru.get_many(["a", "b", "c"]) == {"a": 1, "c": 3}
+        assert lru.stats() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1, "evictions": 1, "expirations": 0}
+
+    def test_deleted_participant_is_evicted(self):
+        ids = participant_cache.resolve(["+12016661234"])
+        Participant.objects.get(id=ids["+12016661234"]).delete()
+
+        assert participant_cache.resolve(["+12016661234"])["+12016661234"] != ids["+12016661234"]
+
+    def test_deleted_elsewhere_expires(self, settings, monkeypatch, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            ids = participant_cache.resolve(["+12016661234"])
+        # another process's delete: evicted from the shared cache, but not from this process's LRU
+        Participant.objects.filter(id=ids["+12016661234"]).delete()
+        participant_cache.local.set_many(ids)
+        now = time.monotonic()
+        monkeypatch.setattr(time, "monotonic", lambda: now + settings.API_PARTICIPANT_CACHE_TTL + 1)
+
+        assert participant_cache.resolve(["+12016661234"])["+12016661234"] != ids["+12016661234"]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_rolled_back_request_caches_nothing(self, client):
+        # the over-long provider id fails the insert, and the request's transaction with it
+        response = post_json(client, "/api/messages/sms", sms_payload(messaging_provider_id="x" * 256))
+        assert response.status_code == 400
+        identifiers = ["+12016661234", "+18045551234"]
+        assert participant_cache.local.get_many(identifiers) == {}
+        assert cache.get_many([participant_cache.key(identifier) for identifier in identifiers]) == {}
+        pair = conversation_cache.normalize(*participant_cache.resolve(identifiers).values())
+        assert conversation_cache.local.get_many([pair]) == {}
+
+        assert post_json(client, "/api/messages/sms", sms_payload()).status_code == 200
+        assert participant_cache.local.get_many(identifiers) == dict(Participant.objects.values_list("identifier", "id"))
+        assert conversation_cache.local.get_many([pair]) == {pair: Conversation.objects.get().id}
+
+    def test_metrics(self, client, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            participant_cache.resolve(["+12016661234"])
+        before = client.get("/api/metrics/").json()["caches"]
+        participant_cache.resolve(["+12016661234"])
+
+        after = client.get("/api/metrics/").json()["caches"]
+        assert after["participants"]["hits"] == before["participants"]["hits"] + 1
+        assert {"hits", "misses", "evictions", "expirations"} <= after["conversations"].keys()
+
+    def test_send_skips_participant_queries_when_warm(self, client, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            post_json(client, "/api/webhooks/sms", sms_payload())
+        with CaptureQueriesContext(connection) as context:
+            post_json(client, "/api/webhooks/sms", sms_payload())
+        assert not any("api_participant" in query["sql"] for query in context.captured_queries)
+
+
+class TestConversationCache:
+    def test_warm_receive_skips_conversation_queries(self, client, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            post_json(client, "/api/webhooks/sms", sms_payload())
+        with CaptureQueriesContext(connection) as context:
+            post_json(client, "/api/webhooks/sms", sms_payload(**{"from": "+18045551234", "to": "+12016661234"}))
+
+        # only the conversation summary update touches the table
+        queries = [query["sql"] for query in context.captured_queries if "api_conversation" in query["sql"]]
+        assert len(queries) == 1
+        assert queries[0].lstrip().startswith("UPDATE")
+
+    def test_by_identifier(self, client):
+        post_json(client, "/api/webhooks/sms", sms_payload())
+        conversation = Conversation.objects.get()
+
+        assert Conversation.objects.by_identifier("+18045551234", "+12016661234") == conversation
+        with pytest.raises(Conversation.DoesNotExist):
+            Conversation.objects.by_identifier("+18045551234", "+19999999999")
+
+    def test_deleted_conversation_is_evicted(self, client):
+        post_json(client, "/api/webhooks/sms", sms_payload())
+        Conversation.objects.get().delete()
+        post_json(client, "/api/webhooks/sms", sms_payload())
+
+        assert Conversation.objects.get().messages.count() == 1
+
+    def test_ttl(self, monkeypatch):
+        lru = LRUCache(maxsize=10, ttl=60)
+        lru.set_many({"a": 1})
+        now = time.monotonic()
+        monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+
+        assert lru.get_many(["a"]) == {}
+        assert lru.stats()["expirations"] == 1
+
+
+@pytest.fixture
+def mock_provider():
+    server = MockProviderServer(("127.0.0.1", 0)).start_in_background()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestProviderClient:
+    def test_reuses_connections(self, mock_provider):
+        provider = integrations.ProviderClient("sms", mock_provider.url)
+        try:
+            statuses = [provider.send({"body": "hi"}).status_code for _ in range(20)]
+        finally:
+            provider.close()
+
+        assert statuses == [202] * 20
+        assert mock_provider.requests == 20
+        assert mock_provider.connections == 1
+
+    def test_passes_through_retry_after(self, mock_provider):
+        mock_provider.throttle_rate = 1.0
+        mock_provider.retry_after = 7
+        provider = integrations.ProviderClient("sms", mock_provider.url)
+        try:
+            response = provider.send({"body": "hi"})
+        finally:
+            provider.close()
+
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "7"
+
+    def test_connection_error_is_503(self):
+        provider = integrations.ProviderClient("sms", "http://127.0.0.1:9/messages")
+        assert provider.send({"body": "hi"}).status_code == 503
+
+    def test_send_through_configured_provider(self, client, settings, mock_provider, monkeypatch):
+        settings.API_PROVIDERS = {**settings.API_PROVIDERS, "sms": {"url": mock_provider.url, "api_key": ""}}
+        monkeypatch.setattr(integrations, "_clients", {})
+        response = post_json(client, "/api/messages/sms", sms_payload())
+
+        # the synchronous send answers with the provider's status code
+        assert response.status_code == 202
+        assert mock_provider.requests == 1
+        assert MessageStatus.objects.get().send_success
+
+
+class TestBatchSendTask:
+    @pytest.fixture
+    def provider(self, settings, mock_provider, monkeypatch):
+        settings.API_PROVIDERS = {**settings.API_PROVIDERS, "sms": {"url": mock_provider.url, "api_key": ""}}
+        monkeypatch.setattr(integrations, "_clients", {})
+        return mock_provider
+
+    def queue_batch(self, client, size):
+        batch = [sms_payload(**{"from": f"+1201666{i:04}"}) for i in range(size)]
+        return [result["message_id"] for result in post_json(client, "/api/messages/batch/", batch).json()["results"]]
+
+    def test_sends_concurrently_and_updates_in_bulk(self, client, settings, provider):
+        settings.API_SEND_CONCURRENCY = 5
+        provider.latency = 0.05
+        message_ids = self.queue_batch(client, 20)
+
+        started = time.monotonic()
+        with CaptureQueriesContext(connection) as context:
+            tasks.send_message_batch(message_ids)
+
+        assert time.monotonic() - started < 20 * provider.latency / 2
+        assert provider.requests == 20
+        assert MessageStatus.objects.filter(send_success=True, send_attempts=1, last_http_status_code=202).count() == 20
+        # the claim and the results
+        updates = [query["sql"] for query in context.captured_queries if query["sql"].lstrip().startswith("UPDATE")]
+        assert len(updates) == 2
+
+    def test_breaker_and_rate_limiter_stay_off_the_event_loop(self, client, settings, provider, monkeypatch):
+        settings.API_SEND_CONCURRENCY = 5
+        message_ids = self.queue_batch(client, 4)
+        threads = []
+        for backend, name in [
+            (circuit_breaker.breakers, "allow"), (circuit_breaker.breakers, "record"), (rate_limiter.buckets, "take"),
+        ]:
+            def recorded(*args, call=getattr(backend, name), **kwargs):
+                threads.append(threading.current_thread())
+                return call(*args, **kwargs)
+            monkeypatch.setattr(backend, name, recorded)
+        tasks.send_message_batch(message_ids)
+
+        assert provider.requests == 4
+        assert len(threads) == 12 and threading.main_thread() not in threads
+
+    def test_failures(self, client, provider, monkeypatch):
+        message_ids = self.queue_batch(client, 2)
+
+        provider.error_rate = 1.0
+        tasks.send_message_batch(message_ids[:1])
+        status = Message.objects.get(id=message_ids[0]).outbound_status
+        assert status.next_attempt_at is not None
+        assert not status.error_message
+
+        monkeypatch.setattr(tasks, "send_messages", lambda messages, concurrency: [integrations.ProviderResponse(400)])
+        tasks.send_message_batch(message_ids[1:])
+        status = Message.objects.get(id=message_ids[1]).outbound_status
+        assert not status.send_success
+        assert status.error_message == "Failed with status code 400"
+
+    def test_retry_after_date(self, client, monkeypatch):
+        message_ids = self.queue_batch(client, 2)
+        retry_at = timezone.now() + timedelta(seconds=120)
+        responses = {
+            message_ids[0]: integrations.ProviderResponse(429, {"Retry-After": retry_at.strftime("%a, %d %b %Y %H:%M:%S GMT")}),
+            message_ids[1]: integrations.ProviderResponse(202),
+        }
+        monkeypatch.setattr(tasks, "send_messages", lambda messages, concurrency: [responses[m.id] for m in messages])
+        tasks.send_message_batch(message_ids)
+
+        throttled, sent = [Message.objects.get(id=id).outbound_status for id in message_ids]
+        assert throttled.state == "retrying"
+        assert throttled.next_attempt_at >= retry_at - timedelta(seconds=1)
+        assert sent.state == "sent"
+
+    def test_bad_response_does_not_hold_up_the_batch(self, client, monkeypatch):
+        message_ids = self.queue_batch(client, 2)
+        responses = {message_ids[0]: None, message_ids[1]: integrations.ProviderResponse(202)}
+        monkeypatch.setattr(tasks, "send_messages", lambda messages, concurrency: [responses[m.id] for m in messages])
+        tasks.send_message_batch(message_ids)
+
+        assert [Message.objects.get(id=id).outbound_status.state for id in message_ids] == ["retrying", "sent"]
+
+    def test_pending_skips_attempted_messages(self, client, provider):
+        message_ids = self.queue_batch(client, 3)
+        tasks.send_message_batch(message_ids[:1])
+
+        assert tasks.send_pending_messages() == 2
+        assert tasks.send_pending_messages() == 0
+        assert provider.requests == 3
+
+    def test_batch_endpoint_queues_one_task_per_chunk(self, client, settings, django_capture_on_commit_callbacks, monkeypatch):
+        settings.API_SEND_BATCH_SIZE = 2
+        queued = PublishedSends()
+        monkeypatch.setattr(tasks.send_message_batch, "apply_async", queued.apply_async)
+        with django_capture_on_commit_callbacks(execute=True):
+            self.queue_batch(client, 5)
+
+        assert [len(chunk) for chunk in queued] == [2, 2, 1]
+
+
+class TestRateLimiter:
+    @pytest.fixture
+    def limiter(self, monkeypatch):
+        limiter = ProviderRateLimiter(LocalBuckets(), {"sms": {"rate": 100, "burst": 2}}, max_wait=0.5)
+        monkeypatch.setattr(integrations, "rate_limiter", limiter)
+        return limiter
+
+    def test_token_bucket(self, limiter):
+        assert limiter.take("sms") == 0
+        assert limiter.take("sms") == 0
+        assert 0 < limiter.take("sms") <= 0.01
+        # waits for the next token rather than failing
+        assert limiter.acquire("sms") is None
+        assert limiter.take("email") == 0
+
+    def test_pause(self, limiter):
+        limiter.pause("sms", 5)
+        assert 4 < limiter.acquire("sms") <= 5
+        state = limiter.state()["sms"]
+        assert state["throttled"] == 1
+        assert 4 < state["paused_for"] <= 5
+
+    def test_provider_429_pauses_every_send(self, limiter, settings, mock_provider, monkeypatch):
+        settings.API_PROVIDERS = {**settings.API_PROVIDERS, "sms": {"url": mock_provider.url, "api_key": ""}}
+        monkeypatch.setattr(integrations, "_clients", {})
+        mock_provider.throttle_rate = 1.0
+        mock_provider.retry_after = 30
+        provider = integrations.get_client("sms")
+
+        assert provider.send({"body": "hi"}).status_code == 429
+        response = provider.send({"body": "hi"})
+
+        # the second send never reached the provider
+        assert mock_provider.requests == 1
+        assert response.status_code == 429
+        assert 29 <= int(response.headers["Retry-After"]) <= 30
+
+    def test_throttled_send_keeps_its_attempts(self, client, settings, monkeypatch):
+        settings.API_RETRY_JITTER = 0
+        monkeypatch.setattr(tasks, "send_sms", lambda message: integrations.ProviderResponse.throttled(12))
+        response = post_json(client, "/api/messages/sms", sms_payload())
+
+        assert response.status_code == 429
+        status = MessageStatus.objects.get()
+        assert 11 < seconds_until_retry(status) <= 12
+        assert status.send_attempts == 0
+
+    def test_metrics(self, client):
+        rate_limiter.pause("email", 60)
+        response = client.get("/api/metrics/")
+
+        assert response.status_code == 200
+        rate_limits = response.json()["rate_limits"]
+        assert rate_limits["email"]["throttled"] == 1
+        assert rate_limits["sms"]["paused_for"] == 0
+
+
+class TestCircuitBreaker:
+    @pytest.fixture
+    def breaker(self, monkeypatch):
+        breaker = CircuitBreaker(LocalBreakers(), ["sms"], threshold=2, open_seconds=0.05, probe_timeout=5)
+        monkeypatch.setattr(integrations, "circuit_breaker", breaker)
+        return breaker
+
+    def test_opens_after_consecutive_failures(self, breaker):
+        breaker.record("sms", success=False)
+        breaker.record("sms", success=True)
+        breaker.record("sms", success=False)
+        assert breaker.allow("sms") is None
+
+        breaker.record("sms", success=False)
+        assert 0 < breaker.allow("sms") <= 0.05
+        assert breaker.state()["sms"]["state"] == "open"
+        assert breaker.state()["sms"]["opens"] == 1
+
+    def test_half_open_probe(self, breaker):
+        breaker.record("sms", success=False)
+        breaker.record("sms", success=False)
+        time.sleep(0.05)
+
+        assert breaker.state()["sms"]["state"] == "half_open"
+        assert breaker.allow("sms") is None
+        # only the one probe
+        assert 4 < breaker.allow("sms") <= 5
+
+        breaker.record("sms", success=True)
+        assert breaker.state()["sms"]["state"] == "closed"
+        assert breaker.allow("sms") is None
+
+    def test_failed_probe_reopens(self, breaker):
+        breaker.record("sms", success=False)
+        breaker.record("sms", success=False)
+        time.sleep(0.05)
+        assert breaker.allow("sms") is None
+
+        breaker.record("sms", success=False)
+        assert breaker.allow("sms") is not None
+        assert breaker.state()["sms"]["opens"] == 2
+
+    def test_open_circuit_skips_the_provider(self, breaker, settings, mock_provider, monkeypatch):
+        settings.API_PROVIDERS = {**settings.API_PROVIDERS, "sms": {"url": mock_provider.url, "api_key": ""}}
+        monkeypatch.setattr(integrations, "_clients", {})
+        mock_provider.error_rate = 1.0
+        provider = integrations.get_client("sms")
+
+        responses = [provider.send({"body": "hi"}) for _ in range(4)]
+
+        assert mock_provider.requests == 2
+        assert [response.status_code for response in responses] == [503] * 4
+        assert [response.sent for response in responses] == [True, True, False, False]
+        assert responses[-1].headers["Retry-After"] == "1"
+
+    def test_deferred_send_keeps_its_attempts(self, client, settings, monkeypatch):
+        settings.API_RETRY_JITTER = 0
+        monkeypatch.setattr(tasks, "send_sms", lambda message: integrations.ProviderResponse.circuit_open(20))
+        post_json(client, "/api/messages/sms", sms_payload())
+
+        status = MessageStatus.objects.get()
+        assert 19 < seconds_until_retry(status) <= 20
+        assert status.send_attempts == 0
+
+    def test_metrics(self, client):
+        response = client.get("/api/metrics/")
+        assert response.json()["circuit_breakers"]["sms"]["state"] == "closed"
+
+
+class TestRetryPump:
+    @pytest.fixture
+    def queued(self, monkeypatch):
+        queued = PublishedSends()
+        monkeypatch.setattr(tasks.send_message_batch, "apply_async", queued.apply_async)
+        return queued
+
+    def failed_send(self, client, monkeypatch, type="sms", **kwargs):
+        monkeypatch.setattr(tasks, f"send_{type}", lambda message: integrations.ProviderResponse(503))
+        payload = email_payload(**kwargs) if type == "email" else sms_payload(**kwargs)
+        post_json(client, f"/api/messages/{type}", payload)
+        return Message.objects.latest("id")
+
+    def test_backoff_is_jittered(self, client, settings, monkeypatch):
+        settings.API_RETRY_JITTER = 0.5
+        delays = set()
+        for i in range(5):
+            message = self.failed_send(client, monkeypatch, **{"from": f"+1201666{i:04}"})
+            delays.add(round(seconds_until_retry(message.outbound_status), 1))
+
+        # 6s backoff after the first attempt, stretched by up to half
+        assert all(5.9 <= delay <= 9 for delay in delays)
+        assert len(delays) > 1
+
+    def test_pump_queues_due_retries(self, client, monkeypatch, queued):
+        message = self.failed_send(client, monkeypatch)
+        assert tasks.pump_retries() == 0
+
+        MessageStatus.objects.update(next_attempt_at=timezone.now())
+        assert tasks.pump_retries() == 1
+        assert queued == [[message.id]]
+        # leased until the send claims it
+        assert seconds_until_retry(MessageStatus.objects.get()) > 60
+        assert tasks.pump_retries() == 0
+
+        monkeypatch.setattr(tasks, "send_messages", lambda messages, concurrency: [integrations.ProviderResponse(200)])
+        tasks.send_message_batch(queued[0])
+        status = MessageStatus.objects.get()
+        assert status.send_success
+        assert status.next_attempt_at is None
+        assert status.send_attempts == 2
+
+    def test_per_provider_budget(self, client, settings, monkeypatch, queued):
+        settings.API_RETRY_BUDGET = {"sms": 2, "email": 2}
+        for i in range(3):
+            self.failed_send(client, monkeypatch, **{"from": f"+1201666{i:04}"})
+        self.failed_send(client, monkeypatch, type="email")
+        MessageStatus.objects.update(next_attempt_at=timezone.now())
+
+        assert tasks.pump_retries() == 3
+        # the sms retry over budget waits for the next run
+        assert tasks.pump_retries() == 1
+        assert tasks.pump_retries() == 0
+
+    def test_gives_up_after_max_attempts(self, client, monkeypatch):
+        message = self.failed_send(client, monkeypatch)
+        for _ in range(tasks.MAX_SEND_ATTEMPTS - 1):
+            tasks.attempt_send_message(message.id)
+
+        status = MessageStatus.objects.get()
+        assert status.send_attempts == tasks.MAX_SEND_ATTEMPTS
+        assert status.error_message == f"Failed after {tasks.MAX_SEND_ATTEMPTS} attempts"
+        assert status.next_attempt_at is None
+
+    def test_lost_on_last_attempt_is_a_dead_letter(self, client, monkeypatch, queued):
+        message = self.failed_send(client, monkeypatch)
+        MessageStatus.objects.update(
+            state="sending", send_attempts=tasks.MAX_SEND_ATTEMPTS, next_attempt_at=timezone.now() - timedelta(seconds=1),
+        )
+
+        assert tasks.pump_retries() == 0
+        assert queued == []
+        status = MessageStatus.objects.get()
+        assert (status.state, status.next_attempt_at) == ("failed", None)
+        dead_letter = DeadLetter.objects.get()
+        assert (dead_letter.message_id, dead_letter.reason) == (message.id, f"Failed after {tasks.MAX_SEND_ATTEMPTS} attempts")
+
+    def test_lost_with_attempts_left_is_queued(self, client, monkeypatch, queued):
+        message = self.failed_send(client, monkeypatch)
+        MessageStatus.objects.update(state="sending", next_attempt_at=timezone.now() - timedelta(seconds=1))
+
+        assert tasks.pump_retries() == 1
+        assert queued == [[message.id]]
+        assert not DeadLetter.objects.exists()
+
+
+class TestSendStateMachine:
+    @pytest.fixture
+    def status(self, client, settings, django_capture_on_commit_callbacks):
+        settings.API_ASYNC_SEND = True
+        post_json(client, "/api/messages/sms", sms_payload())
+        return MessageStatus.objects.get()
+
+    def test_claim_is_exclusive(self, status):
+        claimed = MessageStatus.objects.claim([status.id], lease=60)
+        assert [(s.id, s.state, s.send_attempts) for s in claimed] == [(status.id, "sending", 1)]
+        # a redelivered task finds nothing to claim
+        assert MessageStatus.objects.claim([status.id], lease=60) == []
+
+    def test_expired_lease_can_be_reclaimed(self, status):
+        MessageStatus.objects.claim([status.id], lease=60)
+        MessageStatus.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        [claimed] = MessageStatus.objects.claim([status.id], lease=60)
+        assert claimed.send_attempts == 2
+
+    def test_finish_only_applies_to_the_claimed_attempt(self, status):
+        [first] = MessageStatus.objects.claim([status.id], lease=0)
+        [second] = MessageStatus.objects.claim([status.id], lease=60)
+
+        first.succeed(202)
+        assert MessageStatus.objects.finish([first]) == set()
+        second.fail("Failed with status code 400", 400)
+        assert MessageStatus.objects.finish([second]) == {status.id}
+
+        status.refresh_from_db()
+        assert (status.state, status.send_attempts, status.send_success) == ("failed", 2, False)
+
+    def test_max_attempts(self, status):
+        MessageStatus.objects.update(send_attempts=tasks.MAX_SEND_ATTEMPTS)
+        assert MessageStatus.objects.claim([status.id], max_attempts=tasks.MAX_SEND_ATTEMPTS) == []
+
+    def test_send_is_two_narrow_updates(self, status):
+        message = Message.objects.get()
+        with CaptureQueriesContext(connection) as context:
+            tasks.attempt_send_message(message.id)
+
+        writes = [query["sql"].lstrip() for query in context.captured_queries if not query["sql"].startswith(("SELECT", "SAVEPOINT", "RELEASE"))]
+        assert len(writes) == 2
+        assert all(write.startswith("UPDATE api_messagestatus") for write in writes)
+        status.refresh_from_db()
+        assert (status.state, status.send_attempts, status.last_http_status_code) == ("sent", 1, 200)
+
+        tasks.attempt_send_message(message.id)
+        status.refresh_from_db()
+        assert status.send_attempts == 1
+
+    def test_status_endpoint_reports_retrying(self, client, status, monkeypatch):
+        monkeypatch.setattr(tasks, "send_sms", lambda message: integrations.ProviderResponse(502))
+        tasks.attempt_send_message(Message.objects.get().id)
+
+        response = client.get(f"/api/messages/{Message.objects.get().id}/status/").json()
+        assert response["state"] == "retrying"
+        assert response["send_attempts"] == 1
+
+
+class TestProviderBatches:
+    @pytest.fixture
+    def provider(self, settings, mock_provider, monkeypatch):
+        settings.API_PROVIDERS = {
+            **settings.API_PROVIDERS,
+            "sms": {"url": mock_provider.url, "batch_url": mock_provider.url + "/batch", "batch_size": 4},
+        }
+        monkeypatch.setattr(integrations, "_clients", {})
+        return mock_provider
+
+    def queue(self, client, senders):
+        batch = [sms_payload(**{"from": sender, "to": f"+1804555{i:04}"}) for i, sender in enumerate(senders)]
+        return [result["message_id"] for result in post_json(client, "/api/messages/batch/", batch).json()["results"]]
+
+    def test_groups_by_sender_into_provider_sized_batches(self, client, provider):
+        message_ids = self.queue(client, ["+12016661234"] * 10 + ["+12016665678"])
+        tasks.send_message_batch(message_ids)
+
+        # 4 + 4 + 2 from the first sender, a single send for the second
+        assert provider.requests == 4
+        assert MessageStatus.objects.filter(state="sent", last_http_status_code=202).count() == 11
+
+    def test_per_recipient_results(self, client, provider):
+        provider.recipient_error_rate = 1.0
+        tasks.send_message_batch(self.queue(client, ["+12016661234"] * 3))
+
+        assert provider.requests == 1
+        assert set(MessageStatus.objects.values_list("state", "error_message")) == {("failed", "Failed with status code 400")}
+
+    def test_failed_call_fails_each_message(self, client, provider):
+        provider.error_rate = 1.0
+        tasks.send_message_batch(self.queue(client, ["+12016661234"] * 3))
+
+        assert provider.requests == 1
+        assert set(MessageStatus.objects.values_list("state", "last_http_status_code")) == {("retrying", 503)}
+
+    def test_batch_responses(self):
+        call = integrations.ProviderCall(None, {}, [0, 1, 2], batch=True)
+        response = httpx.Response(202, json={"results": [{"status": 202}, {"status": 400}]})
+
+        # the missing third result was accepted with the batch
+        assert [r.status_code for r in integrations.batch_responses(call, response)] == [202, 400, 202]
+
+        response = httpx.Response(202, json={"results": ["accepted", {"status": "400"}, {"status": 400}]})
+        assert [r.status_code for r in integrations.batch_responses(call, response)] == [202, 202, 400]
+
+    def test_malformed_batch_results(self, client, provider, monkeypatch):
+        async def post(self, url, json=None, **kwargs):
+            return httpx.Response(202, json={"results": ["accepted"] * len(json["messages"])})
+        monkeypatch.setattr(httpx.AsyncClient, "post", post)
+        tasks.send_message_batch(self.queue(client, ["+12016661234"] * 3))
+
+        assert list(MessageStatus.objects.values_list("state", "send_attempts")) == [("sent", 1)] * 3
+
+    def test_failing_call_does_not_lose_the_others(self, client, settings, provider, monkeypatch):
+        settings.API_PROVIDERS = {**settings.API_PROVIDERS, "email": {"url": provider.url, "api_key": ""}}
+        monkeypatch.setattr(integrations, "_clients", {})
+        allow = circuit_breaker.breakers.allow
+        def redis_down_for_email(name, *args, **kwargs):
+            if name == "email":
+                raise ConnectionError("redis down")
+            return allow(name, *args, **kwargs)
+        monkeypatch.setattr(circuit_breaker.breakers, "allow", redis_down_for_email)
+        sms_ids = self.queue(client, ["+12016661234"] * 2)
+        email_id = post_json(client, "/api/messages/batch/", [email_payload()]).json()["results"][0]["message_id"]
+        tasks.send_message_batch(sms_ids + [email_id])
+
+        assert [Message.objects.get(id=id).outbound_status.state for id in sms_ids] == ["sent", "sent"]
+        email = Message.objects.get(id=email_id).outbound_status
+        assert (email.state, email.send_attempts) == ("retrying", 0)
+
+
+class TestOutbox:
+    @pytest.fixture
+    def published(self, monkeypatch):
+        published = PublishedSends()
+        monkeypatch.setattr(tasks.send_message_batch, "apply_async", published.apply_async)
+        return published
+
+    def test_published_after_commit(self, client, published, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks() as callbacks:
+            message_ids = [result["message_id"] for result in post_json(client, "/api/messages/batch/", [
+                sms_payload(), email_payload(),
+            ]).json()["results"]]
+        # written with the messages, nothing is published before the commit
+        assert sorted(OutboxEntry.objects.values_list("message_id", flat=True)) == sorted(message_ids)
+        assert published == []
+
+        for callback in callbacks:
+            callback()
+        assert published == [message_ids]
+        # kept until the send claims them
+        assert not OutboxEntry.objects.due().exists()
+        tasks.send_message_batch(message_ids)
+        assert not OutboxEntry.objects.exists()
+
+    def test_lost_task_is_published_again(self, client, settings, published, monkeypatch, django_capture_on_commit_callbacks):
+        settings.API_ASYNC_SEND = True
+        with django_capture_on_commit_callbacks(execute=True):
+            message_id = post_json(client, "/api/messages/sms", sms_payload()).json()["message_id"]
+        assert published == [[message_id]]
+        assert tasks.relay_outbox() == (0, 0)
+
+        OutboxEntry.objects.update(next_relay_at=timezone.now() - timedelta(seconds=1))
+        assert tasks.relay_outbox()[0] == 1
+        assert published == [[message_id], [message_id]]
+
+        monkeypatch.setattr(tasks, "send_messages", lambda messages, concurrency: [integrations.ProviderResponse(202)])
+        tasks.send_message_batch([message_id])
+        assert not OutboxEntry.objects.exists()
+        assert MessageStatus.objects.get().state == "sent"
+
+    def test_republishing_backs_off(self, client, settings, published, django_capture_on_commit_callbacks):
+        # a bulk send queued behind a backlog that takes longer than the lease to drain
+        with django_capture_on_commit_callbacks(execute=True):
+            post_json(client, "/api/messages/batch/", [sms_payload()])
+        lease = timedelta(seconds=settings.API_OUTBOX_RELAY_LEASE)
+        OutboxEntry.objects.update(next_relay_at=F("next_relay_at") - lease)
+        assert tasks.relay_outbox()[0] == 1
+        assert len(published) == 2
+
+        # published again, the next relay a lease later is still inside the doubled window
+        OutboxEntry.objects.update(next_relay_at=F("next_relay_at") - lease)
+        assert tasks.relay_outbox() == (0, 0)
+        assert len(published) == 2
+        assert OutboxEntry.objects.get().relays == 2
+
+    def test_relay_picks_up_what_the_request_could_not_publish(self, client, settings, monkeypatch, django_capture_on_commit_callbacks):
+        settings.API_ASYNC_SEND = True
+        def broker_down(args=None, **options):
+            raise ConnectionError("broker down")
+        monkeypatch.setattr(tasks.send_message_batch, "apply_async", broker_down)
+        with django_capture_on_commit_callbacks(execute=True):
+            response = post_json(client, "/api/messages/sms", sms_payload())
+
+        assert response.status_code == 202
+        assert OutboxEntry.objects.count() == 1
+
+        published = PublishedSends()
+        monkeypatch.setattr(tasks.send_message_batch, "apply_async", published.apply_async)
+        OutboxEntry.objects.update(created_at=timezone.now() - timedelta(seconds=30))
+        assert 29 < OutboxEntry.objects.lag() < 31
+        assert tasks.relay_outbox() == (1, 0)
+        assert published == [[response.json()["message_id"]]]
+
+    def test_relay_batches(self, client, settings, published, django_capture_on_commit_callbacks):
+        settings.API_SEND_BATCH_SIZE = 2
+        with django_capture_on_commit_callbacks():
+            post_json(client, "/api/messages/batch/", [sms_payload(**{"from": f"+1201666{i:04}"}) for i in range(5)])
+
+        relayed, lag = tasks.relay_outbox(limit=3)
+        assert relayed == 3
+        assert lag > 0
+        assert [len(chunk) for chunk in published] == [2, 1]
+        assert OutboxEntry.objects.due().count() == 2
+
+    def test_metrics(self, client, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks():
+            post_json(client, "/api/messages/batch/", [sms_payload()])
+        assert client.get("/api/metrics/").json()["outbox"]["waiting"] == 1
+
+
+class TestDeadLetters:
+    def failed_send(self, client, monkeypatch, status_code=400, type="sms", **kwargs):
+        monkeypatch.setattr(tasks, f"send_{type}", lambda message: integrations.ProviderResponse(status_code))
+        payload = email_payload(**kwargs) if type == "email" else sms_payload(**kwargs)
+        post_json(client, f"/api/messages/{type}", payload)
+        return Message.objects.latest("id")
+
+    def test_given_up_sends_become_dead_letters(self, client, monkeypatch):
+        message = self.failed_send(client, monkeypatch)
+        self.failed_send(client, monkeypatch, status_code=202, to="+18045550000")
+
+        [dead_letter] = DeadLetter.objects.all()
+        assert (dead_letter.message_id, dead_letter.type, dead_letter.reason, dead_letter.http_status_code) == (
+            message.id, "sms", "Failed with status code 400", 400,
+        )
+
+    def test_out_of_attempts_is_a_dead_letter(self, client, monkeypatch):
+        message = self.failed_send(client, monkeypatch, status_code=503)
+        MessageStatus.objects.update(send_attempts=tasks.MAX_SEND_ATTEMPTS - 1, next_attempt_at=timezone.now())
+        monkeypatch.setattr(tasks, "send_messages", lambda messages, concurrency: [integrations.ProviderResponse(503)])
+        tasks.send_message_batch([message.id])
+
+        assert DeadLetter.objects.get().reason == f"Failed after {tasks.MAX_SEND_ATTEMPTS} attempts"
+
+    def test_list_filters(self, client, monkeypatch):
+        sms = self.failed_send(client, monkeypatch)
+        self.failed_send(client, monkeypatch, status_code=401, to="+18045550000")
+        email = self.failed_send(client, monkeypatch, type="email")
+
+        def listed(**params):
+            response = client.get("/api/dead-letters/", params)
+            return [dead_letter["message_id"] for dead_letter in response.json()["dead_letters"]]
+
+        assert len(listed()) == 3
+        assert listed(provider="email") == [email.id]
+        assert listed(provider="sms", status_code=400) == [sms.id]
+        assert listed(since=(timezone.now() + timedelta(minutes=1)).isoformat()) == []
+        assert client.get("/api/dead-letters/", {"provider": "fax"}).status_code == 400
+
+    def test_requeue(self, client, monkeypatch):
+        sms = self.failed_send(client, monkeypatch)
+        email = self.failed_send(client, monkeypatch, type="email")
+
+        response = post_json(client, "/api/dead-letters/requeue/", {"provider": "sms"})
+        assert response.json() == {"requeued": 1}
+        assert list(DeadLetter.objects.values_list("message_id", flat=True)) == [email.id]
+
+        status = MessageStatus.objects.get(message=sms)
+        assert (status.state, status.send_attempts, status.error_message) == ("retrying", 0, "")
+        queued = PublishedSends()
+        monkeypatch.setattr(tasks.send_message_batch, "apply_async", queued.apply_async)
+        assert tasks.pump_retries() == 1
+        assert queued == [[sms.id]]
+
+    def test_requeue_in_chunks(self, client, monkeypatch):
+        for i in range(5):
+            self.failed_send(client, monkeypatch, to=f"+1804555{i:04}")
+
+        with CaptureQueriesContext(connection) as context:
+            assert DeadLetter.objects.all().requeue(chunk_size=2, limit=4) == 4
+        # two set-based statements a chunk, however many are in it
+        updates = [query for query in context.captured_queries if query["sql"].startswith("UPDATE")]
+        assert len(updates) == 2
+        assert DeadLetter.objects.count() == 1
+        assert MessageStatus.objects.filter(state="retrying").count() == 4
+
+    def test_command(self, client, monkeypatch, capsys):
+        self.failed_send(client, monkeypatch)
+        self.failed_send(client, monkeypatch, status_code=401, to="+18045550000")
+
+        call_command("requeue_dead_letters", "--dry-run")
+        assert "2 dead letters would be requeued" in capsys.readouterr().out
+        assert DeadLetter.objects.count() == 2
+
+        call_command("requeue_dead_letters", "--status-code", "401")
+        assert "Requeued 1 dead letters" in capsys.readouterr().out
+        assert DeadLetter.objects.get().http_status_code == 400
+
+
+class TestPriorityLanes:
+    @pytest.fixture
+    def published(self, monkeypatch):
+        published = PublishedSends()
+        monkeypatch.setattr(tasks.send_message_batch, "apply_async", published.apply_async)
+        return published
+
+    def test_batches_are_bulk_unless_tagged(self, client, settings, published, django_capture_on_commit_callbacks):
+        with django_capture_on_commit_callbacks(execute=True):
+            results = post_json(client, "/api/messages/batch/", [
+                sms_payload(), sms_payload(to="+18045550000", priority="transactional"),
+            ]).json()["results"]
+
+        assert sorted(published) == [[results[0]["message_id"]], [results[1]["message_id"]]]
+        queues = dict(zip([chunk[0] for chunk in published], published.queues))
+        assert queues == {
+            results[0]["message_id"]: settings.API_SEND_QUEUES["bulk"],
+            results[1]["message_id"]: settings.API_SEND_QUEUES["transactional"],
+        }
+        assert MessageStatus.objects.get(message=results[0]["message_id"]).priority == "bulk"
+
+    def test_single_sends_are_transactional(self, client, settings, published, django_capture_on_commit_callbacks):
+        settings.API_ASYNC_SEND = True
+        with django_capture_on_commit_callbacks(execute=True):
+            message_id = post_json(client, "/api/messages/sms", sms_payload()).json()["message_id"]
+
+        assert published.queues == [settings.API_SEND_QUEUES["transactional"]]
+        assert client.get(f"/api/messages/{message_id}/status/").json()["priority"] == "transactional"
+
+    def test_invalid_priority(self, client):
+        response = post_json(client, "/api/messages/sms", sms_payload(priority="urgent"))
+        assert response.status_code == 400
+        assert post_json(client, "/api/messages/batch/", [sms_payload(priority="urgent")]).json()["results"][0]["status"] == 400
+
+    def test_retries_stay_in_their_lane_transactional_first(self, client, settings, monkeypatch, published):
+        settings.API_RETRY_BUDGET = {"sms": 2, "email": 2}
+        monkeypatch.setattr(tasks, "send_sms", lambda message: integrations.ProviderResponse(503))
+        post_json(client, "/api/messages/batch/", [sms_payload(to=f"+1804555{i:04}") for i in range(2)])
+        post_json(client, "/api/messages/sms", sms_payload(to="+18045559999"))
+        transactional = Message.objects.latest("id")
+        monkeypatch.setattr(tasks, "send_messages", lambda messages, concurrency: [integrations.ProviderResponse(503)] * len(messages))
+        tasks.send_pending_messages()
+        MessageStatus.objects.update(next_attempt_at=timezone.now())
+
+        assert tasks.pump_retries() == 2
+        assert published[0] == [transactional.id]
+        assert published.queues == [settings.API_SEND_QUEUES["transactional"], settings.API_SEND_QUEUES["bulk"]]
+        assert len(published[1]) == 1
+
+
+class TestBodyStorage:
+    @pytest.fixture(autouse=True)
+    def thresholds(self, settings, monkeypatch, tmp_path):
+        settings.API_BODY_INLINE_MAX_BYTES = 100
+        settings.API_BODY_BLOB_MIN_BYTES = 200
+        monkeypatch.setattr(body_store, "storage", FileSystemStorage(location=tmp_path))
+        return tmp_path
+
+    def send(self, client, body, type="email"):
+        payload = email_payload(body=body) if type == "email" else sms_payload(body=body)
+        post_json(client, f"/api/messages/{type}", payload)
+        return Message.objects.latest("id")
+
+    def test_tiers(self, client, thresholds):
+        small = self.send(client, "Hello <b>there</b>")
+        html = self.send(client, "<p>Hello&nbsp;<b>there</b></p>\n" * 20)
+        large = self.send(client, secrets.token_hex(400), type="sms")
+
+        assert [message.body_storage for message in (small, html, large)] == ["inline", "zlib", "blob"]
+        assert html.inline_body == "" and large.body_compressed is None
+        assert list(thresholds.rglob(large.body_blob))
+        assert html.body_preview.startswith("Hello there Hello there")
+        for message in (small, html, large):
+            body = message.body
+            assert Message.objects.get(id=message.id).body == body
+
+    def test_same_body_is_stored_once(self, client, thresholds):
+        body = secrets.token_hex(400)
+        first, second = self.send(client, body, type="sms"), self.send(client, body, type="sms")
+        assert first.body_blob == second.body_blob
+        assert len([path for path in thresholds.rglob("*") if path.is_file()]) == 1
+
+    def test_listing_leaves_big_bodies_behind(self, client):
+        self.send(client, "short")
+        message = self.send(client, "<p>long</p>" * 50)
+
+        with CaptureQueriesContext(connection) as context:
+            messages = client.get(f"/api/conversations/{message.conversation_id}/messages/").json()["messages"]
+        assert not any("body_compressed" in query["sql"] for query in context.captured_queries)
+        assert sorted((m["id"], m["body"], m["body_preview"][:9]) for m in messages) == [
+            (message.id - 1, "short", "short"), (message.id, None, "longlongl"),
+        ]
+
+        response = client.get(f"/api/messages/{message.id}/body/").json()
+        assert response["body"] == "<p>long</p>" * 50
+
+    def test_sends_the_full_body(self, client):
+        message = self.send(client, secrets.token_hex(400), type="sms")
+        message = Message.objects.select_related("from_participant", "to_participant").get(id=message.id)
+        assert integrations.message_payload(message)["body"] == message.body
+        assert len(message.body) == 800
+
+    def test_offload_existing_bodies(self, client):
+        message = self.send(client, "short")
+        Message.objects.filter(id=message.id).update(inline_body="x" * 500)
+
+        call_command("offload_message_bodies")
+        message = Message.objects.get(id=message.id)
+        assert (message.body_storage, message.inline_body, message.body) == ("zlib", "", "x" * 500)
+
+
+class TestAdditionalDataFilter:
+    @pytest.fixture
+    def messages(self, client):
+        post_json(client, "/api/messages/batch/", [
+            email_payload(xillio_id="abc", campaign="spring"),
+            email_payload(xillio_id="def", campaign="spring"),
+            email_payload(xillio_id="ghi", campaign="spring", attempt=2),
+            sms_payload(xillio_id="abc"),
+        ])
+        return {message.additional_data.get("xillio_id") + message.type: message for message in Message.objects.all()}
+
+    def test_conversation_messages(self, client, messages):
+        conversation_id = messages["abcemail"].conversation_id
+        url = f"/api/conversations/{conversation_id}/messages/"
+
+        def ids(params):
+            return sorted(message["id"] for message in client.get(url, params).json()["messages"])
+
+        assert ids({"data": json.dumps({"xillio_id": "abc"})}) == [messages["abcemail"].id]
+        assert ids({"data.campaign": "spring", "cursor": ""}) == sorted(
+            messages[key].id for key in ("abcemail", "defemail", "ghiemail")
+        )
+        assert ids({"data": json.dumps({"attempt": 2}), "data.campaign": "spring"}) == [messages["ghiemail"].id]
+        assert client.get(url, {"data": "[1]"}).status_code == 400
+
+    def test_across_conversations(self, client, messages):
+        response = client.get("/api/messages/", {"data.xillio_id": "abc"}).json()
+        assert sorted(message["id"] for message in response["messages"]) == sorted(
+            [messages["abcemail"].id, messages["abcsms"].id]
+        )
+        assert response["messages"][0]["additional_data"]["xillio_id"] == "abc"
+        assert client.get("/api/messages/").status_code == 400
+
+
+class TestSearch:
+    @pytest.fixture
+    def messages(self, client):
+        post_json(client, "/api/messages/batch/", [
+            sms_payload(body="Your refund for order 123 is on its way", timestamp="2024-11-01T14:00:00Z"),
+            sms_payload(body="Refunds: we refunded the refund twice", to="+18045550000", timestamp="2024-11-02T14:00:00Z"),
+            email_payload(body='<p class="refunded">Hello <b>world</b></p>', timestamp="2024-11-03T14:00:00Z"),
+            sms_payload(body="Unrelated", timestamp="2024-11-04T14:00:00Z"),
+        ])
+        return list(Message.objects.order_by("timestamp"))
+
+    def search(self, client, **params):
+        return client.get("/api/search/", params).json()
+
+    def test_ranked(self, client, messages):
+        # both words beats one
+        results = self.search(client, q="refund or order")["messages"]
+        assert [result["id"] for result in results] == [messages[0].id, messages[1].id]
+        assert results[0]["rank"] > results[1]["rank"]
+
+    def test_html_is_stripped(self, client, messages):
+        assert [result["id"] for result in self.search(client, q="world")["messages"]] == [messages[2].id]
+        # only in the markup
+        assert [result["id"] for result in self.search(client, q="refund", type="email")["messages"]] == []
+
+    def test_filters(self, client, messages):
+        def ids(**params):
+            return [result["id"] for result in self.search(client, q="refund", **params)["messages"]]
+
+        assert ids(participant="+18045550000") == [messages[1].id]
+        assert ids(participant="+19999999999") == []
+        assert ids(type="sms", since="2024-11-01T15:00:00Z") == [messages[1].id]
+        assert ids(until="2024-11-02T00:00:00Z") == [messages[0].id]
+        assert client.get("/api/search/").status_code == 400
+        assert client.get("/api/search/", {"q": "refund", "since": "yesterday"}).status_code == 400
+
+    def test_cursor_pagination(self, client, messages, monkeypatch):
+        monkeypatch.setattr(views, "SEARCH_PAGE_SIZE", 1)
+        seen, cursor = [], ""
+        while cursor is not None:
+            page = self.search(client, q="refund", cursor=cursor)
+            seen += [result["id"] for result in page["messages"]]
+            cursor = page["next_cursor"]
+        assert seen == [messages[1].id, messages[0].id]
+        assert client.get("/api/search/", {"q": "refund", "cursor": "nope"}).status_code == 400
+
+    def test_bodies_stored_out_of_line_are_searchable(self, client, settings, monkeypatch, tmp_path):
+        settings.API_BODY_INLINE_MAX_BYTES = 10
+        settings.API_BODY_BLOB_MIN_BYTES = 10
+        monkeypatch.setattr(body_store, "storage", FileSystemStorage(location=tmp_path))
+        post_json(client, "/api/messages/sms", sms_payload(body=f"tracking {secrets.token_hex(40)} parcel"))
+
+        message = Message.objects.get()
+        assert message.body_storage == "blob"
+        assert [result["id"] for result in self.search(client, q="parcel")["messages"]] == [message.id]
+
+
+class TestPartitions:
+    @pytest.fixture
+    def messages(self, client):
+        # sent, so each has a status and an outbox entry as well as its attachment
+        post_json(client, "/api/messages/batch/", [
+            sms_payload(body="november", attachments=["https://example.com/a.png"], timestamp="2024-11-15T14:00:00Z"),
+            sms_payload(body="december", attachments=["https://example.com/b.png"], timestamp="2024-12-15T14:00:00Z"),
+        ])
+        return list(Message.objects.order_by("timestamp"))
+
+    def partition_of(self, message):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT tableoid::regclass::text FROM api_message WHERE id = %s", [message.id])
+            return cursor.fetchone()[0]
+
+    def test_new_partition_takes_its_month_from_the_default(self, messages):
+        assert self.partition_of(messages[0]) == "api_message_default"
+
+        assert Message.objects.create_partitions([date(2024, 11, 20)]) == ["api_message_p2024_11"]
+        assert self.partition_of(messages[0]) == "api_message_p2024_11"
+        assert self.partition_of(messages[1]) == "api_message_default"
+        assert Message.objects.get(id=messages[0].id).body == "november"
+        assert Message.objects.create_partitions([date(2024, 11, 1)]) == []
+
+    def test_time_window_reads_only_its_months(self, client, messages):
+        Message.objects.create_partitions([date(2024, 11, 1), date(2024, 12, 1)])
+        plan = Message.objects.filter(timestamp__gte="2024-12-01T00:00:00Z", timestamp__lt="2024-12-20T00:00:00Z").explain()
+        assert "api_message_p2024_12" in plan
+        assert "api_message_p2024_11" not in plan
+        assert "api_message_default" not in plan
+
+        url = f"/api/conversations/{messages[0].conversation_id}/messages/"
+        listed = client.get(url, {"since": "2024-12-01T00:00:00Z", "until": "2025-01-01T00:00:00Z"}).json()["messages"]
+        assert [message["id"] for message in listed] == [messages[1].id]
+        assert client.get(url, {"until": "soon"}).status_code == 400
+
+    def test_drop_old_months(self, messages):
+        Message.objects.create_partitions([date(2024, 11, 1), date(2024, 12, 1)])
+
+        assert Message.objects.drop_partitions(date(2024, 12, 1)) == ["api_message_p2024_11"]
+        assert list(Message.objects.values_list("id", flat=True)) == [messages[1].id]
+        assert list(Attachment.objects.values_list("message_id", flat=True)) == [messages[1].id]
+        assert list(OutboxEntry.objects.values_list("message_id", flat=True)) == [messages[1].id]
+        assert list(MessageStatus.objects.values_list("id", flat=True)) == [messages[1].outbound_status_id]
+        assert Conversation.objects.get().message_count == 1
+        assert date(2024, 11, 1) not in Message.objects.partitions()
+
+    def test_drop_deletes_unreferenced_bodies(self, client, settings, monkeypatch, tmp_path):
+        settings.API_BODY_INLINE_MAX_BYTES = 100
+        settings.API_BODY_BLOB_MIN_BYTES = 200
+        monkeypatch.setattr(body_store, "storage", FileSystemStorage(location=tmp_path))
+        shared, dropped = secrets.token_hex(400), secrets.token_hex(400)
+        post_json(client, "/api/messages/batch/", [
+            sms_payload(body=shared, timestamp="2024-11-15T14:00:00Z"),
+            sms_payload(body=dropped, timestamp="2024-11-16T14:00:00Z"),
+            sms_payload(body=shared, timestamp="2024-12-15T14:00:00Z"),
+        ])
+        Message.objects.create_partitions([date(2024, 11, 1), date(2024, 12, 1)])
+
+        Message.objects.drop_partitions(date(2024, 12, 1))
+        kept = Message.objects.get()
+        assert [path.name for path in tmp_path.rglob("*") if path.is_file()] == [kept.body_blob]
+        assert kept.body == shared
+
+    def test_maintenance_task(self, settings, messages):
+        Message.objects.create_partitions([date(2024, 11, 1)])
+        settings.API_MESSAGE_RETENTION_MONTHS = 12
+
+        created, dropped = tasks.maintain_message_partitions()
+        assert dropped == ["api_message_p2024_11"]
+        this_month = timezone.now().date().replace(day=1)
+        assert add_months(this_month, settings.API_MESSAGE_PARTITION_MONTHS_AHEAD) in Message.objects.partitions()
+        # the default partition's messages aren't touched
+        assert list(Message.objects.values_list("id", flat=True)) == [messages[1].id]
@@ -4,10 +4,20 @@ from messaging_service.api import views
 urlpatterns = [
     path("messages/sms/", views.send_sms, name="send_sms"),
     path("messages/email/", views.send_email, name="send_email"),
+    path("messages/batch/", views.send_batch, name="send_batch"),
+    path("messages/", views.find_messages, name="find_messages"),
+    path("messages/<int:message_id>/status/", views.get_message_status, name="get_message_status"),
+    path("messages/<int:message_id>/body/", views.get_message_body, name="get_message_body"),
     path("webhooks/sms/", views.receive_sms, name="receive_sms"),
     path("webhooks/email/", views.receive_email, name="receive_email"),
+    path("webhooks/sms/batch/", views.receive_sms_batch, name="receive_sms_batch"),
+    path("webhooks/email/batch/", views.receive_email_batch, name="receive_email_batch"),
     path("conversations/", views.get_conversations, name="get_conversations"),
     path("conversations/<int:conversation_id>/messages/", views.get_messages, name="get_messages"),
+    path("search/", views.search_messages, name="search_messages"),
+    path("metrics/", views.get_metrics, name="get_metrics"),
+    path("dead-letters/", views.get_dead_letters, name="get_dead_letters"),
+    path("dead-letters/requeue/", views.requeue_dead_letters, name="requeue_dead_letters"),
 ]
 
 # Need this section because the reader's team didn't add trailing slashes to tests
@@ -15,8 +25,18 @@ urlpatterns = [
 urlpatterns += [
     path("messages/sms", views.send_sms, name="send_sms"),
     path("messages/email", views.send_email, name="send_email"),
+    path("messages/batch", views.send_batch, name="send_batch"),
+    path("messages", views.find_messages, name="find_messages"),
+    path("messages/<int:message_id>/status", views.get_message_status, name="get_message_status"),
+    path("messages/<int:message_id>/body", views.get_message_body, name="get_message_body"),
     path("webhooks/sms", views.receive_sms, name="receive_sms"),
     path("webhooks/email", views.receive_email, name="receive_email"),
+    path("webhooks/sms/batch", views.receive_sms_batch, name="receive_sms_batch"),
+    path("webhooks/email/batch", views.receive_email_batch, name="receive_email_batch"),
     path("conversations", views.get_conversations, name="get_conversations"),
     path("conversations/<int:conversation_id>/messages", views.get_messages, name="get_messages"),
+    path("search", views.search_messages, name="search_messages"),
+    path("metrics", views.get_metrics, name="get_metrics"),
+    path("dead-letters", views.get_dead_letters, name="get_dead_letters"),
+    path("dead-letters/requeue", views.requeue_dead_letters, name="requeue_dead_letters"),
 ]
\ No newline at end of file
@@ -1,12 +1,27 @@
 from django.shortcuts import render
-from .models import Message, Conversation, Participant, Attachment, APIToken, MessageStatus
+from .models import Message, Conversation, Attachment, APIToken, MessageStatus, OutboxEntry, DeadLetter, BodyStorage
 from django.http import JsonResponse
 from tenacity import retry, stop_after_attempt, wait_exponential
 from django.views.decorators.http import require_http_methods
 import json
-from .tasks import attempt_send_message
+from .tasks import attempt_send_message, publish_sends
+from .caches import conversation_cache, participant_cache
+from .circuitbreaker import circuit_breaker
+from .ratelimit import rate_limiter
+from .integrations import PROVIDER_FOR_TYPE
 from django.core.paginator import Paginator
 from django.views.decorators.csrf import csrf_exempt
+from django.db import transaction
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.core.cache import cache
+from django.conf import settings
+from django.db.models import FloatField, Q
+from django.db.models.functions import Cast
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+import base64
 
 # currently not used so the tests pass, but I'm anticipating we'll need it
 def token_required(view_func):
@@ -26,52 +41,66 @@ def token_required(view_func):
     return wrapped_view
 
 REQUIRED_FIELDS = {'from', 'to', 'body', 'timestamp'}
-OPTIONAL_FIELDS = {'messaging_provider_id', 'attachments', 'type'}
+OPTIONAL_FIELDS = {'messaging_provider_id', 'attachments', 'type', 'priority'}
+
+def validate_entity(data, type):
+  """Returns (resolved message type, error string or None) for a single payload"""
+  if not all(field in data for field in REQUIRED_FIELDS):
+    return type, 'Missing some required fields: ' + ', '.join(REQUIRED_FIELDS - set(data.keys()))
+  if data.get('priority') is not None and data['priority'] not in MessageStatus.Priority.values:
+    return type, 'Priority must be transactional or bulk'
+
+  if type == 'email':
+    return type, None
+  elif type == 'sms':
+    if data.get('type') not in ('sms', 'mms'):
+      return type, 'Type must be sms or mms'
+    return data['type'], None
+  return type, 'Invalid type'
 
 def send_entity(request, type):
     try:
       data = json.loads(request.body)
-      if not all(field in data for field in REQUIRED_FIELDS):
-        return JsonResponse({'error': 'Missing some required fields: ' + ', '.join(REQUIRED_FIELDS - set(data.keys()))}, status=400)
-      
-      if type == 'email':
-        pass
-      elif type == 'sms':
-        if data['type'] != 'sms' and data['type'] != 'mms':
-          return JsonResponse({'error': 'Type must be sms or mms'}, status=400)
-        type = data['type']
-      else:
-        return JsonResponse({'error': 'Invalid type'}, status=400)
-      
+      type, error = validate_entity(data, type)
+      if error:
+        return JsonResponse({'error': error}, status=400)
 
-      from_participant, created = Participant.objects.get_or_create(identifier=data['from'])
-      to_participant, created = Participant.objects.get_or_create(identifier=data['to'])
+      participant_ids = participant_cache.resolve([data['from'], data['to']])
+      from_participant_id, to_participant_id = participant_ids[data['from']], participant_ids[data['to']]
 
-      conversation, created = Conversation.objects.get_or_create_conversation(from_participant, to_participant)
+      conversation_id = conversation_cache.get_or_create(from_participant_id, to_participant_id)
 
 
       additional_fields = {k: v for k, v in data.items() if k not in REQUIRED_FIELDS and k not in OPTIONAL_FIELDS}
       message = Message.objects.create(
-          conversation=conversation,
-          from_participant=from_participant,
-          to_participant=to_participant,
+          conversation_id=conversation_id,
+          from_participant_id=from_participant_id,
+          to_participant_id=to_participant_id,
           type=type,
           body=data['body'],
           timestamp=data['timestamp'],
           messaging_provider_id=data.get('messaging_provider_id', ''),
           additional_data=additional_fields,
       )
-      message.outbound_status = MessageStatus.objects.create()
+      message.outbound_status = MessageStatus.objects.create(
+        priority=data.get('priority') or MessageStatus.Priority.TRANSACTIONAL,
+      )
       message.save()
 
       for attachment_url in data.get('attachments', []) or []:
         Attachment.objects.create(message=message, url=attachment_url)
+      Conversation.objects.record_messages([message])
     except Exception as e:
       print(e)
       return JsonResponse({'error': 'Error creating message, likely invalid data'}, status=400)
         
+    if settings.API_ASYNC_SEND:
+      # don't hold the request (and its ATOMIC_REQUESTS transaction) open for the provider call
+      queue_sends([message.id])
+      return JsonResponse({'message': 'Outbound message queued', 'message_id': message.id}, status=202)
+
     # this is a blocking call, a hack for the sake of the tests; actually dev defaults to CELERY_ALWAYS_EAGER=True anyway
-    # in prod we'd use .delay()
+    # in prod we'd use .delay(), see API_ASYNC_SEND
     try:
       attempt_send_message.apply(args=[message.id])
     except Exception as e:
@@ -95,46 +124,241 @@ def send_sms(request):
 def send_email(request):
   return send_entity(request, 'email')
 
+BATCH_MAX_SIZE = 1000
+BULK_CREATE_BATCH_SIZE = 500
+BATCH_TYPES = {'sms': 'sms', 'mms': 'sms', 'email': 'email'} # message type -> endpoint type
+
+def validate_batch(items, type=None):
+  """Validates each item of a batch payload. Returns (list of (index, type, data), list of per-item error results)
+
+  With no type, items may mix channels and each must name its own type (sms, mms or email)."""
+  valid, errors = [], []
+  timestamp_field = Message._meta.get_field('timestamp')
+  for index, data in enumerate(items):
+    if not isinstance(data, dict):
+      errors.append({'index': index, 'status': 400, 'error': 'Expected a message object'})
+      continue
+    if type is None and data.get('type') not in BATCH_TYPES:
+      errors.append({'index': index, 'status': 400, 'error': 'Type must be sms, mms or email'})
+      continue
+    item_type, error = validate_entity(data, type or BATCH_TYPES[data['type']])
+    if not error and data['from'] == data['to']:
+      error = 'A conversation cannot be between the same participant.'
+    if not error:
+      try:
+        timestamp_field.to_python(data['timestamp'])
+      except ValidationError:
+        error = 'Invalid timestamp'
+    if error:
+      errors.append({'index': index, 'status': 400, 'error': error})
+    else:
+      valid.append((index, item_type, data))
+  return valid, errors
+
+def bulk_create_messages(entries, outbound, priority=MessageStatus.Priority.BULK):
+  """Creates a Message (plus MessageStatus if outbound, plus attachments) for each validated (type, data) entry.
+  Outbound sends go in the `priority` lane unless their payload names one.
+
+  Round trips are per batch rather than per message: participants, conversations, statuses, messages and
+  attachments are each resolved or inserted with set-based statements. Returns the messages in entry order.
+  """
+  participant_ids = participant_cache.resolve(
+    {data['from'] for _, data in entries} | {data['to'] for _, data in entries}
+  )
+  pairs = [(participant_ids[data['from']], participant_ids[data['to']]) for _, data in entries]
+  conversation_ids = conversation_cache.resolve(pairs)
+
+  statuses = [None] * len(entries)
+  if outbound:
+    statuses = MessageStatus.objects.bulk_create(
+      [MessageStatus(priority=data.get('priority') or priority) for _, data in entries], batch_size=BULK_CREATE_BATCH_SIZE,
+    )
+
+  messages = Message.objects.bulk_create([
+    Message(
+      outbound_status=status,
+      conversation_id=conversation_ids[(min(from_id, to_id), max(from_id, to_id))],
+      from_participant_id=from_id,
+      to_participant_id=to_id,
+      type=type,
+      body=data['body'],
+      timestamp=data['timestamp'],
+      messaging_provider_id=data.get('messaging_provider_id', ''),
+      additional_data={k: v for k, v in data.items() if k not in REQUIRED_FIELDS and k not in OPTIONAL_FIELDS},
+    )
+    for (type, data), (from_id, to_id), status in zip(entries, pairs, statuses)
+  ], batch_size=BULK_CREATE_BATCH_SIZE)
+
+  Attachment.objects.bulk_create([
+    Attachment(message=message, url=attachment_url)
+    for (_, data), message in zip(entries, messages)
+    for attachment_url in data.get('attachments', []) or []
+  ], batch_size=BULK_CREATE_BATCH_SIZE)
+  Conversation.objects.record_messages(messages)
+  return messages
+
+def parse_batch(request):
+  """Returns (items, error JsonResponse or None) for a batch request body: a JSON array of message payloads"""
+  try:
+    items = json.loads(request.body)
+  except ValueError:
+    return None, JsonResponse({'error': 'Invalid JSON'}, status=400)
+  if not isinstance(items, list):
+    return None, JsonResponse({'error': 'Expected a list of messages'}, status=400)
+  if len(items) > BATCH_MAX_SIZE:
+    return None, JsonResponse({'error': f'Batches are limited to {BATCH_MAX_SIZE} messages'}, status=400)
+  return items, None
+
+def queue_sends(message_ids):
+  """Queues outbound messages through the outbox. The entries commit with the messages and are published right
+  after, the task is only published once the message is committed so the worker can see it. If that fails (the
+  broker is down, the process dies) or the task is lost, the relay_outbox task publishes them instead."""
+  OutboxEntry.objects.add(message_ids)
+  def publish():
+    try:
+      OutboxEntry.objects.relay(publish_sends, message_ids=message_ids)
+    except Exception as e:
+      print(f"Couldn't publish sends, leaving them to the outbox relay: {e!r}")
+  transaction.on_commit(publish)
+
+# @token_required
+@csrf_exempt
+@require_http_methods(["POST"])
+def send_batch(request):
+  """Saves a mixed list of sms/mms/email payloads and queues them for sending, in the bulk lane unless an item
+  says "priority": "transactional".
+  Returns a result per item, in request order; valid items are accepted even if others fail validation."""
+  items, error = parse_batch(request)
+  if error:
+    return error
+
+  valid, results = validate_batch(items)
+  if valid:
+    try:
+      messages = bulk_create_messages([(type, data) for _, type, data in valid], outbound=True)
+    except Exception as e:
+      print(e)
+      return JsonResponse({'error': 'Error creating messages, likely invalid data'}, status=400)
+
+    # unlike send_entity we don't send inline, a batch of provider calls would hold the request (and its transaction) open
+    queue_sends([message.id for message in messages])
+    results += [
+      {'index': index, 'status': 202, 'message_id': message.id}
+      for (index, _, _), message in zip(valid, messages)
+    ]
+
+  results.sort(key=lambda result: result['index'])
+  return JsonResponse({'results': results}, status=200)
+
+# @token_required
+@require_http_methods(["GET"])
+def get_message_status(request, message_id):
+  try:
+    message = Message.objects.select_related('outbound_status').get(id=message_id)
+  except Message.DoesNotExist:
+    return JsonResponse({'error': 'Message not found'}, status=404)
+  if not message.outbound_status:
+    return JsonResponse({'error': 'Not an outbound message'}, status=404)
+
+  status = message.outbound_status
+  return JsonResponse({
+    'message_id': message.id,
+    'state': status.state,
+    'priority': status.priority,
+    'status': status.send_success,
+    'error_message': status.error_message,
+    'last_http_status_code': status.last_http_status_code,
+    'send_attempts': status.send_attempts,
+  }, status=200)
+
+# @token_required
+@require_http_methods(["GET"])
+def get_message_body(request, message_id):
+  """A message's full body, however it's stored"""
+  try:
+    message = Message.objects.get(id=message_id)
+  except Message.DoesNotExist:
+    return JsonResponse({'error': 'Message not found'}, status=404)
+  return JsonResponse({'message_id': message.id, 'body': message.body}, status=200)
+
+def inbound_dedupe_key(type, messaging_provider_id):
+  return f'api:inbound:{type}:{messaging_provider_id}'
+
+def find_inbound_duplicates(entries, check_database=True):
+  """Returns {(type, messaging_provider_id): message id} for entries already received, checking the recently-seen cache first"""
+  keys = {(type, data['messaging_provider_id']) for type, data in entries if data.get('messaging_provider_id')}
+  if not keys:
+    return {}
+
+  found = {}
+  if settings.API_WEBHOOK_DEDUPE_TIMEOUT:
+    cached = cache.get_many([inbound_dedupe_key(*key) for key in keys])
+    found = {key: cached[inbound_dedupe_key(*key)] for key in keys if inbound_dedupe_key(*key) in cached}
+
+  remaining = keys - found.keys()
+  if remaining and check_database:
+    existing = Message.objects.filter(
+      outbound_status__isnull=True,
+      type__in={type for type, _ in remaining},
+      messaging_provider_id__in={messaging_provider_id for _, messaging_provider_id in remaining},
+    ).values_list('type', 'messaging_provider_id', 'id')
+    found.update({(type, provider_id): id for type, provider_id, id in existing if (type, provider_id) in remaining})
+  return found
+
+def remember_inbound(messages):
+  if settings.API_WEBHOOK_DEDUPE_TIMEOUT:
+    cache.set_many({
+      inbound_dedupe_key(message.type, message.messaging_provider_id): message.id
+      for message in messages if message.messaging_provider_id
+    }, timeout=settings.API_WEBHOOK_DEDUPE_TIMEOUT)
+
+INBOUND_RECEIVED = {'message': 'Inbound message received and saved'}
+
 def receive_entity(request, type):
     try:
       data = json.loads(request.body)
-      if not all(field in data for field in REQUIRED_FIELDS):
-        return JsonResponse({'error': 'Missing some required fields: ' + ', '.join(REQUIRED_FIELDS - set(data.keys()))}, status=400)
-
-      if type == 'email':
-        pass
-      elif type == 'sms':
-        if data['type'] != 'sms' and data['type'] != 'mms':
-          return JsonResponse({'error': 'Type must be sms or mms'}, status=400)
-        type = data['type']
-      else:
-        return JsonResponse({'error': 'Invalid type'}, status=400)
-      
-      from_participant, created = Participant.objects.get_or_create(identifier=data['from'])
-      to_participant, created = Participant.objects.get_or_create(identifier=data['to'])
-
-      conversation, created = Conversation.objects.get_or_create_conversation(from_participant, to_participant)
+      type, error = validate_entity(data, type)
+      if error:
+        return JsonResponse({'error': error}, status=400)
+
+      # a provider retry: acknowledge it the same way as the original delivery without writing again.
+      # past the cache the unique index catches it, so a new message doesn't pay for an extra lookup
+      if find_inbound_duplicates([(type, data)], check_database=False):
+        return JsonResponse(INBOUND_RECEIVED, status=201)
+
+      participant_ids = participant_cache.resolve([data['from'], data['to']])
+      from_participant_id, to_participant_id = participant_ids[data['from']], participant_ids[data['to']]
+
+      conversation_id = conversation_cache.get_or_create(from_participant_id, to_participant_id)
 
       additional_fields = {k: v for k, v in data.items() if k not in REQUIRED_FIELDS and k not in OPTIONAL_FIELDS}
-      message = Message.objects.create(
-          conversation=conversation,
-          from_participant=from_participant,
-          to_participant=to_participant,
-          type=type,
-          body=data['body'],
-          timestamp=data['timestamp'],
-          messaging_provider_id=data.get('messaging_provider_id', ''),
-          additional_data=additional_fields,
-      )
-      message.save()
+      try:
+        with transaction.atomic():
+          message = Message.objects.create(
+              conversation_id=conversation_id,
+              from_participant_id=from_participant_id,
+              to_participant_id=to_participant_id,
+              type=type,
+              body=data['body'],
+              timestamp=data['timestamp'],
+              messaging_provider_id=data.get('messaging_provider_id', ''),
+              additional_data=additional_fields,
+          )
+      except IntegrityError:
+        # lost a race against a concurrent retry of the same message
+        if find_inbound_duplicates([(type, data)]):
+          return JsonResponse(INBOUND_RECEIVED, status=201)
+        raise
 
       for attachment_url in data.get('attachments', []) or []:
         Attachment.objects.create(message=message, url=attachment_url)
+      Conversation.objects.record_messages([message])
     except Exception as e:
       print(e)
       return JsonResponse({'error': 'Error creating message, likely invalid data'}, status=400)
 
-    return JsonResponse({'message': 'Inbound message received and saved'}, status=201)
+    remember_inbound([message])
+    return JsonResponse(INBOUND_RECEIVED, status=201)
 
 
 # @token_required
@@ -149,24 +373,160 @@ def receive_sms(request):
 def receive_email(request):
   return receive_entity(request, 'email')
 
+def receive_batch(request, type):
+  items, error = parse_batch(request)
+  if error:
+    return error
+
+  valid, results = validate_batch(items, type)
+  try:
+    # retries may repeat a message within the batch as well as across requests; only the first copy is created
+    first_index = {}
+    for index, item_type, data in valid:
+      if data.get('messaging_provider_id'):
+        first_index.setdefault((item_type, data['messaging_provider_id']), index)
+    for attempt in range(2):
+      duplicates = find_inbound_duplicates([(item_type, data) for _, item_type, data in valid])
+      to_create = [
+        (index, item_type, data) for index, item_type, data in valid
+        if (item_type, data.get('messaging_provider_id')) not in duplicates
+        and first_index.get((item_type, data.get('messaging_provider_id')), index) == index
+      ]
+      try:
+        with transaction.atomic():
+          messages = bulk_create_messages([(item_type, data) for _, item_type, data in to_create], outbound=False) if to_create else []
+        break
+      except IntegrityError:
+        # a concurrent delivery inserted some of these since we checked, check again
+        if attempt:
+          raise
+  except Exception as e:
+    print(e)
+    return JsonResponse({'error': 'Error creating messages, likely invalid data'}, status=400)
+
+  remember_inbound(messages)
+  message_ids = dict(duplicates)
+  message_ids.update({(message.type, message.messaging_provider_id): message.id for message in messages})
+  created = {index for index, _, _ in to_create}
+  results += [{'index': index, 'status': 201, 'message_id': message.id} for (index, _, _), message in zip(to_create, messages)]
+  results += [
+    {'index': index, 'status': 201, 'message_id': message_ids[(item_type, data['messaging_provider_id'])]}
+    for index, item_type, data in valid if index not in created
+  ]
+
+  results.sort(key=lambda result: result['index'])
+  return JsonResponse({'results': results}, status=200)
+
+# For providers that deliver events in bulk: a JSON array of the same payloads receive_sms/receive_email take
+
+# @token_required
+@csrf_exempt
+@require_http_methods(["POST"])
+def receive_sms_batch(request):
+  return receive_batch(request, 'sms')
+
+# @token_required
+@csrf_exempt
+@require_http_methods(["POST"])
+def receive_email_batch(request):
+  return receive_batch(request, 'email')
+
+def encode_cursor(value, id):
+  # isoformat rather than DjangoJSONEncoder, which truncates to milliseconds and would skip rows
+  value = value.isoformat() if hasattr(value, 'isoformat') else value
+  return base64.urlsafe_b64encode(json.dumps([value, id]).encode()).decode()
+
+def parse_cursor_datetime(value):
+  return parse_datetime(value) if isinstance(value, str) else None
+
+def parse_cursor_number(value):
+  return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+def decode_cursor(cursor, parse=parse_cursor_datetime):
+  """Returns the (ordering value, id) a cursor points after, or raises ValueError"""
+  try:
+    value, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+  except Exception:
+    raise ValueError('Invalid cursor')
+  value = parse(value)
+  if value is None or not isinstance(id, int):
+    raise ValueError('Invalid cursor')
+  return value, id
+
+def keyset_page(queryset, field, cursor, page_size, parse=parse_cursor_datetime):
+  """Cursor pagination over (field, id) descending. No COUNT and no OFFSET, a page costs the same however deep it is.
+  field may be an annotation, parse turns its value back out of a cursor.
+
+  Returns (objects, next_cursor or None). An empty cursor is the first page."""
+  queryset = queryset.order_by(f'-{field}', '-id')
+  if cursor:
+    value, id = decode_cursor(cursor, parse)
+    queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': id}))
+  objects = list(queryset[:page_size + 1])
+  if len(objects) <= page_size:
+    return objects, None
+  objects = objects[:page_size]
+  return objects, encode_cursor(getattr(objects[-1], field), objects[-1].id)
+
+def serialize_conversation(conversation):
+  return {
+    'id': conversation.id,
+    'participants': [conversation.participant1.identifier, conversation.participant2.identifier],
+    'last_message_at': conversation.last_message_at,
+    'last_message_preview': conversation.last_message_preview,
+    'message_count': conversation.message_count,
+  }
+
+def serialize_message(message):
+  return {
+    'id': message.id,
+    # a body that was compressed or moved out of its row is left out, fetch it from the message's body/ endpoint
+    'body': message.inline_body if message.body_storage == BodyStorage.INLINE else None,
+    'body_preview': message.body_preview,
+    'timestamp': message.timestamp,
+    'type': message.type,
+    'from': message.from_participant.identifier,
+    'to': message.to_participant.identifier,
+    'status': message.outbound_status.send_success if message.outbound_status else None,
+    'error_message': message.outbound_status.error_message if message.outbound_status else None,
+    'last_http_status_code': message.outbound_status.last_http_status_code if message.outbound_status else None,
+    'send_attempts': message.outbound_status.send_attempts if message.outbound_status else 0,
+    'additional_data': message.additional_data,
+    'attachments': [attachment.url for attachment in message.attachments.all()],
+  }
+
 CONVERSATIONS_PAGE_SIZE = 20
 
+# Both listings take either ?page=N (the original, counted pagination) or ?cursor=<next_cursor>
+# for keyset pagination; pass an empty ?cursor= to get the first keyset page.
+
 # @token_required
 @require_http_methods(["GET"])
 def get_conversations(request):
-  conversations = Conversation.objects.all()
+  conversations = Conversation.objects.select_related('participant1', 'participant2')
+  order_field = 'created_at'
+  # ?sort=recent is the inbox: most recently active first, conversations with no messages yet left out
+  if request.GET.get('sort') == 'recent':
+    order_field = 'last_message_at'
+    conversations = conversations.filter(last_message_at__isnull=False).order_by('-last_message_at', '-id')
+
+  if 'cursor' in request.GET:
+    try:
+      page, next_cursor = keyset_page(conversations, order_field, request.GET['cursor'], CONVERSATIONS_PAGE_SIZE)
+    except ValueError as e:
+      return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+      'conversations': [serialize_conversation(conversation) for conversation in page],
+      'next_cursor': next_cursor,
+      'has_next': next_cursor is not None,
+    }, status=200)
+
   paginator = Paginator(conversations, CONVERSATIONS_PAGE_SIZE)
 
   page_number = request.GET.get('page', 1)
   page = paginator.get_page(page_number)
   return JsonResponse({
-    'conversations': [
-      {
-        'id': conversation.id,
-        'participants': [conversation.participant1.identifier, conversation.participant2.identifier],
-      }
-      for conversation in page.object_list
-    ],
+    'conversations': [serialize_conversation(conversation) for conversation in page.object_list],
     'total_pages': paginator.num_pages,
     'current_page': page.number,
     'has_next': page.has_next(),
@@ -176,34 +536,217 @@ def get_conversations(request):
 
 MESSAGES_PAGE_SIZE = 20
 
+def additional_data_filter(params):
+  """The object messages' additional_data must contain, from ?data=<JSON object> and/or ?data.<key>=<string value>.
+  Compiles to additional_data @> '{...}', which api_msg_additional_data_idx answers. Raises ValueError if invalid."""
+  data = {}
+  if params.get('data'):
+    try:
+      data = json.loads(params['data'])
+    except ValueError:
+      data = None
+    if not isinstance(data, dict):
+      raise ValueError('data must be a JSON object')
+  for key, value in params.items():
+    if key.startswith('data.') and len(key) > len('data.'):
+      data[key[len('data.'):]] = value
+  return data
+
+def time_window_filter(params):
+  """Filters for ?since= (inclusive) and ?until= (exclusive) timestamps. Messages are partitioned by month, so a
+  window only reads the months it covers. Raises ValueError if invalid."""
+  filters = {}
+  for name, lookup in [('since', 'timestamp__gte'), ('until', 'timestamp__lt')]:
+    if params.get(name):
+      value = parse_datetime(params[name])
+      if value is None:
+        raise ValueError(f'{name} must be an ISO 8601 datetime')
+      filters[lookup] = timezone.make_aware(value) if timezone.is_naive(value) else value
+  return filters
+
+# @token_required
+@require_http_methods(["GET"])
+def find_messages(request):
+  """Messages across all conversations by their additional_data, e.g. a provider's id for them:
+  ?data={"xillio_id": "abc"} or ?data.xillio_id=abc, optionally within ?since= and ?until=. Newest first, keyset
+  paginated (?cursor=)."""
+  try:
+    data = additional_data_filter(request.GET)
+    if not data:
+      raise ValueError('A data filter is required')
+    messages = Message.objects.filter(additional_data__contains=data, **time_window_filter(request.GET)).select_related(
+      'from_participant', 'to_participant', 'outbound_status',
+    ).prefetch_related('attachments').defer('body_compressed', 'search_vector')
+    page, next_cursor = keyset_page(messages, 'timestamp', request.GET.get('cursor'), MESSAGES_PAGE_SIZE)
+  except ValueError as e:
+    return JsonResponse({'error': str(e)}, status=400)
+  return JsonResponse({
+    'messages': [serialize_message(message) for message in page],
+    'next_cursor': next_cursor,
+    'has_next': next_cursor is not None,
+  }, status=200)
+
 # @token_required
 @require_http_methods(["GET"])
 def get_messages(request, conversation_id):
   conversation = Conversation.objects.get(id=conversation_id)
-  messages = conversation.messages.all()
+  # everything serialize_message touches, so a page is a fixed number of queries however many messages/attachments it has
+  messages = conversation.messages.select_related(
+    'from_participant', 'to_participant', 'outbound_status',
+  ).prefetch_related('attachments').defer('body_compressed', 'search_vector')
+  try:
+    data = additional_data_filter(request.GET)
+    messages = messages.filter(**time_window_filter(request.GET))
+  except ValueError as e:
+    return JsonResponse({'error': str(e)}, status=400)
+  if data:
+    messages = messages.filter(additional_data__contains=data)
+
+  if 'cursor' in request.GET:
+    try:
+      page, next_cursor = keyset_page(messages, 'timestamp', request.GET['cursor'], MESSAGES_PAGE_SIZE)
+    except ValueError as e:
+      return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+      'messages': [serialize_message(message) for message in page],
+      'next_cursor': next_cursor,
+      'has_next': next_cursor is not None,
+    }, status=200)
+
   paginator = Paginator(messages, MESSAGES_PAGE_SIZE)
   page_number = request.GET.get('page', 1)
   page = paginator.get_page(page_number)
   return JsonResponse({
-    'messages': [
-      {
-        'id': message.id,
-        'body': message.body,
-        'timestamp': message.timestamp,
-        'type': message.type,
-        'from': message.from_participant.identifier,
-        'to': message.to_participant.identifier,
-        'status': message.outbound_status.send_success if message.outbound_status else None,
-        'error_message': message.outbound_status.error_message if message.outbound_status else None,
-        'last_http_status_code': message.outbound_status.last_http_status_code if message.outbound_status else None,
-        'send_attempts': message.outbound_status.send_attempts if message.outbound_status else 0,
-        'additional_data': message.additional_data,
-        'attachments': [attachment.url for attachment in message.attachments.all()],
-      }
-      for message in page.object_list
-    ],
+    'messages': [serialize_message(message) for message in page.object_list],
     'total_pages': paginator.num_pages,
     'current_page': page.number,
     'has_next': page.has_next(),
     'has_previous': page.has_previous(),
   }, status=200)
+
+
+SEARCH_PAGE_SIZE = 20
+
+# @token_required
+@require_http_methods(["GET"])
+def search_messages(request):
+  """Full-text search over message bodies, best match first: ?q= (web search syntax: "quoted phrases", or, -not),
+  narrowed by ?participant= (an identifier, sender or recipient), ?type=, ?since= and ?until= (timestamps).
+  Keyset paginated (?cursor=)."""
+  q = request.GET.get('q', '').strip()
+  if not q:
+    return JsonResponse({'error': 'q is required'}, status=400)
+  query = SearchQuery(q, search_type='websearch', config=settings.API_SEARCH_CONFIG)
+  # cast as ts_rank's real doesn't round trip through a cursor exactly
+  messages = Message.objects.filter(search_vector=query).annotate(rank=Cast(SearchRank('search_vector', query), FloatField()))
+
+  if request.GET.get('participant'):
+    participant_id = participant_cache.lookup([request.GET['participant']]).get(request.GET['participant'])
+    messages = messages.filter(Q(from_participant_id=participant_id) | Q(to_participant_id=participant_id))
+  if request.GET.get('type'):
+    messages = messages.filter(type=request.GET['type'])
+  try:
+    messages = messages.filter(**time_window_filter(request.GET))
+  except ValueError as e:
+    return JsonResponse({'error': str(e)}, status=400)
+
+  messages = messages.select_related(
+    'from_participant', 'to_participant', 'outbound_status',
+  ).prefetch_related('attachments').defer('body_compressed', 'search_vector')
+  try:
+    page, next_cursor = keyset_page(messages, 'rank', request.GET.get('cursor'), SEARCH_PAGE_SIZE, parse=parse_cursor_number)
+  except ValueError as e:
+    return JsonResponse({'error': str(e)}, status=400)
+  return JsonResponse({
+    'messages': [{**serialize_message(message), 'rank': message.rank} for message in page],
+    'next_cursor': next_cursor,
+    'has_next': next_cursor is not None,
+  }, status=200)
+
+
+@require_http_methods(["GET"])
+def get_metrics(request):
+  """Operational state for dashboards and alerting"""
+  return JsonResponse({
+    'rate_limits': rate_limiter.state(),
+    'circuit_breakers': circuit_breaker.state(),
+    # this process's own, each worker keeps its caches in memory
+    'caches': {'participants': participant_cache.stats(), 'conversations': conversation_cache.stats()},
+    'outbox': {'waiting': OutboxEntry.objects.due().count(), 'lag_seconds': round(OutboxEntry.objects.lag(), 2)},
+    'dead_letters': DeadLetter.objects.count(),
+  })
+
+
+DEAD_LETTERS_PAGE_SIZE = 100
+
+def dead_letter_filters(params):
+  """Dead letter filters from a query string or JSON body: provider, reason, status_code, since and until.
+  Raises ValueError if one is invalid."""
+  filters = {}
+  if params.get('provider'):
+    if params['provider'] not in settings.API_PROVIDERS:
+      raise ValueError(f"Unknown provider: {params['provider']}")
+    filters['provider'] = params['provider']
+  if params.get('reason'):
+    filters['reason'] = params['reason']
+  if params.get('status_code') not in (None, ''):
+    try:
+      filters['http_status_code'] = int(params['status_code'])
+    except (TypeError, ValueError):
+      raise ValueError('status_code must be an integer')
+  for name in ['since', 'until']:
+    if params.get(name):
+      value = parse_datetime(params[name]) if isinstance(params[name], str) else None
+      if value is None:
+        raise ValueError(f'{name} must be an ISO 8601 datetime')
+      filters[name] = timezone.make_aware(value) if timezone.is_naive(value) else value
+  return filters
+
+def serialize_dead_letter(dead_letter):
+  return {
+    'message_id': dead_letter.message_id,
+    'type': dead_letter.type,
+    'provider': PROVIDER_FOR_TYPE.get(dead_letter.type),
+    'reason': dead_letter.reason,
+    'http_status_code': dead_letter.http_status_code,
+    'failed_at': dead_letter.failed_at,
+  }
+
+# @token_required
+@require_http_methods(["GET"])
+def get_dead_letters(request):
+  """Sends that were given up on, most recent first, keyset paginated like the listings (?cursor=)"""
+  try:
+    dead_letters = DeadLetter.objects.matching(**dead_letter_filters(request.GET))
+    page, next_cursor = keyset_page(dead_letters, 'failed_at', request.GET.get('cursor'), DEAD_LETTERS_PAGE_SIZE)
+  except ValueError as e:
+    return JsonResponse({'error': str(e)}, status=400)
+  return JsonResponse({
+    'dead_letters': [serialize_dead_letter(dead_letter) for dead_letter in page],
+    'next_cursor': next_cursor,
+    'has_next': next_cursor is not None,
+  }, status=200)
+
+# @token_required
+@csrf_exempt
+@transaction.non_atomic_requests # requeue commits chunk by chunk
+@require_http_methods(["POST"])
+def requeue_dead_letters(request):
+  """Puts the dead letters matching the filters in the body (all of them with none) back up for retry, at most
+  "limit" of them if given. The sends go out through pump_retries at each provider's retry budget."""
+  try:
+    data = json.loads(request.body or '{}')
+  except json.JSONDecodeError:
+    return JsonResponse({'error': 'Invalid JSON'}, status=400)
+  if not isinstance(data, dict):
+    return JsonResponse({'error': 'Expected an object of filters'}, status=400)
+  limit = data.get('limit')
+  if limit is not None and (not isinstance(limit, int) or limit < 1):
+    return JsonResponse({'error': 'limit must be a positive integer'}, status=400)
+  try:
+    dead_letters = DeadLetter.objects.matching(**dead_letter_filters(data))
+  except ValueError as e:
+    return JsonResponse({'error': str(e)}, status=400)
+
+  requeued = dead_letters.requeue(settings.API_DEAD_LETTER_REQUEUE_CHUNK_SIZE, limit=limit)
+  return JsonResponse({'requeued': requeued}, status=200)